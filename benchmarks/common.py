@@ -0,0 +1,97 @@
+"""Helpers shared by the benchmarks: timing, percentiles, peak memory and machine-readable results."""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Any, Callable, Optional, Sequence
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def git_commit() -> str:
+    """
+    :return: The short hash of the commit being benchmarked, with a + if the working tree has changes
+    """
+    try:
+        commit: str = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty: str = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}+" if dirty else commit
+
+
+def peak_rss_mb() -> float:
+    """
+    :return: The peak resident set size of this process so far, in MiB
+    """
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """
+    :param values: The measurements
+    :param p: The percentile, between 0 and 100
+    :return: The nearest-rank percentile of the values, or None if there are none
+    """
+    if not values:
+        return None
+    ordered: list[float] = sorted(values)
+    rank: int = max(int(round(p / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def best_time(func: Callable[[], Any], repeat: int) -> float:
+    """
+    :return: The shortest of repeat runs of the function in seconds, which is the one least disturbed by noise
+    """
+    best: float = float("inf")
+    for _ in range(max(repeat, 1)):
+        start: float = perf_counter()
+        func()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def write_results(benchmark: str, cases: list[dict[str, Any]], path: Optional[str] = None) -> str:
+    """
+    Writes the results as JSON, along with what they were measured on. Cases are identified by their "case" key, and
+    compared by benchmarks.compare: metrics ending in _per_s are better higher, metrics starting with latency_ or
+    ending in _mb are better lower.
+    :param benchmark: The name of the benchmark
+    :param cases: The results of each case
+    :param path: Where to write the results, by default benchmarks/results/<benchmark>-<commit>.json
+    :return: The path of the results
+    """
+    commit: str = git_commit()
+    results: dict[str, Any] = {
+        "benchmark": benchmark,
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "cases": cases,
+    }
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{benchmark}-{commit}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+    return path
+
+
+def print_cases(cases: list[dict[str, Any]]) -> None:
+    for case in cases:
+        print(", ".join(f"{key}={value}" for key, value in case.items()))
@@ -0,0 +1,70 @@
+"""
+Compares the results of a benchmark between two commits case by case, e.g.
+    python -m benchmarks.compare benchmarks/results/decode-abc1234.json benchmarks/results/decode-def5678.json
+Exits with status 1 if any metric got worse by more than the threshold.
+"""
+
+import argparse
+import json
+import sys
+from typing import Any, Optional
+
+
+def higher_is_better(metric: str) -> Optional[bool]:
+    """
+    :return: Whether a higher value of the metric is better, or None if it isn't a metric
+    """
+    if metric.endswith("_per_s"):
+        return True
+    if metric.startswith("latency_") or metric.endswith("_mb"):
+        return False
+    return None
+
+
+def compare(baseline: dict[str, Any], candidate: dict[str, Any], threshold: float) -> list[str]:
+    """
+    Prints the change in each metric of the cases that both results have
+    :param threshold: The relative change beyond which a metric counts as a regression, e.g. 0.1 for 10%
+    :return: The regressions
+    """
+    regressions: list[str] = []
+    baseline_cases: dict[str, dict[str, Any]] = {case["case"]: case for case in baseline["cases"]}
+    baseline_cases["process"] = {"peak_rss_mb": baseline["peak_rss_mb"]}
+    candidate_cases: list[dict[str, Any]] = candidate["cases"] + [
+        {"case": "process", "peak_rss_mb": candidate["peak_rss_mb"]}
+    ]
+    for case in candidate_cases:
+        before_case: Optional[dict[str, Any]] = baseline_cases.get(case["case"])
+        if before_case is None:
+            continue
+        for metric, after in case.items():
+            better: Optional[bool] = higher_is_better(metric)
+            before = before_case.get(metric)
+            if better is None or not before or after is None:
+                continue
+            change: float = (after - before) / before
+            worse: bool = change < -threshold if better else change > threshold
+            line: str = f"{case['case']} {metric}: {before} -> {after} ({change:+.1%})"
+            print(("REGRESSION " if worse else "") + line)
+            if worse:
+                regressions.append(line)
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline", help="results of the commit to compare against")
+    parser.add_argument("candidate", help="results of the commit being checked")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression")
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline: dict[str, Any] = json.load(f)
+    with open(args.candidate) as f:
+        candidate: dict[str, Any] = json.load(f)
+    print(f"{baseline['benchmark']}: {baseline['commit']} -> {candidate['commit']}")
+    if compare(baseline, candidate, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Microbenchmarks of decoding replication slot entries and turning them into Elasticsearch bulk actions, over synthetic
+streams of each output plugin with docs of varying size and a varying share of changes to tables that aren't synced.
+No Postgres or Elasticsearch is needed, but the settings are read as usual (e.g. from .env), e.g.
+    python -m benchmarks.decode --entries 20000 --repeat 5
+"""
+
+import argparse
+import json
+import random
+from typing import Any, Iterable
+
+from benchmarks.common import best_time, print_cases, write_results
+from sinker.bulk_action_generator import BulkActionGenerator
+from sinker.decoders import Decoder, TestDecodingDecoder, Wal2JsonDecoder
+
+VIEW = "bench_mv"
+INDEX = "bench"
+# number of changes per transaction in the synthetic streams
+TRANSACTION_SIZE = 100
+
+Entry = tuple[int, str, str]
+
+
+class StreamActionGenerator(BulkActionGenerator):
+    """Generates the actions for a synthetic stream of slot entries instead of the replication slot's"""
+
+    def __init__(self, stream: list[Entry], decoder: Decoder):
+        super().__init__({VIEW: INDEX}, {}, decoder)
+        self.stream: list[Entry] = stream
+
+    def entries(self) -> Iterable[Entry]:
+        return iter(self.stream)
+
+
+def test_decoding_change(table: str, doc_id: str, doc: str, op: str = "INSERT") -> str:
+    quoted: str = doc.replace("'", "''")
+    return f"table {table}: {op}: id[text]:'{doc_id}' doc[jsonb]:'{quoted}'"
+
+
+def wal2json_change(table: str, doc_id: str, doc: str, op: str = "I") -> str:
+    schema, _, name = table.partition(".")
+    columns: list[dict[str, Any]] = [{"name": "id", "value": doc_id}, {"name": "doc", "value": doc}]
+    return json.dumps({"action": op, "schema": schema, "table": name, "columns": columns}, separators=(",", ":"))
+
+
+PLUGINS: dict[str, tuple[type[Decoder], Any, str, str]] = {
+    # decoder, change formatter, BEGIN and COMMIT entries
+    "test_decoding": (TestDecodingDecoder, test_decoding_change, "BEGIN {}", "COMMIT {}"),
+    "wal2json": (Wal2JsonDecoder, wal2json_change, '{{"action":"B","xid":{}}}', '{{"action":"C","xid":{}}}'),
+}
+
+
+def stream(plugin: str, entries: int, doc_bytes: int, irrelevant_ratio: float, seed: int = 0) -> list[Entry]:
+    """
+    :param plugin: The output plugin whose output to synthesize
+    :param entries: The number of row changes
+    :param doc_bytes: The rough size of each doc
+    :param irrelevant_ratio: The share of the changes that are to tables that aren't synced
+    :return: (xid, lsn, data) slot entries, with changes to a random doc among as many docs as there are changes, so
+    that some docs change more than once
+    """
+    rng = random.Random(seed)
+    _, change, begin, commit = PLUGINS[plugin]
+    doc: str = json.dumps({"name": "O'Brien", "payload": "x" * max(doc_bytes - 40, 0)})
+    result: list[Entry] = []
+    xid: int = 1000
+    lsn: int = 0
+    for i in range(entries):
+        if i % TRANSACTION_SIZE == 0:
+            xid += 1
+            result.append((xid, f"0/{lsn:X}", begin.format(xid)))
+        lsn += 64
+        if rng.random() < irrelevant_ratio:
+            result.append((xid, f"0/{lsn:X}", change("public.unrelated", f"u-{i}", doc)))
+        else:
+            result.append((xid, f"0/{lsn:X}", change(f"sinker.{VIEW}", f"a-{rng.randrange(entries)}", doc)))
+        if i % TRANSACTION_SIZE == TRANSACTION_SIZE - 1 or i == entries - 1:
+            lsn += 64
+            result.append((xid, f"0/{lsn:X}", commit.format(xid)))
+    return result
+
+
+def run_case(plugin: str, entries: int, doc_bytes: int, irrelevant_ratio: float, repeat: int) -> dict[str, Any]:
+    entries_stream: list[Entry] = stream(plugin, entries, doc_bytes, irrelevant_ratio)
+    decoder: Decoder = PLUGINS[plugin][0]()
+
+    def decode() -> None:
+        for _, _, data in entries_stream:
+            if not decoder.is_commit(data):
+                decoder.decode(data)
+
+    actions: list[int] = []
+
+    def generate() -> None:
+        actions.append(sum(1 for _ in StreamActionGenerator(entries_stream, decoder).generate_actions()))
+
+    decode_seconds: float = best_time(decode, repeat)
+    generate_seconds: float = best_time(generate, repeat)
+    return {
+        "case": f"{plugin}/doc_bytes={doc_bytes}/irrelevant={irrelevant_ratio}",
+        "plugin": plugin,
+        "doc_bytes": doc_bytes,
+        "irrelevant_ratio": irrelevant_ratio,
+        "entries": len(entries_stream),
+        "actions": actions[-1],
+        "decode_entries_per_s": round(len(entries_stream) / decode_seconds),
+        "generate_entries_per_s": round(len(entries_stream) / generate_seconds),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=10000, help="row changes per stream")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, of which the fastest counts")
+    parser.add_argument("--doc-bytes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--irrelevant-ratio", type=float, nargs="+", default=[0, 0.5, 0.9])
+    parser.add_argument("--plugin", nargs="+", choices=sorted(PLUGINS), default=sorted(PLUGINS))
+    parser.add_argument("--output", help="path of the JSON results, by default under benchmarks/results")
+    args = parser.parse_args()
+    cases: list[dict[str, Any]] = [
+        run_case(plugin, args.entries, doc_bytes, irrelevant_ratio, args.repeat)
+        for plugin in args.plugin
+        for doc_bytes in args.doc_bytes
+        for irrelevant_ratio in args.irrelevant_ratio
+    ]
+    print_cases(cases)
+    print(f"Results written to {write_results('decode', cases, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
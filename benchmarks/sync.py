@@ -0,0 +1,135 @@
+"""
+Benchmarks backfilling a synthetic table into Elasticsearch and then syncing batches of updates to it, against the
+Postgres and Elasticsearch that the settings point at, e.g. the docker-compose ones:
+    docker-compose --env-file=.env.test up -d
+    python -m benchmarks.sync --rows 100000 --rounds 20 --batch 1000
+The view is defined in a temporary definitions directory, but Sinker sets up its replication slot and todo tables as
+configured, replacing any existing ones, so don't point this at a live deployment.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+from time import perf_counter, time
+from typing import Any, Dict, Iterable
+
+import psycopg
+
+from benchmarks.common import percentile, print_cases, write_results
+
+TABLE = "bench_item"
+VIEW = "bench_mv"
+INDEX = "bench"
+
+VIEW_SQL = f"""select id, json_build_object('name', name, 'payload', payload, 'version', version) as doc
+from {TABLE}"""
+INDEX_DEFINITION: dict[str, Any] = {
+    "mappings": {"dynamic": False, "properties": {"name": {"type": "keyword"}}},
+    "settings": {"index": {"number_of_shards": "1", "number_of_replicas": "0"}},
+}
+CREATE_TABLE = f"""drop table if exists public.{TABLE} cascade;
+create table public.{TABLE} (id text primary key, name text not null, payload text not null, version int not null);
+insert into public.{TABLE} (id, name, payload, version)
+select 'b-' || i, 'item ' || i, repeat('x', %(payload_bytes)s), 0 from generate_series(1, %(rows)s) as i"""
+UPDATE_ROWS = f"update public.{TABLE} set version = version + 1 where id = any(%(ids)s)"
+
+
+def write_definitions(path: str) -> None:
+    with open(os.path.join(path, "views_to_indices.json"), "w") as f:
+        json.dump({VIEW: INDEX}, f)
+    with open(os.path.join(path, f"{VIEW}.sql"), "w") as f:
+        f.write(VIEW_SQL)
+    with open(os.path.join(path, f"{INDEX}.json"), "w") as f:
+        json.dump(INDEX_DEFINITION, f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000, help="rows to backfill")
+    parser.add_argument("--payload-bytes", type=int, default=500, help="size of each row's payload")
+    parser.add_argument("--rounds", type=int, default=20, help="batches of updates to sync")
+    parser.add_argument("--batch", type=int, default=1000, help="rows updated per batch, in one transaction")
+    parser.add_argument("--output", help="path of the JSON results, by default under benchmarks/results")
+    args = parser.parse_args()
+
+    definitions_path: str = tempfile.mkdtemp(prefix="sinker-bench-")
+    write_definitions(definitions_path)
+    # the settings are read when Sinker is first imported
+    os.environ["SINKER_DEFINITIONS_PATH"] = definitions_path
+    os.environ["SINKER_RESUME"] = "false"
+    from sinker.es import get_client
+    from sinker.pipeline import Pipeline
+    from sinker.runner import Runner
+    from sinker.settings import SINKER_SCHEMA
+
+    # commit times of the updated rows that haven't been acknowledged by Elasticsearch yet
+    committed: dict[str, float] = {}
+    latencies: list[float] = []
+
+    class TimedPipeline(Pipeline):
+        """Measures the time from the commit of each update to Elasticsearch acknowledging its doc"""
+
+        def ship(self, actions: Iterable[Dict[str, Any]]) -> int:
+            shipped: list[str] = []
+
+            def record(actions: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+                for action in actions:
+                    shipped.append(action["_id"])
+                    yield action
+
+            succeeded: int = super().ship(record(actions))
+            acknowledged: float = time()
+            for doc_id in shipped:
+                if doc_id in committed:
+                    latencies.append(acknowledged - committed.pop(doc_id))
+            return succeeded
+
+    with psycopg.connect(autocommit=True) as conn:
+        conn.execute(f"create schema if not exists {SINKER_SCHEMA}")
+        conn.execute(CREATE_TABLE, {"rows": args.rows, "payload_bytes": args.payload_bytes})
+
+        start: float = perf_counter()
+        runner = Runner()
+        backfill_seconds: float = perf_counter() - start
+        runner.pipeline = TimedPipeline(get_client())
+
+        rng = random.Random(0)
+        sync_seconds: float = 0
+        for _ in range(args.rounds):
+            ids: list[str] = [f"b-{rng.randint(1, args.rows)}" for _ in range(args.batch)]
+            conn.execute(UPDATE_ROWS, {"ids": ids})
+            committed_at: float = time()
+            for doc_id in ids:
+                committed.setdefault(doc_id, committed_at)
+            start = perf_counter()
+            # a refresh is due right away with the default schedule, so an iteration syncs the whole batch
+            runner.iterate()
+            sync_seconds += perf_counter() - start
+        runner.listener.close()
+
+    cases: list[dict[str, Any]] = [
+        {
+            "case": f"backfill/rows={args.rows}/payload_bytes={args.payload_bytes}",
+            "rows": args.rows,
+            "seconds": round(backfill_seconds, 3),
+            "backfill_docs_per_s": round(args.rows / backfill_seconds),
+        },
+        {
+            "case": f"sync/batch={args.batch}/payload_bytes={args.payload_bytes}",
+            "rounds": args.rounds,
+            "docs": len(latencies),
+            "unsynced_docs": len(committed),
+            "seconds": round(sync_seconds, 3),
+            "sync_docs_per_s": round(len(latencies) / sync_seconds) if sync_seconds else None,
+            "latency_p50_s": percentile(latencies, 50),
+            "latency_p99_s": percentile(latencies, 99),
+        },
+    ]
+    print_cases(cases)
+    print(f"Results written to {write_results('sync', cases, args.output)}")
+
+
+if __name__ == "__main__":
+    main()
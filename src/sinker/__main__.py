@@ -1,9 +1,98 @@
-from sinker.runner import Runner
+"""
+Synchronizes Postgres materialized views to Elasticsearch indices. With no command, Sinker sets everything up as
+configured and syncs changes from then on, like `sinker run`. The other commands operate on just the given views (all
+of them by default), e.g. to rebuild one index without restarting the workers that sync the others.
+"""
 
+import argparse
+import os
+from typing import Optional
 
-def main():
-    runner = Runner()
-    runner.run()
+# the settings that flags override, by the flags' destinations
+SETTING_FLAGS: dict[str, str] = {
+    "definitions_path": "SINKER_DEFINITIONS_PATH",
+    "log_level": "SINKER_LOG_LEVEL",
+    "partitions": "SINKER_BACKFILL_PARTITIONS",
+    "bulk_threads": "ELASTICSEARCH_BULK_THREADS",
+    "backfill_batch_size": "ELASTICSEARCH_BACKFILL_CHUNK_SIZE",
+    "bulk_senders": "ELASTICSEARCH_BULK_SENDERS",
+    "batch_size": "ELASTICSEARCH_CHUNK_SIZE",
+    "refreshes": "SINKER_MAX_CONCURRENT_REFRESHES",
+    "buckets": "SINKER_RECONCILE_BUCKETS",
+}
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="sinker", description=__doc__)
+    parser.add_argument("--definitions-path", help="directory of the view and index definitions")
+    parser.add_argument("--log-level", help="e.g. DEBUG or INFO")
+
+    backfilling = argparse.ArgumentParser(add_help=False)
+    backfilling.add_argument("--partitions", type=int, help="page range partitions each view is backfilled in")
+    backfilling.add_argument("--bulk-threads", type=int, help="bulk request senders per backfill partition")
+    backfilling.add_argument("--backfill-batch-size", type=int, help="docs per backfill bulk request to start with")
+    syncing = argparse.ArgumentParser(add_help=False)
+    syncing.add_argument("--bulk-senders", type=int, help="bulk request senders syncing changes")
+    syncing.add_argument("--batch-size", type=int, help="docs per bulk request to start with while syncing")
+    syncing.add_argument("--refreshes", type=int, help="max number of views refreshing at the same time")
+    views = argparse.ArgumentParser(add_help=False)
+    views.add_argument("views", nargs="*", help="views to operate on, all of them by default")
+    parallel = argparse.ArgumentParser(add_help=False)
+    parallel.add_argument("--parallel", type=int, help="max number of views at a time, all of them by default")
+
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.add_parser(
+        "run", parents=[backfilling, syncing], help="set everything up as configured, then sync changes (the default)"
+    )
+    commands.add_parser(
+        "sync",
+        parents=[backfilling, syncing],
+        help="sync changes, resuming the views and indices that are set up from their current definitions",
+    )
+    commands.add_parser(
+        "setup",
+        parents=[views, parallel, backfilling],
+        help="set up the views and indices that aren't set up from their current definitions",
+    )
+    commands.add_parser(
+        "rebuild", parents=[views, parallel, backfilling], help="set up views and indices again from scratch"
+    )
+    commands.add_parser(
+        "backfill", parents=[views, parallel, backfilling], help="ship every doc of views to their current indices"
+    )
+    commands.add_parser("refresh", parents=[views], help="have the running workers refresh views")
+    commands.add_parser("status", parents=[views], help="show whether views and indices are set up and in sync")
+    reconcile = commands.add_parser(
+        "reconcile", parents=[views], help="repair just the docs that differ between views and their indices"
+    )
+    reconcile.add_argument("--dry-run", action="store_true", help="only report the docs that differ")
+    reconcile.add_argument("--buckets", type=int, help="id hash buckets whose digests are compared first")
+    args = parser.parse_args(argv)
+    args.command = args.command or "run"
+    return args
+
+
+def settings_environment(args: argparse.Namespace) -> dict[str, str]:
+    """
+    :return: The environment variables that override the settings, as given by the flags
+    """
+    environment: dict[str, str] = {
+        setting: str(getattr(args, dest))
+        for dest, setting in SETTING_FLAGS.items()
+        if getattr(args, dest, None) is not None
+    }
+    if args.command == "sync":
+        environment["SINKER_RESUME"] = "true"
+    return environment
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    args = parse_args(argv)
+    # the settings are read when they're first imported, so the flags have to be in the environment before that
+    os.environ.update(settings_environment(args))
+    from sinker import commands
+
+    getattr(commands, args.command)(args)
 
 
 if __name__ == "__main__":
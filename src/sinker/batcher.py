@@ -0,0 +1,169 @@
+"""Sizes Elasticsearch bulk requests by bytes and observed latency, and retries rejected actions with backoff."""
+
+import json
+import logging
+import random
+import threading
+from collections import Counter
+from time import monotonic, sleep
+from typing import Any, Dict, Optional
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import BulkIndexError, streaming_bulk
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Elasticsearch responds with this status when its write thread pool queue is full (es_rejected_execution_exception)
+TOO_MANY_REQUESTS = 429
+NOT_FOUND = 404
+CONFLICT = 409
+# the batch size grows by this factor while requests are well under the target latency
+GROWTH_FACTOR = 1.25
+
+
+class AdaptiveBatcher:
+    """
+    Decides how many actions go into each bulk request. A request is capped at max_chunk_bytes and at a number of
+    actions that adapts to Elasticsearch: it grows while requests take well under target_latency seconds, shrinks in
+    proportion when they take longer, and halves when Elasticsearch rejects actions with a 429. Rejected actions are
+    retried with exponential backoff and full jitter, so that concurrent senders don't retry in lockstep.
+    The batcher is shared by the senders of a pipeline, and learns from all of their requests.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int,
+        min_chunk_size: int,
+        max_chunk_size: int,
+        max_chunk_bytes: int,
+        target_latency: float,
+        max_retries: int,
+        initial_backoff: float,
+        max_backoff: float,
+        raise_on_error: bool = True,
+        raise_on_exception: bool = True,
+    ):
+        self.min_chunk_size: int = max(min_chunk_size, 1)
+        self.max_chunk_size: int = max(max_chunk_size, self.min_chunk_size)
+        self.chunk_size: int = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+        self.max_chunk_bytes: int = max_chunk_bytes
+        self.target_latency: float = target_latency
+        self.max_retries: int = max_retries
+        self.initial_backoff: float = initial_backoff
+        self.max_backoff: float = max_backoff
+        self.raise_on_error: bool = raise_on_error
+        self.raise_on_exception: bool = raise_on_exception
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def action_bytes(action: Dict[str, Any]) -> int:
+        """
+        :return: Roughly how many bytes the action adds to a bulk request, i.e. the size of its source, or of its
+        partial doc for an update
+        """
+        source = action.get("_source", action.get("doc"))
+        if source is None:
+            return 0
+        if isinstance(source, (str, bytes)):
+            return len(source)
+        return len(json.dumps(source))
+
+    def full(self, actions: int, nbytes: int) -> bool:
+        """
+        :param actions: The number of actions in the chunk so far
+        :param nbytes: The bytes of the actions in the chunk so far
+        :return: Whether the chunk should be sent now
+        """
+        return actions >= self.chunk_size or nbytes >= self.max_chunk_bytes
+
+    def record(self, actions: int, latency: float, rejected: bool) -> None:
+        """
+        Adapts the batch size to the outcome of a bulk request
+        :param actions: The number of actions in the request
+        :param latency: How long the request took in seconds
+        :param rejected: Whether Elasticsearch rejected any of the actions with a 429
+        """
+        with self._lock:
+            chunk_size: int = self.chunk_size
+            if rejected:
+                chunk_size //= 2
+            elif latency > self.target_latency:
+                chunk_size = int(chunk_size * max(0.5, self.target_latency / latency))
+            elif latency < self.target_latency / 2 and actions >= chunk_size:
+                # only grow if the requests are actually this big, rather than limited by bytes or available actions
+                chunk_size = int(chunk_size * GROWTH_FACTOR) + 1
+            chunk_size = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+            if chunk_size != self.chunk_size:
+                logger.debug(f"Bulk request of {actions} actions took {latency:.2f}s, batch size is now {chunk_size}")
+                self.chunk_size = chunk_size
+
+    def backoff(self, attempt: int) -> float:
+        """
+        :return: Seconds to wait before the given retry, drawn uniformly up to the exponential backoff (full jitter)
+        """
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * 2**attempt))
+
+    def send(self, client: Elasticsearch, chunk: list[Dict[str, Any]]) -> int:
+        """
+        Sends the chunk of actions in a bulk request, retrying the ones that get rejected
+        :return: The number of actions that succeeded
+        """
+        succeeded: int = 0
+        errors: list[Dict[str, Any]] = []
+        attempt: int = 0
+        while chunk:
+            start: float = monotonic()
+            rejected: list[Dict[str, Any]] = []
+            shipped: Counter = Counter()
+            with metrics.BULK_REQUEST_SECONDS.time():
+                results = streaming_bulk(
+                    client=client,
+                    actions=chunk,
+                    chunk_size=len(chunk),
+                    max_chunk_bytes=self.max_chunk_bytes * 2,
+                    raise_on_error=False,
+                    raise_on_exception=False,
+                    max_retries=0,
+                    yield_ok=True,
+                )
+                # results come back in the order of the actions
+                for action, (ok, info) in zip(chunk, results):
+                    if not ok:
+                        op_type, item = next(iter(info.items()))
+                        if item.get("status") == TOO_MANY_REQUESTS:
+                            rejected.append(action)
+                            continue
+                        # only conditional actions conflict, e.g. the repairs of a reconcile, when the doc changed
+                        # after it was read, in which case the newer change stands
+                        if item.get("status") == CONFLICT:
+                            continue
+                        # a doc that's already gone is as good as deleted, e.g. one whose row dropped out of its view
+                        # and whose parent row was deleted too
+                        if not (op_type == "delete" and item.get("status") == NOT_FOUND):
+                            errors.append(info)
+                            continue
+                    shipped[(action["_index"], action.get("_op_type", "index"))] += 1
+            self.record(len(chunk), monotonic() - start, bool(rejected))
+            for (index, op), count in shipped.items():
+                metrics.ACTIONS.labels(index=index, op=op).inc(count)
+            succeeded += sum(shipped.values())
+            if rejected and attempt < self.max_retries:
+                metrics.RETRIES.labels(stage="bulk").inc()
+                delay: float = self.backoff(attempt)
+                logger.warning(f"Elasticsearch rejected {len(rejected)} actions, retrying in {delay:.1f}s")
+                sleep(delay)
+                attempt += 1
+                chunk = rejected
+                continue
+            errors.extend({"index": {"status": TOO_MANY_REQUESTS, "_id": action["_id"]}} for action in rejected)
+            break
+        if errors:
+            metrics.ERRORS.labels(stage="bulk_item").inc(len(errors))
+            exception: Optional[BaseException] = next(iter(errors[0].values())).get("exception")
+            if exception is not None and self.raise_on_exception:
+                raise exception
+            if self.raise_on_error:
+                raise BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        return succeeded
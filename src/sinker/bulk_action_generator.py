@@ -1,90 +1,322 @@
 import logging
-import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from logging import Logger
-from typing import Iterable, Dict, Any, Match, Optional
-
-import psycopg
+from typing import Iterable, Dict, Any, Optional, Union
 
 import sinker.query_templates as q
-from sinker.settings import SINKER_REPLICATION_SLOT, PGCHUNK_SIZE
+from sinker import metrics
+from sinker.cache import DigestCache, DocCache, DocKey
+from sinker.decoders import Change, Decoder, get_decoder
+from sinker.pg import get_pool
+from sinker.pipeline import prefetch
+from sinker.utils import digested_doc, doc_diff, json_text, load_json
+from sinker.settings import (
+    SINKER_REPLICATION_SLOT,
+    SINKER_SCHEMA,
+    PGCHUNK_SIZE,
+    SINKER_COALESCE_WINDOW,
+    SINKER_DIGEST_CACHE_SIZE,
+    SINKER_SLOT_SLICE_CHANGES,
+    SINKER_SLOT_SLICE_BYTES,
+    SINKER_DOC_CACHE_BYTES,
+    SINKER_PARTIAL_UPDATE_MAX_RATIO,
+)
 
 logger: Logger = logging.getLogger(__name__)
 
-# Replication slot pattern
-SLOT_RE = re.compile(
-    r"""table\s\"?(?P<schema>[\w-]+)\"?.\"?(?P<table>[\w-]+)\"?:\s
-        (?P<tg_op>[A-Z]+):\sid\[text]:'(?P<id>[\w-]+)'""",
-    re.X,
-)
 GET_CURSOR_NAME = "get_changes"
+# the fewest slot entries a slice sized by bytes is cut down to
+MIN_SLICE_CHANGES = 1000
 
 
 @dataclass
 class BulkActionGenerator:
     views_to_indices: dict
+    # the indices of the views built on each parent table, for deletes from views without a replica identity
     parent_tables_to_indices: dict
+    decoder: Decoder = field(default_factory=get_decoder)
+    # end LSN of the last complete transaction that has been read from the slot but not yet confirmed
+    pending_lsn: Optional[str] = field(default=None, init=False)
+    digest_cache: DigestCache = field(default_factory=lambda: DigestCache(SINKER_DIGEST_CACHE_SIZE))
+    # digests of the docs shipped since the last confirm(), None for deleted docs
+    pending_digests: dict[DocKey, Optional[bytes]] = field(default_factory=dict, init=False)
+    doc_cache: DocCache = field(default_factory=lambda: DocCache(SINKER_DOC_CACHE_BYTES))
+    # docs shipped since the last confirm(), None for deleted docs
+    pending_docs: dict[DocKey, Optional[Union[str, bytes]]] = field(default_factory=dict, init=False)
+    # the replication slot of the shard being synced
+    slot: str = SINKER_REPLICATION_SLOT
+    # the max number of slot entries to decode in the next slice, None for no limit
+    upto_nchanges: Optional[int] = field(
+        default_factory=lambda: SINKER_SLOT_SLICE_CHANGES if SINKER_SLOT_SLICE_CHANGES > 0 else None
+    )
+    # whether the last slice stopped at its limit, so that more changes may be pending in the slot
+    more_pending: bool = field(default=False, init=False)
 
     def generate_actions(self) -> Iterable[Dict[str, Any]]:
-        with psycopg.connect() as conn:
+        """
+        Generates the actions for the next slice of the replication slot, of up to upto_nchanges entries. Call this
+        again after confirm() for as long as more_pending is set.
+        """
+        # anything pending from a drain that wasn't confirmed may not have reached Elasticsearch
+        self.pending_digests.clear()
+        self.pending_docs.clear()
+        size: list[int] = [0, 0]
+        # read the slot in a background thread so that Postgres round trips overlap with decoding
+        actions: Iterable[Dict[str, Any]] = coalesce(
+            self.actions(prefetch(self.measure(self.entries(), size), PGCHUNK_SIZE))
+        )
+        if self.digest_cache.enabled:
+            actions = self.skip_unchanged(actions)
+        if self.doc_cache.enabled:
+            actions = self.partial_updates(actions)
+        yield from actions
+        self.size_next_slice(*size)
+
+    @staticmethod
+    def measure(entries: Iterable[tuple[Any, str, Any]], size: list[int]) -> Iterable[tuple[Any, str, Any]]:
+        """
+        Passes the entries through, counting them and their bytes into size
+        """
+        for entry in entries:
+            size[0] += 1
+            size[1] += len(entry[2])
+            yield entry
+
+    def size_next_slice(self, entries: int, nbytes: int) -> None:
+        """
+        Sizes the next slice so that it holds about SINKER_SLOT_SLICE_BYTES of entries as big as the ones in the slice
+        just read, and works out whether that slice stopped at its limit. Decoding stops after the transaction in
+        which the limit is reached, so a slice never ends in the middle of a transaction.
+        :param entries: The number of entries in the slice just read
+        :param nbytes: The bytes of the entries in the slice just read
+        """
+        self.more_pending = self.upto_nchanges is not None and entries >= self.upto_nchanges
+        if self.upto_nchanges is None or not entries or SINKER_SLOT_SLICE_BYTES <= 0:
+            return
+        upto_nchanges: int = SINKER_SLOT_SLICE_BYTES * entries // max(nbytes, 1)
+        self.upto_nchanges = min(max(upto_nchanges, MIN_SLICE_CHANGES), SINKER_SLOT_SLICE_CHANGES)
+
+    def entries(self) -> Iterable[tuple[Any, str, Any]]:
+        """
+        :return: The (xid, lsn, data) entries pending in the replication slot
+        """
+        # pooled connections are in autocommit mode, and a server-side cursor needs a transaction
+        with get_pool().connection() as conn, conn.transaction():
             with conn.cursor(name=GET_CURSOR_NAME) as cursor:
                 # num of tuples to fetch over the wire at a time, not transactions. A transaction can contain
                 # many tuples.
                 cursor.itersize = PGCHUNK_SIZE
-                # gather all pending transactions on server-side cursor, which has the side effect of
-                # truncating the replication slot
-                cursor.execute(q.GET_ALL_CHANGES.format(SINKER_REPLICATION_SLOT))
-                for xid, lsn, data in cursor:
-                    logger.debug(f"Got LSN {lsn} for xid {xid} with data {data}")
-                    match: Optional[Match[str]] = SLOT_RE.search(data)
-                    if match:
-                        logger.debug(f"LSN entry {lsn} matches pattern")
-                        slot_dict: dict[str, str] = match.groupdict()
-                        slot_dict["table"] = slot_dict["table"].replace('"', "")
-                        if slot_dict["table"] in self.views_to_indices and slot_dict["tg_op"] == "INSERT":
-                            doc: str = data.split("doc[json]:")[1].replace("'", "")
-                            logger.debug(
-                                f"Putting doc {slot_dict['id']} from {slot_dict['table']}"
-                                f" into {self.views_to_indices[slot_dict['table']]}"
-                            )
-                            yield self.index_action(doc, slot_dict)
-                        elif slot_dict["table"] in self.parent_tables_to_indices and slot_dict["tg_op"] == "DELETE":
-                            logger.debug(
-                                f"Deleting doc {slot_dict['id']}"
-                                f" from {self.parent_tables_to_indices[slot_dict['table']]}"
-                            )
-                            yield self.delete_action(slot_dict)
-                        else:
-                            logger.debug(f"Ignoring LSN {lsn}")
-
-    def delete_action(self, slot_dict):
-        """
-        Generate a delete action for a particular Elasticsearch document
-        based on the replication slot entry for the parent table e.g.
+                # gather the pending transactions of the slice on server-side cursor without consuming them. The slot
+                # gets advanced in confirm() once the actions have been acknowledged by Elasticsearch.
+                cursor.execute(self.decoder.peek_query(self.slot, self.tables(), self.upto_nchanges))
+                yield from cursor
+
+    def tables(self) -> list[str]:
+        """
+        :return: The tables whose changes become actions. Parent tables are only known by name, so match any schema.
+        """
+        return [f"{SINKER_SCHEMA}.{view}" for view in self.views_to_indices] + [
+            f"*.{table}" for table in self.parent_tables_to_indices
+        ]
+
+    def actions(self, entries: Iterable[tuple[Any, str, Any]]) -> Iterable[Dict[str, Any]]:
+        """
+        Decode replication slot entries into Elasticsearch bulk actions
+        :param entries: The (xid, lsn, data) replication slot entries
+        """
+        debug: bool = logger.isEnabledFor(logging.DEBUG)
+        decoded, ignored = metrics.SLOT_ENTRIES.labels(result="decoded"), metrics.SLOT_ENTRIES.labels(result="ignored")
+        for xid, lsn, data in entries:
+            if self.decoder.is_commit(data):
+                # the LSN of a COMMIT entry is the end of the transaction's commit record, which is where
+                # decoding has to resume from to skip the transaction
+                self.pending_lsn = lsn
+                ignored.inc()
+                continue
+            change: Optional[Change] = self.decoder.decode(data)
+            if change is None:
+                ignored.inc()
+                continue
+            # A materialized view refresh only produces INSERTs with docs, whereas a view table in
+            # incremental mode gets UPDATEs too
+            if change.table in self.views_to_indices and change.op in ("INSERT", "UPDATE") and change.doc is not None:
+                if debug:
+                    logger.debug(
+                        f"Putting doc {change.id} from {change.table} into {self.views_to_indices[change.table]}"
+                    )
+                decoded.inc()
+                yield self.index_action(change)
+            elif (
+                change.table in self.views_to_indices or change.table in self.parent_tables_to_indices
+            ) and change.op == "DELETE":
+                delete_actions: list[dict[str, str]] = self.delete_actions(change)
+                if debug:
+                    logger.debug(f"Deleting doc {change.id} from {[action['_index'] for action in delete_actions]}")
+                decoded.inc()
+                yield from delete_actions
+            else:
+                ignored.inc()
+                if debug:
+                    logger.debug(f"Ignoring LSN {lsn} for xid {xid}")
+
+    def confirm(self) -> None:
+        """
+        Advance the replication slot past the transactions that generate_actions() has read. Call this only after
+        the actions have been acknowledged by Elasticsearch, so that a failure in between leaves them in the slot to
+        be read again.
+        """
+        # Elasticsearch now has these docs, so the next changes can be compared against them
+        for key, digest in self.pending_digests.items():
+            self.digest_cache.put(key, digest)
+        self.pending_digests.clear()
+        for key, doc in self.pending_docs.items():
+            self.doc_cache.put(key, doc)
+        self.pending_docs.clear()
+        if self.pending_lsn is None:
+            # there's nothing to advance past, so another slice would read the same entries
+            self.more_pending = False
+            return
+        logger.debug(f"Advancing replication slot to {self.pending_lsn}")
+        with get_pool().connection() as conn:
+            conn.execute(q.ADVANCE_SLOT.format(self.slot, self.pending_lsn))
+        self.pending_lsn = None
+
+    def forget(self, index: str) -> None:
+        """
+        Forgets the docs shipped to an index, e.g. one that was rebuilt behind this generator's back, so that the next
+        changes to them are shipped whole
+        """
+        self.digest_cache.forget(index)
+        self.doc_cache.forget(index)
+
+    def skip_unchanged(self, actions: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+        """
+        Drops index actions for docs identical to the ones last shipped, e.g. rows that a concurrent materialized view
+        refresh rewrote without changing them. The digests of the shipped docs only go into the cache once confirm()
+        is called, so docs that never made it to Elasticsearch aren't skipped next time.
+        """
+        for action in actions:
+            key: DocKey = (action["_index"], action["_id"])
+            if action.get("_op_type") == "delete":
+                self.pending_digests[key] = None
+                yield action
+                continue
+            digest: bytes = DigestCache.digest(action["_source"])
+            last_digest: Optional[bytes] = (
+                self.pending_digests[key] if key in self.pending_digests else self.digest_cache.get(key)
+            )
+            if digest == last_digest:
+                self.digest_cache.skipped += 1
+                metrics.SKIPPED_DOCS.inc()
+                continue
+            self.pending_digests[key] = digest
+            yield action
+
+    def partial_updates(self, actions: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+        """
+        Replaces index actions for docs that were shipped before with update actions of just the fields that changed,
+        e.g. a counter in a big doc. The diff is against the doc in the cache, which is what Elasticsearch has as long
+        as the actions are applied in order, which the pipeline makes sure of. Docs that aren't in the cache, had fields
+        removed, or changed so much that the update wouldn't be much smaller, are shipped whole. Coalescing comes
+        first, since the last update to a doc only has the fields that changed since the one before.
+        """
+        for action in actions:
+            key: DocKey = (action["_index"], action["_id"])
+            if action.get("_op_type") == "delete":
+                self.pending_docs[key] = None
+                yield action
+                continue
+            source: Union[str, bytes] = action["_source"]
+            last_doc: Optional[Union[str, bytes]] = (
+                self.pending_docs[key] if key in self.pending_docs else self.doc_cache.get(key)
+            )
+            self.pending_docs[key] = source
+            if last_doc is None:
+                yield action
+                continue
+            partial: Optional[dict[str, Any]] = doc_diff(load_json(last_doc), load_json(source))
+            if partial is None:
+                yield action
+                continue
+            if not partial:
+                metrics.SKIPPED_DOCS.inc()
+                continue
+            if len(json_text(partial)) > SINKER_PARTIAL_UPDATE_MAX_RATIO * len(source):
+                yield action
+                continue
+            # the bulk helpers only take the body of an update from a mapping, so the partial doc stays one
+            yield {"_op_type": "update", "_index": action["_index"], "_id": action["_id"], "doc": partial}
+
+    def delete_indices(self, change: Change) -> list[str]:
+        """
+        Materialized views have a replica identity and view tables in incremental mode a primary key, so their
+        DELETE entries carry the ID of the doc. Materialized views set up without one log no ID, and deletes come from
+        the parent table instead, which goes to the index of every view built on it.
+        """
+        if change.table in self.views_to_indices:
+            return [self.views_to_indices[change.table]]
+        return self.parent_tables_to_indices[change.table]
+
+    def delete_actions(self, change: Change) -> list[dict[str, str]]:
+        """
+        Generate the delete actions for a particular Elasticsearch document
+        based on the replication slot entry for the view or the parent table e.g.
+            table sinker.foo_mv: DELETE: id[text]:'a-1' doc[jsonb]:'{"name": "Foo"}'
             table public.foo: DELETE: id[text]:'a-1'
-        :param slot_dict: The dict representing the replication slot entry
-        :return: The delete action for use in the Elasticsearch bulk operation
+        :param change: The change decoded from the replication slot entry
+        :return: The delete actions for use in the Elasticsearch bulk operation, one per index
         """
-        delete_action: dict[str, str] = {
-            "_op_type": "delete",
-            "_index": self.parent_tables_to_indices[slot_dict["table"]],
-            "_id": slot_dict["id"],
-        }
-        return delete_action
+        return [{"_op_type": "delete", "_index": index, "_id": change.id} for index in self.delete_indices(change)]
 
-    def index_action(self, doc: str, slot_dict: dict) -> dict[str, Any]:
+    def index_action(self, change: Change) -> dict[str, Any]:
         """
         Generate an index action (insert or overwrite what's already in Elasticsearch for that ID)
         based on the replication slot entry for the materialized view e.g.
             table sinker.foo_mv: INSERT: id[text]:'a-1' doc[json]:'{"name" : "Foo Bar"}'
 
-        :param doc: The document JSON string to index in Elasticsearch
-        :param slot_dict: The dict representing the replication slot entry
+        :param change: The change decoded from the replication slot entry, with the document JSON string to index
         :return: The index action for use in the Elasticsearch bulk operation
         """
         index_action: dict[str, Any] = {
-            "_index": self.views_to_indices[slot_dict["table"]],
-            "_id": slot_dict["id"],
-            "_source": doc,
+            "_index": self.views_to_indices[change.table],
+            "_id": change.id,
+            "_source": digested_doc(change.id, change.doc) if change.doc is not None else None,
         }
         return index_action
+
+
+def coalesce(actions: Iterable[Dict[str, Any]], window: int = SINKER_COALESCE_WINDOW) -> Iterable[Dict[str, Any]]:
+    """
+    Keeps only the last action for each doc among up to window docs at a time. A hot row that is updated, or deleted
+    and re-inserted, many times between two drains of the slot then costs one bulk action instead of one per change.
+    Every action is either a full index or a delete, so the last one alone determines the doc's final state.
+
+    Deletes are held back until the end of the slice whatever the window, since REFRESH MATERIALIZED VIEW CONCURRENTLY
+    deletes every changed row before inserting it again, and shipping the delete would take the doc out of the index
+    until the insert follows. A slice never ends in the middle of a transaction, so a refresh's deletes always meet
+    their inserts. A delete and an insert in separate transactions can still land in separate slices, but then the doc
+    really was gone from the view in between.
+    :param actions: The bulk actions of a slice, in slot order
+    :param window: The max number of distinct docs whose index actions are held back at a time, 0 or 1 to pass them
+        through
+    """
+    pending: dict[tuple[str, str], Dict[str, Any]] = {}
+    deletes: dict[tuple[str, str], Dict[str, Any]] = {}
+    coalesced: int = 0
+    for action in actions:
+        key: tuple[str, str] = (action["_index"], action["_id"])
+        if pending.pop(key, None) is not None or deletes.pop(key, None) is not None:
+            coalesced += 1
+        if action.get("_op_type") == "delete":
+            deletes[key] = action
+            continue
+        # (re-)inserting the key moves it to the end, so the actions are flushed in the order of their last change
+        pending[key] = action
+        if len(pending) >= window:
+            yield from pending.values()
+            pending.clear()
+    # none of the held deletes' docs has a later action, so they can go after the rest
+    yield from pending.values()
+    yield from deletes.values()
+    if coalesced:
+        logger.debug(f"Coalesced {coalesced} redundant action(s)")
@@ -0,0 +1,121 @@
+"""
+Caches of the docs last shipped to Elasticsearch: their digests, used to skip re-shipping unchanged docs, and the docs
+themselves, used to ship only the fields that changed.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Union
+
+DIGEST_SIZE = 16
+
+# (index, doc ID)
+DocKey = tuple[str, str]
+
+
+class DigestCache:
+    """
+    A thread-safe LRU map from (index, doc ID) to the digest of the doc last shipped for it. A max_size of 0 disables
+    the cache, so nothing is ever skipped.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size: int = max_size
+        self.skipped: int = 0  # number of unchanged docs that weren't shipped
+        self._digests: OrderedDict[DocKey, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    @staticmethod
+    def digest(doc: Union[str, bytes]) -> bytes:
+        return hashlib.blake2b(doc.encode() if isinstance(doc, str) else doc, digest_size=DIGEST_SIZE).digest()
+
+    def get(self, key: DocKey) -> Optional[bytes]:
+        with self._lock:
+            digest: Optional[bytes] = self._digests.get(key)
+            if digest is not None:
+                self._digests.move_to_end(key)
+            return digest
+
+    def put(self, key: DocKey, digest: Optional[bytes]) -> None:
+        """
+        :param digest: The digest of the doc that was shipped, or None if the doc was deleted
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if digest is None:
+                self._digests.pop(key, None)
+                return
+            self._digests[key] = digest
+            self._digests.move_to_end(key)
+            while len(self._digests) > self.max_size:
+                self._digests.popitem(last=False)
+
+    def forget(self, index: str) -> None:
+        """
+        Drops the digests of the docs of an index
+        """
+        with self._lock:
+            for key in [key for key in self._digests if key[0] == index]:
+                del self._digests[key]
+
+
+class DocCache:
+    """
+    A thread-safe LRU map from (index, doc ID) to the JSON text of the doc last shipped for it, holding up to max_bytes
+    of docs. A max_bytes of 0 disables the cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+        self.nbytes: int = 0
+        self._docs: OrderedDict[DocKey, Union[str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: DocKey) -> Optional[Union[str, bytes]]:
+        with self._lock:
+            doc: Optional[Union[str, bytes]] = self._docs.get(key)
+            if doc is not None:
+                self._docs.move_to_end(key)
+            return doc
+
+    def put(self, key: DocKey, doc: Optional[Union[str, bytes]]) -> None:
+        """
+        :param doc: The doc that was shipped, or None if the doc was deleted
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            previous: Optional[Union[str, bytes]] = self._docs.pop(key, None)
+            if previous is not None:
+                self.nbytes -= len(previous)
+            if doc is None or len(doc) > self.max_bytes:
+                return
+            self._docs[key] = doc
+            self.nbytes += len(doc)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._docs.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def forget(self, index: str) -> None:
+        """
+        Drops the docs of an index
+        """
+        with self._lock:
+            for key in [key for key in self._docs if key[0] == index]:
+                self.nbytes -= len(self._docs.pop(key))
@@ -0,0 +1,151 @@
+"""The commands of the sinker CLI, which each operate on some or all of the views in views_to_indices.json"""
+
+import concurrent
+import json
+import logging
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import sinker.query_templates as q
+from .decoders import Decoder, PgOutputDecoder, get_decoder
+from .es import get_client
+from .pg import get_pool
+from .reconcile import Reconciler
+from .runner import Runner, setup_publication, setup_slot, setup_tables, slot_plugin
+from .settings import SINKER_DEFINITIONS_PATH, SINKER_SCHEMA, SINKER_SHARDS
+from .shards import Shard, load_assignments, shard_of
+from .sinker import Sinker
+
+logger = logging.getLogger(__name__)
+
+
+def load_sinkers(views: list[str]) -> list[Sinker]:
+    """
+    :param views: The views to operate on, all of them if empty
+    :return: A sinker for each view, in the shard that owns the view
+    """
+    with open(f"{SINKER_DEFINITIONS_PATH}/views_to_indices.json") as f:
+        views_to_indices: dict[str, str] = json.load(f)
+    unknown: list[str] = [view for view in views if view not in views_to_indices]
+    if unknown:
+        raise ValueError(f"Unknown view(s): {', '.join(unknown)}")
+    assignments: dict[str, int] = load_assignments(f"{SINKER_DEFINITIONS_PATH}/shards.json")
+    return [Sinker(view, views_to_indices[view], shard_of(view, assignments)) for view in views or views_to_indices]
+
+
+def adopt_slot(shard: Shard, decoder: Decoder) -> None:
+    """
+    Creates the shard's replication slot if it's missing, so that `sinker sync` resumes the views set up by the CLI
+    rather than rebuilding them for lack of a slot to resume from. Their refreshes were held off while they were set
+    up, and the changes since are in the todo tables, which a resuming worker refreshes the views for.
+    """
+    plugin: Optional[str] = slot_plugin(shard)
+    if plugin is None:
+        setup_slot(shard, decoder)
+        logger.info(f"Created the {shard.slot} replication slot")
+    elif plugin != decoder.plugin:
+        logger.warning(
+            f"The {shard.slot} replication slot was created with {plugin} rather than {decoder.plugin}, so the next "
+            "`sinker sync` rebuilds every view of the shard"
+        )
+
+
+def set_up(sinkers: list[Sinker], parallel: Optional[int]) -> None:
+    """
+    Sets up the views and indices, holding off any running worker's refreshes of each view until it's done
+    :param parallel: The max number of views set up at the same time, None for all of them
+    """
+    if not sinkers:
+        logger.info("Nothing to set up")
+        return
+    decoders: dict[Shard, Decoder] = {sinker.shard: get_decoder(sinker.shard) for sinker in sinkers}
+    for shard, decoder in decoders.items():
+        setup_tables(shard)
+        # the view tables are added to the publication as they're set up, and it has to exist before the slot does
+        if decoder.plugin == PgOutputDecoder.plugin and slot_plugin(shard) is None:
+            setup_publication(shard, resume=True)
+
+    def set_up_view(sinker: Sinker) -> str:
+        with sinker.holding_refreshes():
+            return sinker.setup()
+
+    with ThreadPoolExecutor(max_workers=parallel or len(sinkers)) as executor:
+        futures = [executor.submit(set_up_view, sinker) for sinker in sinkers]
+        for future in concurrent.futures.as_completed(futures):
+            logger.info(f"{future.result()} sinker is set up")
+    for shard, decoder in decoders.items():
+        adopt_slot(shard, decoder)
+
+
+def run(args: Namespace) -> None:
+    Runner().run()
+
+
+def setup(args: Namespace) -> None:
+    set_up([sinker for sinker in load_sinkers(args.views) if not sinker.is_current()], args.parallel)
+
+
+def rebuild(args: Namespace) -> None:
+    set_up(load_sinkers(args.views), args.parallel)
+
+
+def backfill(args: Namespace) -> None:
+    def backfill_view(sinker: Sinker) -> None:
+        with sinker.holding_refreshes():
+            sinker.backfill_index()
+
+    sinkers: list[Sinker] = load_sinkers(args.views)
+    with ThreadPoolExecutor(max_workers=args.parallel or len(sinkers)) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(backfill_view, sinker) for sinker in sinkers]):
+            future.result()
+
+
+def refresh(args: Namespace) -> None:
+    with get_pool().connection() as conn:
+        for sinker in load_sinkers(args.views):
+            conn.execute(
+                q.CREATE_TODO_ENTRY.format(SINKER_SCHEMA, sinker.shard.todo_table, f"{SINKER_SCHEMA}.{sinker.view}")
+            )
+            conn.execute(q.NOTIFY.format(sinker.shard.channel))
+            logger.info(f"Scheduled a refresh of {sinker.view}")
+
+
+def status(args: Namespace) -> None:
+    es = get_client()
+    rows: list[tuple[str, ...]] = [("view", "index", "shard", "current", "view rows", "index docs")]
+    for sinker in load_sinkers(args.views):
+        with get_pool().connection() as conn:
+            relkind_tuple = conn.execute(q.GET_RELKIND.format(f"{SINKER_SCHEMA}.{sinker.view}")).fetchone()
+            count_tuple = (
+                conn.execute(q.COUNT_ROWS.format(SINKER_SCHEMA, sinker.view)).fetchone()
+                if relkind_tuple and relkind_tuple[0] is not None
+                else None
+            )
+        docs: Optional[int] = (
+            es.count(index=sinker.index)["count"] if es.indices.exists_alias(name=sinker.index) else None
+        )
+        rows.append(
+            (
+                sinker.view,
+                sinker.index,
+                str(sinker.shard.number),
+                "yes" if sinker.is_current() else "no",
+                str(count_tuple[0]) if count_tuple else "-",
+                str(docs) if docs is not None else "-",
+            )
+        )
+    widths: list[int] = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+    with get_pool().connection() as conn:
+        for number in range(max(SINKER_SHARDS, 1)):
+            shard = Shard(number, SINKER_SHARDS)
+            lag_tuple = conn.execute(q.GET_SLOT_LAG.format(shard.slot)).fetchone()
+            lag: str = f"{lag_tuple[0]} bytes behind" if lag_tuple and lag_tuple[0] is not None else "missing"
+            print(f"replication slot {shard.slot}: {lag}")
+
+
+def reconcile(args: Namespace) -> None:
+    for sinker in load_sinkers(args.views):
+        Reconciler(sinker.view, sinker.index).reconcile(repair=not args.dry_run)
@@ -0,0 +1,285 @@
+"""Decoders for the output of the logical decoding plugins that the replication slot can be created with."""
+
+import json
+import struct
+from dataclasses import dataclass
+from typing import Iterable, Optional, Union
+
+from .settings import SINKER_OUTPUT_PLUGIN, SINKER_PUBLICATION, SINKER_INCREMENTAL
+from .shards import Shard
+
+SlotData = Union[str, bytes]
+
+
+@dataclass(frozen=True)
+class Change:
+    """A row change decoded from the replication slot"""
+
+    schema: str
+    table: str
+    op: str  # INSERT, UPDATE or DELETE
+    id: str
+    doc: Optional[str] = None  # the doc column of a view, as JSON text
+
+
+class Decoder:
+    plugin: str = ""
+
+    def peek_query(self, slot: str, tables: Iterable[str] = (), upto_nchanges: Optional[int] = None) -> str:
+        """
+        :param slot: The replication slot name
+        :param tables: The schema-qualified tables whose changes are of interest, where * matches any schema. Plugins
+        that support it only decode changes to these tables, so changes to the rest never leave the server.
+        :param upto_nchanges: Stop decoding after the transaction in which the slot entries produced reach this many,
+        or None to decode all pending changes
+        :return: The query that peeks at the slot's pending changes as (xid, lsn, data) tuples
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def _upto(upto_nchanges: Optional[int]) -> str:
+        return "NULL" if upto_nchanges is None else str(int(upto_nchanges))
+
+    def is_commit(self, data: SlotData) -> bool:
+        raise NotImplementedError
+
+    def decode(self, data: SlotData) -> Optional[Change]:
+        """
+        :param data: The data of one replication slot entry
+        :return: The row change, or None if the entry isn't a row change with an ID
+        """
+        raise NotImplementedError
+
+
+class TestDecodingDecoder(Decoder):
+    """
+    Parses the text output of the test_decoding plugin e.g.
+        table sinker.foo_mv: INSERT: id[text]:'a-1' doc[json]:'{"name" : "Foo Bar"}'
+    """
+
+    __test__ = False  # not a pytest test class
+    plugin = "test_decoding"
+
+    def peek_query(self, slot: str, tables: Iterable[str] = (), upto_nchanges: Optional[int] = None) -> str:
+        # test_decoding has no option to filter tables
+        return f"SELECT xid, lsn, data FROM pg_logical_slot_peek_changes('{slot}', NULL, {self._upto(upto_nchanges)})"
+
+    def is_commit(self, data: SlotData) -> bool:
+        return isinstance(data, str) and data.startswith("COMMIT")
+
+    def decode(self, data: SlotData) -> Optional[Change]:
+        if not isinstance(data, str) or not data.startswith("table "):
+            return None
+        schema_table, _, rest = data[6:].partition(": ")
+        op, _, columns = rest.partition(": ")
+        values: dict[str, Optional[str]] = self._columns(columns)
+        doc_id: Optional[str] = values.get("id")
+        if doc_id is None:
+            return None
+        schema, _, table = schema_table.partition(".")
+        return Change(schema.replace('"', ""), table.replace('"', ""), op, doc_id, values.get("doc"))
+
+    def _columns(self, columns: str) -> dict[str, Optional[str]]:
+        """
+        Reads the name[type]:value columns of a change. UPDATEs of tables with REPLICA IDENTITY FULL or a changed key
+        list the old tuple or key before the new tuple, in which case only the new tuple's values are returned.
+        """
+        values: dict[str, Optional[str]] = {}
+        if columns == "(no-tuple-data)":
+            return values
+        pos: int = 0
+        while pos < len(columns):
+            if columns.startswith("new-tuple: ", pos):
+                values = {}
+                pos += len("new-tuple: ")
+                continue
+            for prefix in ("old-key: ", "old-tuple: "):
+                if columns.startswith(prefix, pos):
+                    pos += len(prefix)
+            type_start: int = columns.index("[", pos)
+            name: str = columns[pos:type_start].replace('"', "")
+            values[name], pos = self._value(columns, columns.index("]:", type_start) + 2)
+        return values
+
+    @staticmethod
+    def _value(columns: str, start: int) -> tuple[Optional[str], int]:
+        """
+        Reads the column value starting at columns[start]. Text values are quoted, with any quotes inside them doubled.
+        :return: The value and the position of the next column
+        """
+        if not columns.startswith("'", start):
+            end: int = columns.find(" ", start)
+            end = len(columns) if end < 0 else end
+            value: str = columns[start:end]
+            return (None if value == "null" else value), end + 1
+        end = start + 1
+        while True:
+            end = columns.index("'", end)
+            if not columns.startswith("''", end):
+                break
+            end += 2
+        value = columns[start + 1 : end]
+        if "''" in value:
+            value = value.replace("''", "'")
+        return value, end + 2
+
+
+class Wal2JsonDecoder(Decoder):
+    """
+    Parses the JSON output of the wal2json plugin in format version 2, which emits one JSON object per change e.g.
+        {"action":"I","schema":"sinker","table":"foo_mv","columns":[{"name":"id","value":"a-1"},...]}
+    """
+
+    plugin = "wal2json"
+
+    def peek_query(self, slot: str, tables: Iterable[str] = (), upto_nchanges: Optional[int] = None) -> str:
+        add_tables: str = ",".join(self._escape(table) for table in tables)
+        return (
+            f"SELECT xid, lsn, data FROM pg_logical_slot_peek_changes('{slot}', NULL, {self._upto(upto_nchanges)}, "
+            f"'format-version', '2', 'include-types', 'false'"
+            + (f", 'add-tables', '{add_tables}'" if add_tables else "")
+            + ")"
+        )
+
+    @staticmethod
+    def _escape(table: str) -> str:
+        """
+        Escapes the characters that wal2json's add-tables option gives a special meaning in names, other than the
+        dot between the schema and the table and a * schema, then quotes the result for the SQL string literal
+        """
+        schema, _, name = table.partition(".")
+        parts: list[str] = []
+        for part in (schema, name):
+            if part != "*":
+                for char in "\\ ,.*'":
+                    part = part.replace(char, f"\\{char}")
+            parts.append(part)
+        return ".".join(parts).replace("'", "''")
+
+    def is_commit(self, data: SlotData) -> bool:
+        return isinstance(data, str) and data.startswith('{"action":"C"')
+
+    def decode(self, data: SlotData) -> Optional[Change]:
+        message: dict = json.loads(data)
+        op: Optional[str] = {"I": "INSERT", "U": "UPDATE", "D": "DELETE"}.get(message["action"])
+        if op is None:
+            return None
+        # DELETEs only carry the replica identity columns
+        columns: dict = {
+            column["name"]: column["value"] for column in message.get("columns") or message.get("identity") or []
+        }
+        if columns.get("id") is None:
+            return None
+        doc = columns.get("doc")
+        if doc is not None and not isinstance(doc, str):
+            doc = json.dumps(doc)
+        return Change(message["schema"], message["table"], op, str(columns["id"]), doc)
+
+
+class PgOutputDecoder(Decoder):
+    """
+    Parses the binary logical replication protocol messages of the pgoutput plugin. Relation messages describing
+    each table's columns precede the first change to that table, so the decoder keeps track of them.
+    """
+
+    plugin = "pgoutput"
+
+    def __init__(self, publication: str = SINKER_PUBLICATION):
+        self.publication: str = publication
+        # relation OID -> (schema, table, column names)
+        self.relations: dict[int, tuple[str, str, list[str]]] = {}
+
+    def peek_query(self, slot: str, tables: Iterable[str] = (), upto_nchanges: Optional[int] = None) -> str:
+        # the publication determines the tables
+        return (
+            f"SELECT xid, lsn, data FROM pg_logical_slot_peek_binary_changes('{slot}', NULL, "
+            f"{self._upto(upto_nchanges)}, "
+            f"'proto_version', '1', 'publication_names', '{self.publication}')"
+        )
+
+    def is_commit(self, data: SlotData) -> bool:
+        return data[:1] == b"C"
+
+    def decode(self, data: SlotData) -> Optional[Change]:
+        assert isinstance(data, bytes)
+        kind: bytes = data[:1]
+        if kind == b"R":
+            self._relation(data)
+            return None
+        if kind not in (b"I", b"U", b"D"):
+            return None
+        (relation_id,) = struct.unpack_from("!I", data, 1)
+        schema, table, column_names = self.relations[relation_id]
+        # each tuple is preceded by a byte saying whether it's the new tuple (N), an old key (K) or an old tuple (O)
+        offset: int = 5
+        if kind == b"U" and data[offset : offset + 1] in (b"K", b"O"):
+            # skip the old key or tuple, the new tuple follows it
+            _, offset = self._tuple(data, offset + 1)
+        values, _ = self._tuple(data, offset + 1)
+        columns: dict[str, Optional[str]] = dict(zip(column_names, values))
+        doc_id = columns.get("id")
+        if doc_id is None:
+            return None
+        op: str = {b"I": "INSERT", b"U": "UPDATE", b"D": "DELETE"}[kind]
+        return Change(schema, table, op, doc_id, columns.get("doc"))
+
+    def _relation(self, data: bytes) -> None:
+        (relation_id,) = struct.unpack_from("!I", data, 1)
+        schema, offset = self._string(data, 5)
+        table, offset = self._string(data, offset)
+        # skip the replica identity setting
+        (column_count,) = struct.unpack_from("!H", data, offset + 1)
+        offset += 3
+        column_names: list[str] = []
+        for _ in range(column_count):
+            # skip the flags before and the type OID and modifier after the name
+            name, offset = self._string(data, offset + 1)
+            column_names.append(name)
+            offset += 8
+        self.relations[relation_id] = (schema, table, column_names)
+
+    @staticmethod
+    def _string(data: bytes, offset: int) -> tuple[str, int]:
+        end = data.index(b"\0", offset)
+        return data[offset:end].decode(), end + 1
+
+    @staticmethod
+    def _tuple(data: bytes, offset: int) -> tuple[list[Optional[str]], int]:
+        """
+        Reads TupleData, where each column is null (n), an unchanged TOASTed value (u) or text (t).
+        :return: The column values and the offset after the tuple
+        """
+        (column_count,) = struct.unpack_from("!H", data, offset)
+        offset += 2
+        values: list[Optional[str]] = []
+        for _ in range(column_count):
+            kind = data[offset : offset + 1]
+            offset += 1
+            if kind == b"t":
+                (length,) = struct.unpack_from("!I", data, offset)
+                offset += 4
+                values.append(data[offset : offset + length].decode())
+                offset += length
+            else:
+                values.append(None)
+        return values, offset
+
+
+DECODERS: dict[str, type[Decoder]] = {
+    decoder.plugin: decoder for decoder in (TestDecodingDecoder, Wal2JsonDecoder, PgOutputDecoder)
+}
+
+
+def get_decoder(shard: Shard = Shard()) -> Decoder:
+    """
+    :param shard: The shard whose replication slot gets decoded
+    :return: A decoder for the output plugin configured in SINKER_OUTPUT_PLUGIN
+    """
+    if SINKER_OUTPUT_PLUGIN not in DECODERS:
+        raise ValueError(f"Unsupported output plugin {SINKER_OUTPUT_PLUGIN}, expected one of {', '.join(DECODERS)}")
+    if SINKER_OUTPUT_PLUGIN == PgOutputDecoder.plugin and not SINKER_INCREMENTAL:
+        # publications can only contain tables
+        raise ValueError("The pgoutput plugin can't decode changes to materialized views, set SINKER_INCREMENTAL")
+    if SINKER_OUTPUT_PLUGIN == PgOutputDecoder.plugin:
+        return PgOutputDecoder(shard.publication)
+    return DECODERS[SINKER_OUTPUT_PLUGIN]()
@@ -1,5 +1,12 @@
+from functools import cache
+
 from elasticsearch import Elasticsearch
 
+try:
+    from elasticsearch.serializer import OrjsonSerializer
+except ImportError:
+    OrjsonSerializer = None  # type: ignore[assignment,misc]
+
 from .settings import (
     ELASTICSEARCH_VERIFY_CERTS,
     ELASTICSEARCH_SCHEME,
@@ -9,10 +16,15 @@ from .settings import (
     ELASTICSEARCH_PORT,
     ELASTICSEARCH_SSL_SHOW_WARN,
     ELASTICSEARCH_TIMEOUT,
+    ELASTICSEARCH_CONNECTIONS_PER_NODE,
 )
 
 
+@cache
 def get_client() -> Elasticsearch:
+    """
+    :return: The process-wide Elasticsearch client. It is thread-safe, so all threads share its HTTP connection pool.
+    """
     es_url = (
         f"{ELASTICSEARCH_SCHEME}://{ELASTICSEARCH_USER}:{ELASTICSEARCH_PASSWORD}"
         f"@{ELASTICSEARCH_HOST}:{ELASTICSEARCH_PORT}"
@@ -22,4 +34,7 @@ def get_client() -> Elasticsearch:
         verify_certs=ELASTICSEARCH_VERIFY_CERTS,
         ssl_show_warn=ELASTICSEARCH_SSL_SHOW_WARN,
         request_timeout=ELASTICSEARCH_TIMEOUT,
+        connections_per_node=ELASTICSEARCH_CONNECTIONS_PER_NODE,
+        # docs are mostly passed through as JSON text, but anything that does need serializing is faster with orjson
+        serializer=OrjsonSerializer() if OrjsonSerializer is not None else None,
     )
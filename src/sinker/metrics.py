@@ -0,0 +1,87 @@
+"""
+Prometheus metrics for each stage of the pipeline, served over HTTP on SINKER_METRICS_PORT. They need the optional
+prometheus-client package (pip install sinker[metrics]). Without it, the metrics are no-ops.
+"""
+
+import logging
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+from .settings import SINKER_METRICS_PORT
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+# refreshes and slot drains take anywhere from milliseconds to many minutes
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+class _NoopMetric:
+    """Stands in for any metric when prometheus-client isn't installed"""
+
+    def labels(self, *args: Any, **kwargs: Any) -> "_NoopMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, amount: float) -> None:
+        pass
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        yield
+
+
+def _metric(kind: str, name: str, documentation: str, labelnames: tuple[str, ...] = (), **kwargs: Any) -> Any:
+    if prometheus_client is None:
+        return _NoopMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, namespace="sinker", **kwargs)
+
+
+REFRESH_SECONDS = _metric(
+    "Histogram", "refresh_seconds", "Duration of view refreshes", ("view",), buckets=DURATION_BUCKETS
+)
+SLOT_DRAIN_SECONDS = _metric(
+    "Histogram",
+    "slot_drain_seconds",
+    "Duration of reading and shipping a slice of the replication slot",
+    buckets=DURATION_BUCKETS,
+)
+BULK_REQUEST_SECONDS = _metric("Histogram", "bulk_request_seconds", "Latency of Elasticsearch bulk requests")
+ACTIONS = _metric("Counter", "actions", "Bulk actions shipped to Elasticsearch", ("index", "op"))
+SLOT_ENTRIES = _metric(
+    "Counter", "slot_entries", "Replication slot entries read, by whether they became actions", ("result",)
+)
+SKIPPED_DOCS = _metric("Counter", "skipped_docs", "Docs not shipped because they were unchanged")
+RETRIES = _metric("Counter", "retries", "Retried requests", ("stage",))
+ERRORS = _metric("Counter", "errors", "Failed operations", ("stage",))
+SLOT_LAG_BYTES = _metric("Gauge", "slot_lag_bytes", "Bytes of WAL the replication slot has yet to confirm")
+TODO_DEPTH = _metric("Gauge", "todo_depth", "Pending entries in the todo tables", ("table",))
+SPOOL_BYTES = _metric("Gauge", "spool_bytes", "Bytes of spooled actions waiting to be shipped")
+
+
+def enabled() -> bool:
+    """
+    :return: Whether metrics are being served, i.e. whether it's worth querying Postgres for the gauges
+    """
+    return bool(SINKER_METRICS_PORT) and prometheus_client is not None
+
+
+def start_server() -> None:
+    """
+    Serves the metrics on SINKER_METRICS_PORT, if it is set
+    """
+    if not SINKER_METRICS_PORT:
+        return
+    if prometheus_client is None:
+        raise ImportError("SINKER_METRICS_PORT is set but prometheus-client isn't installed, install sinker[metrics]")
+    prometheus_client.start_http_server(SINKER_METRICS_PORT)
+    logger.info(f"Serving metrics on port {SINKER_METRICS_PORT}")
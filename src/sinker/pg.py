@@ -0,0 +1,35 @@
+from functools import cache
+
+from psycopg.abc import Buffer
+from psycopg.adapt import Loader
+from psycopg_pool import ConnectionPool
+
+from .settings import PGPOOL_MIN_SIZE, PGPOOL_MAX_SIZE, PGPOOL_TIMEOUT
+
+
+@cache
+def get_pool() -> ConnectionPool:
+    """
+    :return: The process-wide pool of autocommit Postgres connections. Statements that need a transaction, like
+    server-side cursors, run in an explicit conn.transaction() block.
+    """
+    return ConnectionPool(
+        # an empty conninfo lets libpq pick up the PG* environment variables, like psycopg.connect() does
+        conninfo="",
+        min_size=PGPOOL_MIN_SIZE,
+        max_size=PGPOOL_MAX_SIZE,
+        timeout=PGPOOL_TIMEOUT,
+        kwargs={"autocommit": True},
+        name="sinker",
+        open=True,
+    )
+
+
+class RawTextLoader(Loader):
+    """
+    Loads text columns as the raw UTF-8 bytes sent by Postgres, skipping decoding them into str. Register it on a
+    cursor that fetches docs as text, to pass them on to Elasticsearch without ever decoding or parsing them.
+    """
+
+    def load(self, data: Buffer) -> bytes:
+        return bytes(data)
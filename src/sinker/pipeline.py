@@ -0,0 +1,168 @@
+"""Bounded-queue pipeline that overlaps reading from Postgres, building actions and shipping them to Elasticsearch."""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from typing import Any, Dict, Iterable, Iterator, Optional, TypeVar
+
+from elasticsearch import Elasticsearch
+
+from . import metrics
+from .batcher import AdaptiveBatcher
+from .settings import (
+    ELASTICSEARCH_BULK_SENDERS,
+    ELASTICSEARCH_SYNC_BATCHING,
+    SINKER_PIPELINE_QUEUE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# seconds to wait on a full or empty queue before checking whether the other side has given up
+QUEUE_TIMEOUT = 0.1
+
+
+class _Done:
+    """Marks the end of a queue's items, along with the exception that ended them early, if any"""
+
+    def __init__(self, error: Optional[BaseException] = None):
+        self.error = error
+
+
+def _put(queue: Queue, item: Any, stop: threading.Event) -> bool:
+    """
+    Blocks until the item is put on the queue or the stop event is set
+    :return: Whether the item was put on the queue
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=QUEUE_TIMEOUT)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def prefetch(items: Iterable[T], batch_size: int, queue_size: int = SINKER_PIPELINE_QUEUE_SIZE) -> Iterator[T]:
+    """
+    Iterates over the items in a background thread, up to queue_size batches ahead of the consumer, so that reading
+    them (e.g. from a Postgres cursor) overlaps with processing them. Exceptions are re-raised to the consumer.
+    :param items: The items to read ahead
+    :param batch_size: The number of items handed over at a time, to keep the queue overhead per item low
+    :param queue_size: The maximum number of batches read ahead
+    """
+    queue: Queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def produce() -> None:
+        batch: list[T] = []
+        try:
+            for item in items:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    if not _put(queue, batch, stop):
+                        return
+                    batch = []
+            if batch:
+                _put(queue, batch, stop)
+        except BaseException as e:
+            _put(queue, _Done(e), stop)
+        else:
+            _put(queue, _Done(), stop)
+        finally:
+            # releases e.g. the cursor of a generator that the consumer stopped iterating early
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch_or_done = queue.get()
+            if isinstance(batch_or_done, _Done):
+                if batch_or_done.error is not None:
+                    raise batch_or_done.error
+                return
+            yield from batch_or_done
+    finally:
+        # lets the thread finish if the consumer stops early
+        stop.set()
+        thread.join()
+
+
+class Pipeline:
+    """
+    Ships Elasticsearch actions with a number of concurrent bulk senders, each fed chunks of actions through its own
+    bounded queue. The queues provide backpressure, so the producer of the actions (reading and decoding the
+    replication slot) runs ahead of the senders by at most SINKER_PIPELINE_QUEUE_SIZE chunks per sender.
+    All actions for a given document go to the same sender, so they are applied in order. The batcher decides when a
+    chunk is big enough to send, and keeps adapting to Elasticsearch for as long as the pipeline is reused.
+    """
+
+    def __init__(
+        self,
+        client: Elasticsearch,
+        senders: int = ELASTICSEARCH_BULK_SENDERS,
+        batcher: Optional[AdaptiveBatcher] = None,
+        queue_size: int = SINKER_PIPELINE_QUEUE_SIZE,
+    ):
+        self.client = client
+        self.senders: int = max(senders, 1)
+        self.batcher: AdaptiveBatcher = batcher or AdaptiveBatcher(**ELASTICSEARCH_SYNC_BATCHING)
+        self.queue_size: int = queue_size
+
+    def ship(self, actions: Iterable[Dict[str, Any]]) -> int:
+        """
+        Sends the actions to Elasticsearch and waits until they have all been acknowledged
+        :param actions: The bulk actions, consumed in the calling thread
+        :return: The number of actions that succeeded
+        """
+        queues: list[Queue] = [Queue(maxsize=self.queue_size) for _ in range(self.senders)]
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="bulk") as executor:
+            futures: list[Future] = [executor.submit(self._send, queue, stop) for queue in queues]
+            try:
+                chunks: list[list[Dict[str, Any]]] = [[] for _ in range(self.senders)]
+                chunk_bytes: list[int] = [0] * self.senders
+                for action in actions:
+                    sender: int = hash((action["_index"], action["_id"])) % self.senders
+                    chunk = chunks[sender]
+                    chunk.append(action)
+                    chunk_bytes[sender] += self.batcher.action_bytes(action)
+                    if self.batcher.full(len(chunk), chunk_bytes[sender]):
+                        if not _put(queues[sender], chunk, stop):
+                            break
+                        chunks[sender] = []
+                        chunk_bytes[sender] = 0
+                for sender, chunk in enumerate(chunks):
+                    if chunk:
+                        _put(queues[sender], chunk, stop)
+            except BaseException:
+                stop.set()
+                raise
+            finally:
+                for queue in queues:
+                    _put(queue, _Done(), stop)
+            # re-raises the first sender exception, if any
+            return sum(future.result() for future in futures)
+
+    def _send(self, queue: Queue, stop: threading.Event) -> int:
+        succeeded: int = 0
+        try:
+            while not stop.is_set():
+                try:
+                    chunk = queue.get(timeout=QUEUE_TIMEOUT)
+                except Empty:
+                    continue
+                if isinstance(chunk, _Done):
+                    break
+                succeeded += self.batcher.send(self.client, chunk)
+        except BaseException:
+            metrics.ERRORS.labels(stage="bulk").inc()
+            # stops the producer and the other senders
+            stop.set()
+            raise
+        return succeeded
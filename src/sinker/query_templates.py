@@ -1,34 +1,164 @@
 CHECK_SLOT = "SELECT count(*) FROM PG_REPLICATION_SLOTS where slot_name='{}'"
+GET_SLOT_PLUGIN = "SELECT plugin FROM PG_REPLICATION_SLOTS where slot_name='{}'"
 DROP_SLOT = "select pg_drop_replication_slot('{}')"
-CREATE_SLOT = "select pg_create_logical_replication_slot('{}', 'test_decoding')"
+CREATE_SLOT = "select pg_create_logical_replication_slot('{}', '{}')"
+GET_PUBLICATION = "select puballtables from pg_publication where pubname = '{}'"
+# Workers hold this lock on a shard for as long as they run it (on their notification connection)
+TRY_LOCK_SHARD = "select pg_try_advisory_lock(hashtext('{}'))"
+CREATE_PUBLICATION = "create publication {}"
+DROP_PUBLICATION = "drop publication if exists {}"
+ADD_PUBLICATION_TABLE = "alter publication {} add table {}"
 
 DROP_TODO_TABLE = "drop table if exists {}.{}"
-CREATE_TODO_TABLE = """create table {}.{} (
+CREATE_TODO_TABLE = """create table if not exists {}.{} (
         mv text primary key not null,
         created timestamp not null default now())"""
+CREATE_TODO_KEYS_TABLE = """create table if not exists {}.{} (
+        mv text not null,
+        id text not null,
+        created timestamp not null default now(),
+        primary key (mv, id))"""
+
+# Hashes of the definitions each view and index were last set up from, for resuming on restart
+CREATE_DEFINITIONS_TABLE = """create table if not exists {}.{} (
+        view text primary key not null,
+        hash text not null,
+        updated timestamp not null default now())"""
+GET_DEFINITION_HASH = "select hash from {}.{} where view = %(view)s"
+SAVE_DEFINITION_HASH = """insert into {}.{} (view, hash) values (%(view)s, %(hash)s)
+on conflict (view) do update set hash = excluded.hash, updated = now()"""
 
 DROP_VIEW = "drop materialized view if exists {}"
 CREATE_VIEW = "create materialized view {} (id, doc) as {}"
 CREATE_VIEW_INDEX = "create unique index {}_id on {} (id)"
+# Logs the old row of each row that a refresh deletes, so that its DELETE entry in the replication slot carries the ID
+# of the doc. Using the unique index as the replica identity would need the id column to be not null, which the
+# columns of a materialized view can't be declared.
+SET_VIEW_REPLICA_IDENTITY = "alter materialized view {} replica identity full"
 REFRESH_VIEW = "refresh materialized view concurrently {}.{}"
+# Refreshes of a view wait for the sinker CLI while it rebuilds or backfills the view's index, so that no change to the
+# view lands in an index that is about to be replaced, or gets overwritten by an older doc from the backfill
+LOCK_VIEW_REFRESHES = "select pg_advisory_lock(hashtext('sinker_view:{}'))"
+WAIT_FOR_VIEW_REFRESHES = "select pg_advisory_xact_lock_shared(hashtext('sinker_view:{}'))"
+NOTIFY = "select pg_notify('{}', '')"
+
+# Incremental mode: the view is a regular table keyed by id and recomputed row by row
+GET_RELKIND = "select relkind from pg_class where oid = to_regclass('{}')"
+DROP_TABLE = "drop table if exists {}"
+CREATE_VIEW_TABLE = "create table {} (id, doc) as {}"
+CREATE_VIEW_TABLE_KEY = "alter table {} add primary key (id)"
+# no rows if the view doesn't exist (yet)
+GET_ID_TYPE = (
+    "select format_type(atttypid, atttypmod) from pg_attribute where attrelid = to_regclass('{}') and attname = 'id'"
+)
+# Recompute the rows of the view table selected by the filter: upsert the docs that changed and delete the rows that
+# dropped out of the view query. Unchanged docs are left alone so they don't show up in the replication slot.
+REFRESH_ROWS = """with src as (
+    select id, doc from ({query}) as src (id, doc) {filter}
+), deleted as (
+    delete from {view} as dst where {filter_dst} not exists (select from src where src.id = dst.id)
+)
+insert into {view} as dst (id, doc) select id, doc from src
+on conflict (id) do update set doc = excluded.doc
+where dst.doc::text is distinct from excluded.doc::text"""
+ROWS_FILTER = "where id = any(%(ids)s::{}[])"
+ROWS_FILTER_DST = "dst.id = any(%(ids)s::{}[]) and"
 
+# The triggers fire once per statement rather than once per row, so a statement that changes a million rows costs the
+# same as one that changes a single row. Only the triggers whose functions need the IDs of the changed rows get them in
+# the new_rows and old_rows transition tables, since Postgres keeps a copy of every changed row for those. Postgres only
+# allows transition tables on triggers for a single event, hence a trigger per event.
+# The trigger functions also wake up the runner, which LISTENs on the channel. Postgres only delivers notifications on
+# commit, and folds identical ones from the same transaction into one.
 CREATE_FUNCTION = """create or replace function {} ()
 RETURNS TRIGGER AS $$
 BEGIN
     insert into {}.{} (mv) values ('{}') on conflict do nothing;
-    RETURN NEW;
+    perform pg_notify('{channel}', '');
+    RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 """
 
-CREATE_TRIGGER = """create or replace trigger {}
-after insert or update or delete on {}."{}"
-for each row
-execute procedure {}();
+# Records the parent IDs of the changed rows, as selected by the key query from the "changed" relation, so that only
+# those rows of the view get recomputed. A TRUNCATE has no transition tables, so it uses CREATE_FUNCTION instead.
+CREATE_KEYS_FUNCTION = """create or replace function {function} ()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        {insert_keys_new}
+    ELSIF TG_OP = 'UPDATE' THEN
+        {insert_keys_both}
+    ELSE
+        {insert_keys_old}
+    END IF;
+    IF FOUND THEN
+        perform pg_notify('{channel}', '');
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+INSERT_KEYS = """insert into {keys_table} (mv, id)
+        select '{view}', changed_keys.id::text from (
+            with changed as ({changed})
+            {key_query}
+        ) as changed_keys (id)
+        where changed_keys.id is not null
+        on conflict do nothing;"""
+CHANGED_NEW = "select * from new_rows"
+CHANGED_BOTH = "select * from new_rows union all select * from old_rows"
+CHANGED_OLD = "select * from old_rows"
+DEFAULT_KEY_QUERY = "select id from changed"
+LISTEN = "listen {}"
+
+CREATE_TRIGGER = """create or replace trigger {name}
+after {event} on {schema}."{table}"
+{referencing}
+for each statement
+execute procedure {function}();
 """
+# the transition tables of the trigger for each event, for the functions that read the changed rows
+TRIGGER_EVENTS = {
+    "insert": "referencing new table as new_rows",
+    "update": "referencing new table as new_rows old table as old_rows",
+    "delete": "referencing old table as old_rows",
+    "truncate": "",
+}
+# the row-level trigger that earlier versions installed under the name without an event suffix
+DROP_ROW_TRIGGER = 'drop trigger if exists {} on {}."{}"'
+
+CREATE_TODO_ENTRY = "insert into {}.{} (mv) values ('{}') on conflict do nothing"
+# also returns how many seconds ago each entry was created
+POP_TODO_ENTRIES = "delete from {}.{} returning mv, extract(epoch from now() - created)::float8"
+POP_TODO_KEYS = "delete from {}.{} returning mv, id, extract(epoch from now() - created)::float8"
+# the docs are fetched as text so they can be passed to Elasticsearch verbatim, rather than parsed and re-serialized
+BACKFILL_QUERY = "SELECT id, doc::text FROM {}"
+# A partition is a range of the view's pages, which Postgres (14+) reads with a TID range scan, so the partitions each
+# read just their own part of the view. The last partition has no end, in case the view grows while it's backfilled.
+GET_BLOCK_COUNT = "select pg_relation_size('{}') / current_setting('block_size')::int"
+BACKFILL_PARTITION_QUERY = "SELECT id, doc::text FROM {} WHERE ctid >= '({},0)'::tid"
+BACKFILL_PARTITION_END = " AND ctid < '({},0)'::tid"
 
-CREATE_TODO_ENTRY = "insert into {}.{} (mv) values ('{}')"
-POP_TODO_ENTRIES = "delete from {}.{} returning mv"
-BACKFILL_QUERY = "SELECT id, doc FROM {}"
+# Reconciling: a doc's ID hash and digest are the first 32 bits of the MD5 of its ID and of its text, the same as the
+# ones stored in the docs in Elasticsearch (see utils.digested_doc). A bucket is a range of ID hashes, the hash shifted
+# right by some number of bits, so that shifting by fewer bits splits it into sub-buckets. The buckets within the parent
+# buckets are summarized by their number of docs and the sum of their digests.
+# Rows with a NULL doc are never indexed (see Sinker.backfill_stream), so they are left out here too.
+RECONCILE_SUMMARY_QUERY = """select ('x' || substr(md5(id::text), 1, 8))::bit(32)::bigint >> {shift}, count(*),
+sum(('x' || substr(md5(doc::text), 1, 8))::bit(32)::bigint)::bigint
+from {view}
+where ('x' || substr(md5(id::text), 1, 8))::bit(32)::bigint >> {parent_shift} = any(%(parents)s) and doc is not null
+group by 1"""
+RECONCILE_DIGESTS_QUERY = """select id::text, ('x' || substr(md5(doc::text), 1, 8))::bit(32)::bigint
+from {view}
+where ('x' || substr(md5(id::text), 1, 8))::bit(32)::bigint >> {shift} = any(%(buckets)s) and doc is not null"""
+RECONCILE_IDS_QUERY = "select id::text, doc::text from {} where id = any(%(ids)s::{}[]) and doc is not null"
 
-GET_ALL_CHANGES = "SELECT xid, lsn, data FROM pg_logical_slot_get_changes('{}', NULL, NULL)"
+# Changes are peeked rather than consumed (see the decoders for the queries), and the slot is only advanced past them
+# once Elasticsearch has acknowledged them, so a crash in between doesn't lose anything.
+ADVANCE_SLOT = "select pg_replication_slot_advance('{}', '{}'::pg_lsn)"
+GET_SLOT_LAG = (
+    "select pg_wal_lsn_diff(pg_current_wal_lsn(), confirmed_flush_lsn) from pg_replication_slots where slot_name = '{}'"
+)
+COUNT_ROWS = "select count(*) from {}.{}"
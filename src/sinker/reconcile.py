@@ -0,0 +1,295 @@
+"""
+Checks that an Elasticsearch index matches its view, and repairs just the docs that differ, without backfilling the
+index again (see `sinker reconcile`).
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Optional
+
+import psycopg
+from elasticsearch.helpers import scan
+
+import sinker.query_templates as q
+from .es import get_client
+from .pg import RawTextLoader
+from .pipeline import Pipeline
+from .settings import PGCHUNK_SIZE, SINKER_DIGEST_FIELD, SINKER_RECONCILE_BUCKETS, SINKER_SCHEMA
+from .utils import digested_doc, md5_prefix
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_CURSOR_NAME = "reconcile"
+# bits of the ID hashes (see utils.md5_prefix)
+ID_HASH_BITS = 32
+# each bucket that differs is split into 2 ** SPLIT_BITS sub-buckets
+SPLIT_BITS = 4
+# max number of docs in a bucket that differs for the digests of its docs to be compared rather than splitting it again
+LEAF_DOCS = 1000
+# max number of buckets per Elasticsearch query, each of which is a range clause
+QUERY_BUCKETS = 1000
+
+# the number of docs in each bucket and the sum of their digests, by bucket
+Summary = Dict[int, tuple[int, int]]
+
+
+def bucket(doc_id: str, shift: int) -> int:
+    """
+    :return: The doc's bucket among the buckets of ID hashes shifted right by shift bits
+    """
+    return md5_prefix(doc_id) >> shift
+
+
+def differing_buckets(view: Summary, index: Summary) -> list[int]:
+    return sorted(
+        doc_bucket for doc_bucket in view.keys() | index.keys() if view.get(doc_bucket) != index.get(doc_bucket)
+    )
+
+
+@dataclass
+class Report:
+    view: str
+    index: str
+    docs: int = 0
+    differing_buckets: int = 0
+    # docs whose digests were compared one by one
+    compared: int = 0
+    # docs in the view that are missing from the index, or differ from the ones in it
+    missing: int = 0
+    stale: int = 0
+    # docs in the index that aren't in the view anymore
+    extra: int = 0
+    repaired: int = 0
+
+
+class Reconciler:
+    """
+    Compares a view and its index without reading the docs where they match. Both are summarized in buckets of ID
+    hashes by the number of docs in each bucket and the sum of their digests, which Postgres computes from the view and
+    Elasticsearch aggregates from the digests stored in the docs. The buckets that differ are split into sub-buckets and
+    summarized again, until they are small enough to compare the digests of their docs one by one. The docs that differ
+    are then re-indexed from the view or deleted. Each repair is conditional on the doc in the index being the one that
+    was compared, so a doc that the sync loop changes in the meantime is left alone.
+    """
+
+    def __init__(
+        self,
+        view: str,
+        index: str,
+        buckets: int = SINKER_RECONCILE_BUCKETS,
+        pipeline: Optional[Pipeline] = None,
+        leaf_docs: int = LEAF_DOCS,
+    ):
+        """
+        :param view: Postgres materialized view name
+        :param index: Elasticsearch index name
+        :param buckets: The number of buckets summarized first, rounded up to a power of two
+        :param pipeline: Ships the repairs, defaults to one with the sync profile
+        :param leaf_docs: The max number of docs in a bucket that differs for its docs to be compared one by one
+        """
+        if not SINKER_DIGEST_FIELD:
+            raise ValueError("Reconciling needs SINKER_DIGEST_FIELD to be set, and the indices rebuilt with it")
+        self.view: str = view
+        self.index: str = index
+        # the top-level buckets are the ID hashes shifted right by this many bits
+        self.shift: int = ID_HASH_BITS - min(max(buckets - 1, 1).bit_length(), ID_HASH_BITS)
+        self.pipeline: Pipeline = pipeline or Pipeline(get_client())
+        self.leaf_docs: int = leaf_docs
+
+    def id_type(self) -> str:
+        """
+        :return: The type of the view's id column, for the view to be filtered by ID with its index, text by default
+        """
+        with psycopg.connect() as conn:
+            row: Optional[tuple[str]] = conn.execute(q.GET_ID_TYPE.format(f"{SINKER_SCHEMA}.{self.view}")).fetchone()
+        return row[0] if row else "text"
+
+    def view_docs(self, query: str, params: Optional[dict[str, Any]] = None) -> Iterable[tuple[str, Any]]:
+        """
+        :return: The rows of the view selected by the query, with the ID first, streamed over a dedicated connection
+        """
+        with psycopg.connect() as conn:
+            with conn.cursor(name=RECONCILE_CURSOR_NAME) as cursor:
+                cursor.adapters.register_loader("text", RawTextLoader)
+                cursor.itersize = PGCHUNK_SIZE
+                cursor.execute(query, params)
+                for doc_id, value in cursor:
+                    yield doc_id.decode(), value
+
+    def view_summary(self, shift: int, parents: list[int], parent_shift: int) -> Summary:
+        """
+        :param shift: The shift of the buckets to summarize
+        :param parents: The buckets to summarize the sub-buckets of
+        :param parent_shift: The shift of the parent buckets
+        """
+        query: str = q.RECONCILE_SUMMARY_QUERY.format(
+            view=f"{SINKER_SCHEMA}.{self.view}", shift=shift, parent_shift=parent_shift
+        )
+        # a summary has a row per bucket, few enough to fetch at once
+        with psycopg.connect() as conn:
+            rows: list[tuple[int, int, int]] = conn.execute(query, {"parents": parents}).fetchall()
+        return {doc_bucket: (count, digests) for doc_bucket, count, digests in rows}
+
+    def index_summary(self, shift: int, parents: list[int], parent_shift: int) -> Summary:
+        """
+        :param shift: The shift of the buckets to summarize
+        :param parents: The buckets to summarize the sub-buckets of
+        :param parent_shift: The shift of the parent buckets
+        """
+        es = get_client()
+        summary: Summary = {}
+        for start in range(0, len(parents), QUERY_BUCKETS):
+            response = es.search(
+                index=self.index,
+                size=0,
+                query=self.buckets_query(parents[start : start + QUERY_BUCKETS], parent_shift),
+                aggs={
+                    "buckets": {
+                        "histogram": {"field": f"{SINKER_DIGEST_FIELD}.id", "interval": 1 << shift, "min_doc_count": 1},
+                        # summed up as doubles, which are exact up to 2 ** 21 docs per bucket, and just make the
+                        # bigger buckets be split rather than compared
+                        "aggs": {"digests": {"sum": {"field": f"{SINKER_DIGEST_FIELD}.doc"}}},
+                    }
+                },
+            )
+            for hist_bucket in response["aggregations"]["buckets"]["buckets"]:
+                summary[int(hist_bucket["key"]) >> shift] = (
+                    hist_bucket["doc_count"],
+                    int(hist_bucket["digests"]["value"]),
+                )
+        return summary
+
+    @staticmethod
+    def buckets_query(buckets: list[int], shift: int) -> dict[str, Any]:
+        """
+        :return: An Elasticsearch query for the docs in the buckets
+        """
+        ranges: list[dict[str, Any]] = [
+            {"range": {f"{SINKER_DIGEST_FIELD}.id": {"gte": doc_bucket << shift, "lt": (doc_bucket + 1) << shift}}}
+            for doc_bucket in buckets
+        ]
+        return {"bool": {"filter": [{"bool": {"should": ranges}}]}}
+
+    def differing_leaves(self, report: Report) -> dict[int, list[int]]:
+        """
+        Summarizes the view and the index level by level, splitting only the buckets that differ
+        :return: The smallest buckets that differ, by their shift
+        """
+        leaves: dict[int, list[int]] = {}
+        shift, parents, parent_shift = self.shift, [0], ID_HASH_BITS
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="reconcile") as executor:
+            while parents:
+                view_future = executor.submit(self.view_summary, shift, parents, parent_shift)
+                index_summary: Summary = self.index_summary(shift, parents, parent_shift)
+                view_summary: Summary = view_future.result()
+                buckets: list[int] = differing_buckets(view_summary, index_summary)
+                if parent_shift == ID_HASH_BITS:
+                    report.docs = sum(count for count, _ in view_summary.values())
+                    report.differing_buckets = len(buckets)
+                parents = [
+                    doc_bucket
+                    for doc_bucket in buckets
+                    if shift > 0
+                    and max(view_summary.get(doc_bucket, (0, 0))[0], index_summary.get(doc_bucket, (0, 0))[0])
+                    > self.leaf_docs
+                ]
+                split: set[int] = set(parents)
+                if len(split) < len(buckets):
+                    leaves[shift] = [doc_bucket for doc_bucket in buckets if doc_bucket not in split]
+                parent_shift, shift = shift, max(shift - SPLIT_BITS, 0)
+        return leaves
+
+    def view_digests(self, leaves: dict[int, list[int]]) -> dict[str, int]:
+        """
+        :param leaves: The buckets by their shift
+        :return: The digests of the view's docs in the buckets, by ID
+        """
+        digests: dict[str, int] = {}
+        for shift, buckets in leaves.items():
+            query: str = q.RECONCILE_DIGESTS_QUERY.format(view=f"{SINKER_SCHEMA}.{self.view}", shift=shift)
+            digests.update(self.view_docs(query, {"buckets": buckets}))
+        return digests
+
+    def index_versions(self, leaves: dict[int, list[int]]) -> dict[str, tuple[int, int, int]]:
+        """
+        Reads the digests stored in the index's docs rather than the docs
+        :param leaves: The buckets by their shift
+        :return: The digests, sequence numbers and primary terms of the index's docs in the buckets, by ID
+        """
+        es = get_client()
+        versions: dict[str, tuple[int, int, int]] = {}
+        for shift, buckets in leaves.items():
+            for start in range(0, len(buckets), QUERY_BUCKETS):
+                for hit in scan(
+                    es,
+                    query={"query": self.buckets_query(buckets[start : start + QUERY_BUCKETS], shift)},
+                    index=self.index,
+                    size=PGCHUNK_SIZE,
+                    _source=[f"{SINKER_DIGEST_FIELD}.doc"],
+                    seq_no_primary_term=True,
+                ):
+                    versions[hit["_id"]] = (
+                        hit["_source"][SINKER_DIGEST_FIELD]["doc"],
+                        hit["_seq_no"],
+                        hit["_primary_term"],
+                    )
+        return versions
+
+    def repair_actions(
+        self, stale_ids: list[str], extra_ids: list[str], versions: dict[str, tuple[int, int, int]]
+    ) -> Iterable[Dict[str, Any]]:
+        """
+        :param stale_ids: The IDs of the docs to index from the view
+        :param extra_ids: The IDs of the docs to delete from the index
+        :param versions: The digests, sequence numbers and primary terms of the docs in the index, by ID
+        """
+        # the docs are read again right before shipping them, rather than kept from the comparison
+        query: str = q.RECONCILE_IDS_QUERY.format(f"{SINKER_SCHEMA}.{self.view}", self.id_type())
+        for start in range(0, len(stale_ids), PGCHUNK_SIZE):
+            for doc_id, doc in self.view_docs(query, {"ids": stale_ids[start : start + PGCHUNK_SIZE]}):
+                action: Dict[str, Any] = {"_index": self.index, "_id": doc_id, "_source": digested_doc(doc_id, doc)}
+                if doc_id in versions:
+                    _, seq_no, primary_term = versions[doc_id]
+                    action.update(if_seq_no=seq_no, if_primary_term=primary_term)
+                else:
+                    action["_op_type"] = "create"
+                yield action
+        for doc_id in extra_ids:
+            _, seq_no, primary_term = versions[doc_id]
+            yield {
+                "_op_type": "delete",
+                "_index": self.index,
+                "_id": doc_id,
+                "if_seq_no": seq_no,
+                "if_primary_term": primary_term,
+            }
+
+    def reconcile(self, repair: bool = True) -> Report:
+        """
+        :param repair: Whether to repair the docs that differ, or only report them
+        """
+        report = Report(self.view, self.index)
+        logger.info(f"Comparing {self.view} with {self.index} in {1 << (ID_HASH_BITS - self.shift)} buckets")
+        leaves: dict[int, list[int]] = self.differing_leaves(report)
+        if not leaves:
+            logger.info(f"{self.index} matches {self.view} ({report.docs} docs)")
+            return report
+        logger.info(f"{report.differing_buckets} buckets of {self.index} differ from {self.view}")
+        view_digests: dict[str, int] = self.view_digests(leaves)
+        versions: dict[str, tuple[int, int, int]] = self.index_versions(leaves)
+        report.compared = len(view_digests.keys() | versions.keys())
+        missing_ids: list[str] = [doc_id for doc_id in view_digests if doc_id not in versions]
+        stale_ids: list[str] = [
+            doc_id for doc_id, digest in view_digests.items() if doc_id in versions and versions[doc_id][0] != digest
+        ]
+        extra_ids: list[str] = [doc_id for doc_id in versions if doc_id not in view_digests]
+        report.missing, report.stale, report.extra = len(missing_ids), len(stale_ids), len(extra_ids)
+        logger.info(
+            f"Compared {report.compared} docs: {self.index} is missing {report.missing} docs of {self.view}, has "
+            f"{report.stale} stale docs and {report.extra} docs that aren't in the view anymore"
+        )
+        if repair:
+            report.repaired = self.pipeline.ship(self.repair_actions(missing_ids + stale_ids, extra_ids, versions))
+            logger.info(f"Repaired {report.repaired} docs in {self.index}")
+        return report
@@ -1,69 +1,232 @@
 import concurrent
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
 from time import sleep
-from typing import Any
+from typing import Any, Iterable, Optional
 
 import psycopg
-from elasticsearch.helpers import bulk
 
 import sinker.query_templates as q
+from . import metrics
 from .bulk_action_generator import BulkActionGenerator
+from .decoders import Decoder, PgOutputDecoder, get_decoder
 from .es import get_client
+from .pg import get_pool
+from .pipeline import Pipeline
+from .scheduler import PendingView, Scheduler, load_scheduler
+from .shards import Shard, load_assignments
+from .spool import Spool, SpoolShipper
 from .settings import (
     SINKER_DEFINITIONS_PATH,
     SINKER_SCHEMA,
-    SINKER_REPLICATION_SLOT,
-    SINKER_TODO_TABLE,
+    SINKER_DEFINITIONS_TABLE,
+    SINKER_RESUME,
+    SINKER_INCREMENTAL,
     SINKER_POLL_INTERVAL,
-    ELASTICSEARCH_BULK_KWARGS,
+    SINKER_MAX_CONCURRENT_REFRESHES,
+    SINKER_SHARDS,
+    SINKER_SPOOL_PATH,
+    SINKER_SPOOL_SEGMENT_BYTES,
+    SINKER_SPOOL_MAX_BYTES,
+    SINKER_SPOOL_BATCH_SIZE,
 )
 from .sinker import Sinker, SCHEMA_TABLE_DELIMITER
 
 logger = logging.getLogger(__name__)
 
 
+def setup_tables(shard: Shard, drop: bool = False) -> None:
+    """
+    Sets up the tables that track the materialized views of the shard that need updating, and the definitions they
+    were built from
+    :param drop: Whether to drop the todo tables first, along with any pending changes
+    """
+    ddl_list = []
+    if drop:
+        ddl_list.append(q.DROP_TODO_TABLE.format(SINKER_SCHEMA, shard.todo_table))
+        ddl_list.append(q.DROP_TODO_TABLE.format(SINKER_SCHEMA, shard.todo_keys_table))
+    ddl_list.append(q.CREATE_TODO_TABLE.format(SINKER_SCHEMA, shard.todo_table))
+    if SINKER_INCREMENTAL:
+        ddl_list.append(q.CREATE_TODO_KEYS_TABLE.format(SINKER_SCHEMA, shard.todo_keys_table))
+    ddl_list.append(q.CREATE_DEFINITIONS_TABLE.format(SINKER_SCHEMA, SINKER_DEFINITIONS_TABLE))
+    with get_pool().connection() as conn:
+        conn.execute("; ".join(ddl_list))
+
+
+def slot_plugin(shard: Shard) -> Optional[str]:
+    """
+    :return: The output plugin of the shard's existing replication slot, or None if there is no slot
+    """
+    with get_pool().connection() as conn:
+        plugin_tuple = conn.execute(q.GET_SLOT_PLUGIN.format(shard.slot)).fetchone()
+    return plugin_tuple[0] if plugin_tuple else None
+
+
+def setup_publication(shard: Shard, resume: bool) -> None:
+    """
+    pgoutput only decodes changes to the tables in the publication, which each sinker adds its view table to as it
+    sets it up, so changes to any other table never leave the server. The publication is looked up as of each
+    change, so it has to exist before the slot does. When resuming, the existing publication already has the view
+    tables that are kept, and dropping a table drops it from the publication too.
+    """
+    with get_pool().connection() as conn:
+        all_tables_tuple = conn.execute(q.GET_PUBLICATION.format(shard.publication)).fetchone()
+        if all_tables_tuple and resume:
+            return
+        if all_tables_tuple:
+            conn.execute(q.DROP_PUBLICATION.format(shard.publication))
+        conn.execute(q.CREATE_PUBLICATION.format(shard.publication))
+
+
+def setup_slot(shard: Shard, decoder: Decoder) -> None:
+    # set up replication slot
+    drop_slot: str = q.DROP_SLOT.format(shard.slot)
+    with get_pool().connection() as conn:
+        check_slot_format = q.CHECK_SLOT.format(shard.slot)
+        count_tuple = conn.execute(check_slot_format).fetchone()
+        if count_tuple and count_tuple[0] > 0:
+            conn.execute(drop_slot)
+        create_slot: str = q.CREATE_SLOT.format(shard.slot, decoder.plugin)
+        conn.execute(create_slot)
+
+
 class Runner:
     def __init__(self):
+        metrics.start_server()
         # What are you sinking about?
         with open(f"{SINKER_DEFINITIONS_PATH}/views_to_indices.json") as f:
             views_to_indices = json.load(f)
+        assignments: dict[str, int] = load_assignments(f"{SINKER_DEFINITIONS_PATH}/shards.json")
+        # A dedicated connection, since it's held for as long as Sinker runs, that the triggers' notifications arrive
+        # on. Polling the todo tables every SINKER_POLL_INTERVAL is only a fallback, e.g. for triggers that predate
+        # the notifications. It also holds the lock on the shard.
+        self.listener = psycopg.connect(autocommit=True)
+        self.shard: Shard = self.claim_shard()
+        views_to_indices = {
+            view: index for view, index in views_to_indices.items() if self.shard.owns(view, assignments)
+        }
+        # fail fast on an unsupported output plugin, before doing any expensive setup
+        decoder: Decoder = get_decoder(self.shard)
+        # reused for every drain of the slot, so that its batch size keeps adapting to Elasticsearch
+        self.pipeline = Pipeline(get_client())
+        self.scheduler: Scheduler = load_scheduler(f"{SINKER_DEFINITIONS_PATH}/schedules.json")
+        self.refresh_executor = ThreadPoolExecutor(
+            max_workers=max(SINKER_MAX_CONCURRENT_REFRESHES, 1), thread_name_prefix="refresh"
+        )
+        # the refreshes in progress, and their views
+        self.refreshing: dict[Future, str] = {}
+        self.listener.execute(q.LISTEN.format(self.shard.channel))
+        self.spool: Optional[Spool] = None
+        self.shipper: Optional[SpoolShipper] = None
+        if SINKER_SPOOL_PATH:
+            self.spool = Spool(self.shard.name(SINKER_SPOOL_PATH), SINKER_SPOOL_SEGMENT_BYTES, SINKER_SPOOL_MAX_BYTES)
+            self.shipper = SpoolShipper(self.spool, self.pipeline, SINKER_SPOOL_BATCH_SIZE, SINKER_POLL_INTERVAL)
 
-        # set up table to track materialized views that need updating
-        ddl_list = [
-            q.DROP_TODO_TABLE.format(SINKER_SCHEMA, SINKER_TODO_TABLE),
-            q.CREATE_TODO_TABLE.format(SINKER_SCHEMA, SINKER_TODO_TABLE),
-        ]
-        psycopg.connect(autocommit=True).execute("; ".join(ddl_list))
+        setup_tables(self.shard, drop=not SINKER_RESUME)
         self.views_to_sinkers: dict[str, Sinker] = {
-            view: Sinker(view, index) for (view, index) in views_to_indices.items()
+            view: Sinker(view, index, self.shard) for (view, index) in views_to_indices.items()
         }
 
-        # set up materialized views and Elasticsearch indices, and populate them with initial data
-        with ThreadPoolExecutor(max_workers=len(self.views_to_sinkers)) as executor:
-            futures = []
+        # Resuming continues from where the existing replication slot left off, which only works if it was created
+        # with the same output plugin. Otherwise, changes may have been missed and everything gets rebuilt.
+        resume: bool = SINKER_RESUME and slot_plugin(self.shard) == decoder.plugin
+        sinkers_to_set_up: list[Sinker] = list(self.views_to_sinkers.values())
+        if self.shipper is not None:
+            # Spooled actions for the indices about to be rebuilt must not land in the rebuilt ones, so ship them to the
+            # current ones first. If everything gets rebuilt, they're not needed at all.
+            if resume:
+                self.shipper.drain()
+            else:
+                self.shipper.spool.clear()
+        if resume:
             for sinker in self.views_to_sinkers.values():
-                futures.append(executor.submit(sinker.setup))
-            for future in concurrent.futures.as_completed(futures):
-                view: str = future.result()
-                logger.info(f"{view} sinker is set up")
+                sinker.load_definition()
+            current_sinkers: list[Sinker] = [sinker for sinker in sinkers_to_set_up if sinker.is_current()]
+            if not SINKER_INCREMENTAL:
+                for sinker in current_sinkers:
+                    sinker.set_replica_identity()
+            sinkers_to_set_up = [sinker for sinker in sinkers_to_set_up if sinker not in current_sinkers]
+            logger.info(f"Resuming {len(current_sinkers)} view(s) and rebuilding {len(sinkers_to_set_up)} view(s)")
+            # Ship what's pending in the slot for the views being resumed. Pending changes for the views being rebuilt
+            # are skipped, so they can't land in the rebuilt indices after the fact. Views may have had no replica
+            # identity when the pending changes were logged, so deletes also come from their parent tables.
+            self.bulk_gen: BulkActionGenerator = BulkActionGenerator(
+                {sinker.view: sinker.index for sinker in current_sinkers},
+                self.parent_tables_to_indices(current_sinkers),
+                decoder,
+                slot=self.shard.slot,
+            )
+            self.process_slot()
+            # Todo entries are popped before the views are refreshed, and may have been waiting on their schedule when
+            # Sinker stopped, so refresh the resumed views once to be safe
+            if current_sinkers:
+                with get_pool().connection() as conn:
+                    conn.execute(
+                        "; ".join(
+                            q.CREATE_TODO_ENTRY.format(
+                                SINKER_SCHEMA, self.shard.todo_table, f"{SINKER_SCHEMA}.{sinker.view}"
+                            )
+                            for sinker in current_sinkers
+                        )
+                    )
 
-        parent_tables_to_indices: dict[str, str] = {
-            sinker.parent_table: sinker.index for sinker in self.views_to_sinkers.values()
-        }
+        if decoder.plugin == PgOutputDecoder.plugin:
+            setup_publication(self.shard, resume)
 
-        # set up replication slot
-        drop_slot: str = q.DROP_SLOT.format(SINKER_REPLICATION_SLOT)
-        with psycopg.connect(autocommit=True) as conn:
-            check_slot_format = q.CHECK_SLOT.format(SINKER_REPLICATION_SLOT)
-            count_tuple = conn.execute(check_slot_format).fetchone()
-            if count_tuple and count_tuple[0] > 0:
-                conn.execute(drop_slot)
-            create_slot: str = q.CREATE_SLOT.format(SINKER_REPLICATION_SLOT)
-            conn.execute(create_slot)
+        # set up materialized views and Elasticsearch indices, and populate them with initial data
+        if sinkers_to_set_up:
+            with ThreadPoolExecutor(max_workers=len(sinkers_to_set_up)) as executor:
+                futures = []
+                for sinker in sinkers_to_set_up:
+                    futures.append(executor.submit(sinker.setup))
+                for future in concurrent.futures.as_completed(futures):
+                    view: str = future.result()
+                    logger.info(f"{view} sinker is set up")
 
-        self.bulk_gen: BulkActionGenerator = BulkActionGenerator(views_to_indices, parent_tables_to_indices)
+        if not resume:
+            setup_slot(self.shard, decoder)
+
+        # every view now logs the IDs of its deleted rows, so the parent tables aren't needed
+        self.bulk_gen = BulkActionGenerator(
+            views_to_indices,
+            {},
+            decoder,
+            slot=self.shard.slot,
+        )
+        if self.shipper is not None:
+            self.shipper.start()
+
+    @staticmethod
+    def parent_tables_to_indices(sinkers: Iterable[Sinker]) -> dict[str, list[str]]:
+        """
+        Maps each parent table to the indices of all the views built on it, so that a delete reaches each of them
+        """
+        # In incremental mode the views are tables with a primary key, so their own DELETE events carry the ID of the
+        # doc and the parent table proxy isn't needed.
+        if SINKER_INCREMENTAL:
+            return {}
+        parent_tables_to_indices: dict[str, list[str]] = {}
+        for sinker in sinkers:
+            parent_tables_to_indices.setdefault(sinker.parent_table, []).append(sinker.index)
+        return parent_tables_to_indices
+
+    def claim_shard(self) -> Shard:
+        """
+        Waits for a shard that no other worker owns, and locks it for as long as this worker runs. The lock is held by
+        the listener connection, so when a worker dies, a standby worker takes its shard over.
+        """
+        if SINKER_SHARDS <= 1:
+            return Shard()
+        while True:
+            for number in range(SINKER_SHARDS):
+                shard: Shard = Shard(number, SINKER_SHARDS)
+                locked_tuple = self.listener.execute(q.TRY_LOCK_SHARD.format(shard.slot)).fetchone()
+                if locked_tuple and locked_tuple[0]:
+                    logger.info(f"Running shard {number} of {SINKER_SHARDS}")
+                    return shard
+            logger.info(f"All {SINKER_SHARDS} shards are owned by other workers, standing by")
+            sleep(SINKER_POLL_INTERVAL)
 
     def run(self):
         logger.info("We are sinking!")
@@ -71,38 +234,113 @@ class Runner:
             self.iterate()
 
     def iterate(self):
-        # pop any materialized views that need refreshing
-        views: list[tuple[Any, ...]] = (
-            psycopg.connect(autocommit=True)
-            .execute(q.POP_TODO_ENTRIES.format(SINKER_SCHEMA, SINKER_TODO_TABLE))
-            .fetchall()
-        )
-        # ---------------------------------------
-        # a triggered update here will cause a new entry to be added to the table
-        # to be processed on a subsequent loop. However, the actual change will get reflected in the materialized
-        # view when it gets refreshed below, and will get propagated to Elasticsearch on this loop. When the
-        # enqueued update is popped on the next iteration, it could be a harmless no-op if no additional changes
-        # occurred because the materialized view will already be up-to-date.
-        # ---------------------------------------
-        if not views:
-            logger.debug("Nothing is something worth doing.")
-            sleep(SINKER_POLL_INTERVAL)
+        if self.shipper is not None and self.shipper.error is not None:
+            raise self.shipper.error
+        if metrics.enabled():
+            self.update_gauges()
+        self.pop_todo()
+        timeout: float = self.start_due_refreshes()
+        if not self.refreshing:
+            if not self.scheduler.pending:
+                logger.debug("Nothing is something worth doing.")
+            self.wait_for_changes(timeout)
             return
-        with ThreadPoolExecutor(max_workers=len(views)) as executor:
-            futures = []
-            for view_tuple in views:
-                view: str = view_tuple[0].split(SCHEMA_TABLE_DELIMITER)[1]
-                sinker: Sinker = self.views_to_sinkers[view]
-                futures.append(executor.submit(sinker.refresh_view))
-            for future in concurrent.futures.as_completed(futures):
-                view_result: str = future.result()
+        # Keep scheduling while the refreshes are running, so that views that become due in the meantime don't wait
+        # for the slowest refresh to finish
+        while self.refreshing:
+            done, _ = concurrent.futures.wait(self.refreshing, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                self.refreshing.pop(future)
+                try:
+                    view_result: str = future.result()
+                except Exception:
+                    metrics.ERRORS.labels(stage="refresh").inc()
+                    raise
                 logger.info(f"{view_result} view is refreshed")
+                sinker: Sinker = self.views_to_sinkers[view_result]
+                if sinker.redefined:
+                    # the index was rebuilt, so what was shipped to the previous one says nothing about it
+                    self.bulk_gen.forget(sinker.index)
+                    sinker.redefined = False
+                # ship each view's changes as soon as it's refreshed, while the other views are still refreshing
+                self.process_slot()
+            self.pop_todo()
+            timeout = self.start_due_refreshes()
 
+    def wait_for_changes(self, timeout: float) -> None:
+        """
+        Blocks until a trigger notifies of a change, or for the timeout at most
+        """
+        for _ in self.listener.notifies(timeout=timeout, stop_after=1):
+            logger.debug("Woken up by a change")
+        # a burst of changes only needs to wake the loop up once
+        for _ in self.listener.notifies(timeout=0):
+            pass
+
+    def start_due_refreshes(self) -> float:
+        """
+        Starts refreshing the views that are due, highest priority first, as far as the cap on concurrent refreshes
+        allows
+        :return: Seconds until the scheduler should be checked again
+        """
+        busy: set[str] = set(self.refreshing.values())
+        for view in self.scheduler.due(busy)[: max(SINKER_MAX_CONCURRENT_REFRESHES - len(self.refreshing), 0)]:
+            pending: PendingView = self.scheduler.take(view)
+            sinker: Sinker = self.views_to_sinkers[view]
+            # a full refresh of the view already covers any individual rows
+            future: Future = (
+                self.refresh_executor.submit(sinker.refresh_view)
+                if pending.full
+                else self.refresh_executor.submit(sinker.refresh_rows, sorted(pending.ids))
+            )
+            self.refreshing[future] = view
+            busy.add(view)
         # ---------------------------------------
-        # a triggered update from here on will cause a new materialized view entry to be added to the "end"
-        # of the table to be processed on the next loop iteration.
+        # a triggered update from here on will cause a new entry to be added to the todo table, to be picked up on a
+        # subsequent loop. The change may already be reflected by the refresh that is running, in which case the
+        # next refresh of the view is a harmless no-op.
         # ---------------------------------------
+        if len(self.refreshing) >= SINKER_MAX_CONCURRENT_REFRESHES:
+            # due views wait for a refresh to finish, which wakes the loop up anyway
+            return SINKER_POLL_INTERVAL
+        wait_time: Optional[float] = self.scheduler.wait_time(busy)
+        return SINKER_POLL_INTERVAL if wait_time is None else min(wait_time, SINKER_POLL_INTERVAL)
+
+    def pop_todo(self) -> None:
+        """
+        Hands the pending changes in the todo tables over to the scheduler. They're popped as soon as they're seen, so
+        the time of the entries that show up after that tells the scheduler when the view last changed.
+        """
+        with get_pool().connection() as conn:
+            views: list[tuple[Any, ...]] = conn.execute(
+                q.POP_TODO_ENTRIES.format(SINKER_SCHEMA, self.shard.todo_table)
+            ).fetchall()
+            # pop any individual rows of views that need recomputing (incremental mode)
+            keys: list[tuple[Any, ...]] = (
+                conn.execute(q.POP_TODO_KEYS.format(SINKER_SCHEMA, self.shard.todo_keys_table)).fetchall()
+                if SINKER_INCREMENTAL
+                else []
+            )
+        for schema_view, age in views:
+            self.scheduler.add(schema_view.split(SCHEMA_TABLE_DELIMITER)[1], age)
+        for schema_view, doc_id, age in keys:
+            self.scheduler.add(schema_view.split(SCHEMA_TABLE_DELIMITER)[1], age, doc_id)
 
+    def update_gauges(self) -> None:
+        with get_pool().connection() as conn:
+            lag_tuple = conn.execute(q.GET_SLOT_LAG.format(self.shard.slot)).fetchone()
+            if lag_tuple and lag_tuple[0] is not None:
+                metrics.SLOT_LAG_BYTES.set(float(lag_tuple[0]))
+            todo_tables: list[str] = [self.shard.todo_table] + (
+                [self.shard.todo_keys_table] if SINKER_INCREMENTAL else []
+            )
+            for table in todo_tables:
+                count_tuple = conn.execute(q.COUNT_ROWS.format(SINKER_SCHEMA, table)).fetchone()
+                metrics.TODO_DEPTH.labels(table=table).set(count_tuple[0] if count_tuple else 0)
+        if self.spool is not None:
+            metrics.SPOOL_BYTES.set(self.spool.pending_bytes())
+
+    def process_slot(self) -> None:
         logger.info("Processing replication slot entries...")
         # Loop over available xid's in replication slot that came from refreshing the materialized view. Any other
         # changes to anything in the entire database will be ignored. It's possible that the replication slot will
@@ -111,7 +349,25 @@ class Runner:
         # activity, like inserts into a schema/table you aren't synchronizing to Elasticsearch. If you are worried
         # about your replication slot growing too large during a scenario like this, you can periodically trigger
         # a materialized view refresh to clear out the slot (see the CREATE_TODO_ENTRY query template).
-        processed_tuples, _ = bulk(
-            client=get_client(), actions=self.bulk_gen.generate_actions(), stats_only=False, **ELASTICSEARCH_BULK_KWARGS
-        )
+        # The slot is drained in slices, each shipped and confirmed before the next is decoded, so that a failure
+        # only loses the work of the current slice
+        processed_tuples: int = 0
+        while True:
+            with metrics.SLOT_DRAIN_SECONDS.time():
+                if self.spool is None:
+                    processed_tuples += self.pipeline.ship(self.bulk_gen.generate_actions())
+                elif self.spool.full():
+                    logger.warning("The spool is full, leaving the changes in the replication slot until it's shipped")
+                    break
+                else:
+                    # the shipper takes it from here, at its own pace
+                    processed_tuples += self.spool.append(self.bulk_gen.generate_actions())
+                # only now that Elasticsearch has acknowledged the actions, or they're safe in the spool, is it safe
+                # to let go of them
+                self.bulk_gen.confirm()
+            if not self.bulk_gen.more_pending:
+                break
+            logger.debug(f"Processed {processed_tuples} tuples so far, decoding the next slice")
         logger.info(f"Processed {processed_tuples} tuples from replication slot")
+        if self.bulk_gen.digest_cache.enabled:
+            logger.info(f"Skipped {self.bulk_gen.digest_cache.skipped} unchanged docs so far")
@@ -0,0 +1,139 @@
+"""Decides when each view with pending changes gets refreshed, based on its schedule."""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field, fields
+from time import monotonic
+from typing import Collection, Optional
+
+
+@dataclass(frozen=True)
+class Schedule:
+    """
+    How eagerly a view gets refreshed once it has pending changes
+    :param min_interval: Min seconds between the starts of two refreshes of the view
+    :param debounce: Seconds without new changes to wait for, so that a burst of changes costs a single refresh
+    :param priority: Views with a higher priority are refreshed first when refreshes are capped
+    :param max_staleness: Max seconds a change waits for a refresh, overriding the min interval and the debounce window
+    """
+
+    min_interval: float = 0
+    debounce: float = 0
+    priority: int = 0
+    max_staleness: Optional[float] = None
+
+
+@dataclass
+class PendingView:
+    """The changes to a view that are waiting for a refresh, with their times on the monotonic clock"""
+
+    first_change: float
+    last_change: float
+    full: bool = False  # whether the whole view needs refreshing, rather than just the rows with these IDs
+    ids: set[str] = field(default_factory=set)
+
+
+class Scheduler:
+    def __init__(self, schedules: dict[str, Schedule], default: Schedule = Schedule()):
+        """
+        :param schedules: The schedules of views that don't follow the default one
+        :param default: The schedule of any other view
+        """
+        self.schedules: dict[str, Schedule] = schedules
+        self.default: Schedule = default
+        self.pending: dict[str, PendingView] = {}
+        self.last_refresh: dict[str, float] = {}
+
+    def schedule(self, view: str) -> Schedule:
+        return self.schedules.get(view, self.default)
+
+    def add(self, view: str, age: float, doc_id: Optional[str] = None, now: Optional[float] = None) -> None:
+        """
+        Records a pending change to a view
+        :param view: The view
+        :param age: How many seconds ago the change was made
+        :param doc_id: The parent ID of the view row that needs recomputing, or None if the whole view does
+        """
+        now = monotonic() if now is None else now
+        changed: float = now - max(age, 0)
+        pending: Optional[PendingView] = self.pending.get(view)
+        if pending is None:
+            pending = self.pending[view] = PendingView(changed, changed)
+        else:
+            pending.first_change = min(pending.first_change, changed)
+            pending.last_change = max(pending.last_change, changed)
+        if doc_id is None:
+            pending.full = True
+        else:
+            pending.ids.add(doc_id)
+
+    def due(self, busy: Collection[str] = (), now: Optional[float] = None) -> list[str]:
+        """
+        A view is due when it has been quiet for its debounce window and wasn't refreshed in the last min interval, or
+        when its oldest pending change has been waiting for its max staleness
+        :param busy: The views being refreshed right now, which aren't due until they're done
+        :return: The due views, overdue ones first, then by priority, then the ones waiting the longest
+        """
+        now = monotonic() if now is None else now
+        due: list[tuple[bool, int, float, str]] = []
+        for view, pending in self.pending.items():
+            if view in busy:
+                continue
+            schedule: Schedule = self.schedule(view)
+            staleness: float = now - pending.first_change
+            overdue: bool = schedule.max_staleness is not None and staleness >= schedule.max_staleness
+            if not overdue and (
+                now - pending.last_change < schedule.debounce
+                or now - self.last_refresh.get(view, float("-inf")) < schedule.min_interval
+            ):
+                continue
+            due.append((not overdue, -schedule.priority, -staleness, view))
+        return [view for *_, view in sorted(due)]
+
+    def wait_time(self, busy: Collection[str] = (), now: Optional[float] = None) -> Optional[float]:
+        """
+        :param busy: The views being refreshed right now
+        :return: Seconds until the next pending view is due, or None if there are none
+        """
+        now = monotonic() if now is None else now
+        due_times: list[float] = []
+        for view, pending in self.pending.items():
+            if view in busy:
+                continue
+            schedule: Schedule = self.schedule(view)
+            due_time: float = max(
+                pending.last_change + schedule.debounce,
+                self.last_refresh.get(view, float("-inf")) + schedule.min_interval,
+            )
+            if schedule.max_staleness is not None:
+                due_time = min(due_time, pending.first_change + schedule.max_staleness)
+            due_times.append(due_time - now)
+        return max(min(due_times), 0) if due_times else None
+
+    def take(self, view: str, now: Optional[float] = None) -> PendingView:
+        """
+        Hands over the pending changes of a view whose refresh is starting
+        """
+        self.last_refresh[view] = monotonic() if now is None else now
+        return self.pending.pop(view)
+
+
+def load_scheduler(path: str) -> Scheduler:
+    """
+    Reads the optional schedules.json definition file, which maps views to their schedule settings, with a "default"
+    entry for the views that aren't listed e.g.
+        {"default": {"debounce": 1}, "course_mv": {"priority": 10, "max_staleness": 5}}
+    :param path: The path of the file
+    """
+    if not os.path.exists(path):
+        return Scheduler({})
+    with open(path, "r") as f:
+        config: dict[str, dict] = json.load(f)
+    names: set[str] = {schedule_field.name for schedule_field in fields(Schedule)}
+    for view, settings in config.items():
+        unknown: set[str] = set(settings) - names
+        if unknown:
+            raise ValueError(f"Unknown schedule settings for {view}: {', '.join(sorted(unknown))}")
+    default: Schedule = Schedule(**config.pop("default", {}))
+    # views override just the settings they list
+    return Scheduler({view: Schedule(**{**asdict(default), **settings}) for view, settings in config.items()}, default)
@@ -2,6 +2,7 @@
 
 import logging.config
 import os
+from typing import Any
 
 from environs import Env
 
@@ -18,9 +19,72 @@ SINKER_SCHEMA = env.str("SINKER_SCHEMA", default=DEFAULT_SCHEMA)
 SINKER_REPLICATION_SLOT = env.str("SINKER_REPLICATION_SLOT", default="sinker")
 SINKER_TODO_TABLE = env.str("SINKER_TODO_TABLE", default="todo")
 SINKER_POLL_INTERVAL = env.int("SINKER_POLL_INTERVAL", default=10)
+# channel the triggers notify of changes, to wake Sinker up without waiting for the next poll
+SINKER_NOTIFY_CHANNEL = env.str("SINKER_NOTIFY_CHANNEL", default="sinker")
+# number of shards the views are split into, each owned by one Sinker worker at a time with its own replication slot
+# and todo tables. Run more workers than shards to have standbys take over the shards of workers that die.
+SINKER_SHARDS = env.int("SINKER_SHARDS", default=1)
+# max number of views refreshing at the same time, to bound the load on Postgres however many views have changes
+SINKER_MAX_CONCURRENT_REFRESHES = env.int("SINKER_MAX_CONCURRENT_REFRESHES", default=4)
+# keep views in regular tables and recompute only the rows whose parent IDs were touched, instead of refreshing
+# materialized views in full
+SINKER_INCREMENTAL = env.bool("SINKER_INCREMENTAL", default=False)
+SINKER_TODO_KEYS_TABLE = env.str("SINKER_TODO_KEYS_TABLE", default="todo_keys")
+# on restart, keep the replication slot, todo table, views and indices whose definitions haven't changed and continue
+# from where the slot left off, instead of rebuilding everything
+SINKER_RESUME = env.bool("SINKER_RESUME", default=False)
+SINKER_DEFINITIONS_TABLE = env.str("SINKER_DEFINITIONS_TABLE", default="definitions")
+# logical decoding output plugin for the replication slot: test_decoding, wal2json or pgoutput
+SINKER_OUTPUT_PLUGIN = env.str("SINKER_OUTPUT_PLUGIN", default="test_decoding")
+# publication that the pgoutput plugin decodes changes for
+SINKER_PUBLICATION = env.str("SINKER_PUBLICATION", default="sinker")
+# number of page range partitions each view is backfilled in, each read over its own Postgres connection in parallel
+SINKER_BACKFILL_PARTITIONS = env.int("SINKER_BACKFILL_PARTITIONS", default=1)
+# number of id hash buckets whose digests are compared first to find the docs that differ between a view and its index
+# (rounded up to a power of two), each of which is split into sub-buckets in turn until they are small
+SINKER_RECONCILE_BUCKETS = env.int("SINKER_RECONCILE_BUCKETS", default=4096)
+# object field of each doc holding the hash of its ID and the digest of its text, which reconciling sums up, empty to
+# leave the docs as they are (reconciling needs it set, and the indices rebuilt)
+SINKER_DIGEST_FIELD = env.str("SINKER_DIGEST_FIELD", default="")
+# max number of slot entries decoded per slice of the replication slot, each of which is shipped and confirmed before
+# the next one is decoded, so that the memory and the work lost to a failure are bounded, 0 to decode all at once
+SINKER_SLOT_SLICE_CHANGES = env.int("SINKER_SLOT_SLICE_CHANGES", default=100000)
+# bytes of slot entries to aim for per slice, which sizes the slices within SINKER_SLOT_SLICE_CHANGES, 0 not to
+SINKER_SLOT_SLICE_BYTES = env.int("SINKER_SLOT_SLICE_BYTES", default=64 * 1024 * 1024)
+# max number of chunks of slot entries read ahead, and of actions queued for each bulk sender
+SINKER_PIPELINE_QUEUE_SIZE = env.int("SINKER_PIPELINE_QUEUE_SIZE", default=4)
+# max number of distinct docs whose index actions are held back to coalesce repeated changes to them, 0 to ship every
+# change (deletes are held until the end of the slice regardless)
+SINKER_COALESCE_WINDOW = env.int("SINKER_COALESCE_WINDOW", default=10000)
+# max number of docs whose last shipped digest is remembered to skip re-shipping them unchanged, 0 to disable
+SINKER_DIGEST_CACHE_SIZE = env.int("SINKER_DIGEST_CACHE_SIZE", default=0)
+# directory of a durable spool that actions are written to before the replication slot is advanced past them, so that
+# the slot keeps draining while Elasticsearch is unavailable, empty to ship the actions straight from the slot
+SINKER_SPOOL_PATH = env.str("SINKER_SPOOL_PATH", default="")
+# size of the spool's segment files
+SINKER_SPOOL_SEGMENT_BYTES = env.int("SINKER_SPOOL_SEGMENT_BYTES", default=64 * 1024 * 1024)
+# bytes of unshipped actions at which the slot stops being drained into the spool, 0 for no limit
+SINKER_SPOOL_MAX_BYTES = env.int("SINKER_SPOOL_MAX_BYTES", default=10 * 1024 * 1024 * 1024)
+# max number of spooled actions shipped between two checkpoints
+SINKER_SPOOL_BATCH_SIZE = env.int("SINKER_SPOOL_BATCH_SIZE", default=10000)
+# bytes of the docs last shipped to keep in memory, so that the next change to one of them ships a partial update of
+# just the fields that changed, 0 to always ship whole docs
+SINKER_DOC_CACHE_BYTES = env.int("SINKER_DOC_CACHE_BYTES", default=0)
+# max size of a partial update relative to the whole doc, beyond which the whole doc is shipped instead
+SINKER_PARTIAL_UPDATE_MAX_RATIO = env.float("SINKER_PARTIAL_UPDATE_MAX_RATIO", default=0.5)
+# port to serve Prometheus metrics on, 0 to not serve them
+SINKER_METRICS_PORT = env.int("SINKER_METRICS_PORT", default=0)
+# force-merge a freshly backfilled index down to this many segments before it goes live (0 to skip)
+SINKER_FORCE_MERGE_SEGMENTS = env.int("SINKER_FORCE_MERGE_SEGMENTS", default=0)
 
 # Elasticsearch:
 ELASTICSEARCH_CHUNK_SIZE = env.int("ELASTICSEARCH_CHUNK_SIZE", default=100)
+# size of the HTTP connection pool to each Elasticsearch node, shared by all threads
+ELASTICSEARCH_CONNECTIONS_PER_NODE = env.int("ELASTICSEARCH_CONNECTIONS_PER_NODE", default=10)
+# number of concurrent bulk request senders syncing changes from the replication slot
+ELASTICSEARCH_BULK_SENDERS = env.int("ELASTICSEARCH_BULK_SENDERS", default=2)
+# number of concurrent bulk request senders shipping each backfill partition to Elasticsearch
+ELASTICSEARCH_BULK_THREADS = env.int("ELASTICSEARCH_BULK_THREADS", default=4)
 ELASTICSEARCH_HOST = env.str("ELASTICSEARCH_HOST", default="localhost")
 ELASTICSEARCH_MAX_RETRIES = env.int("ELASTICSEARCH_MAX_RETRIES", default=5)
 ELASTICSEARCH_PASSWORD = env.str("ELASTICSEARCH_PASSWORD", default=None)
@@ -33,12 +97,40 @@ ELASTICSEARCH_TIMEOUT = env.float("ELASTICSEARCH_TIMEOUT", default=60)
 ELASTICSEARCH_USER = env.str("ELASTICSEARCH_USER", default=None)
 ELASTICSEARCH_VERIFY_CERTS = env.bool("ELASTICSEARCH_VERIFY_CERTS", default=True)
 
-ELASTICSEARCH_BULK_KWARGS = dict(
+# Bulk requests start at ELASTICSEARCH_CHUNK_SIZE docs (ELASTICSEARCH_BACKFILL_CHUNK_SIZE for backfills) and adapt
+# between the min and max chunk sizes to keep their latency near the target, without exceeding the max chunk bytes.
+# Live sync favors small, quick requests to keep latency low, whereas backfills favor throughput.
+ELASTICSEARCH_MIN_CHUNK_SIZE = env.int("ELASTICSEARCH_MIN_CHUNK_SIZE", default=10)
+ELASTICSEARCH_MAX_CHUNK_SIZE = env.int("ELASTICSEARCH_MAX_CHUNK_SIZE", default=2000)
+ELASTICSEARCH_MAX_CHUNK_BYTES = env.int("ELASTICSEARCH_MAX_CHUNK_BYTES", default=5 * 1024 * 1024)
+ELASTICSEARCH_TARGET_LATENCY = env.float("ELASTICSEARCH_TARGET_LATENCY", default=0.5)
+ELASTICSEARCH_BACKFILL_CHUNK_SIZE = env.int("ELASTICSEARCH_BACKFILL_CHUNK_SIZE", default=500)
+ELASTICSEARCH_BACKFILL_MAX_CHUNK_SIZE = env.int("ELASTICSEARCH_BACKFILL_MAX_CHUNK_SIZE", default=10000)
+ELASTICSEARCH_BACKFILL_MAX_CHUNK_BYTES = env.int("ELASTICSEARCH_BACKFILL_MAX_CHUNK_BYTES", default=20 * 1024 * 1024)
+ELASTICSEARCH_BACKFILL_TARGET_LATENCY = env.float("ELASTICSEARCH_BACKFILL_TARGET_LATENCY", default=2)
+# seconds to back off before the first retry of actions rejected with a 429, doubling up to the max for each retry
+ELASTICSEARCH_INITIAL_BACKOFF = env.float("ELASTICSEARCH_INITIAL_BACKOFF", default=1)
+ELASTICSEARCH_MAX_BACKOFF = env.float("ELASTICSEARCH_MAX_BACKOFF", default=60)
+
+ELASTICSEARCH_SYNC_BATCHING: dict[str, Any] = dict(
     chunk_size=ELASTICSEARCH_CHUNK_SIZE,
+    min_chunk_size=ELASTICSEARCH_MIN_CHUNK_SIZE,
+    max_chunk_size=ELASTICSEARCH_MAX_CHUNK_SIZE,
+    max_chunk_bytes=ELASTICSEARCH_MAX_CHUNK_BYTES,
+    target_latency=ELASTICSEARCH_TARGET_LATENCY,
     max_retries=ELASTICSEARCH_MAX_RETRIES,
+    initial_backoff=ELASTICSEARCH_INITIAL_BACKOFF,
+    max_backoff=ELASTICSEARCH_MAX_BACKOFF,
     raise_on_error=ELASTICSEARCH_RAISE_ON_ERROR,
     raise_on_exception=ELASTICSEARCH_RAISE_ON_EXCEPTION,
 )
+ELASTICSEARCH_BACKFILL_BATCHING: dict[str, Any] = dict(
+    ELASTICSEARCH_SYNC_BATCHING,
+    chunk_size=ELASTICSEARCH_BACKFILL_CHUNK_SIZE,
+    max_chunk_size=ELASTICSEARCH_BACKFILL_MAX_CHUNK_SIZE,
+    max_chunk_bytes=ELASTICSEARCH_BACKFILL_MAX_CHUNK_BYTES,
+    target_latency=ELASTICSEARCH_BACKFILL_TARGET_LATENCY,
+)
 
 # Postgres:
 PGHOST = env.str("PGHOST", default="localhost")
@@ -48,6 +140,10 @@ PGSSLMODE = env.str("PGSSLMODE", default=None)
 PGSSLROOTCERT = env.str("PGSSLROOTCERT", default=None)
 PGUSER = env.str("PGUSER")
 PGCHUNK_SIZE = env.int("PGCHUNK_SIZE", default=2000)
+# size of the Postgres connection pool shared by all threads, and how long to wait for a free connection in seconds
+PGPOOL_MIN_SIZE = env.int("PGPOOL_MIN_SIZE", default=1)
+PGPOOL_MAX_SIZE = env.int("PGPOOL_MAX_SIZE", default=10)
+PGPOOL_TIMEOUT = env.float("PGPOOL_TIMEOUT", default=300)
 
 logging.config.dictConfig(
     {
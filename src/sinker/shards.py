@@ -0,0 +1,97 @@
+"""Splits the views between Sinker workers, each of which owns a shard of them with its own slot and todo tables."""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from .settings import (
+    SINKER_NOTIFY_CHANNEL,
+    SINKER_PUBLICATION,
+    SINKER_REPLICATION_SLOT,
+    SINKER_SHARDS,
+    SINKER_TODO_KEYS_TABLE,
+    SINKER_TODO_TABLE,
+)
+
+
+@dataclass(frozen=True)
+class Shard:
+    """
+    One of the count shards that the views are split into. Each shard has its own replication slot, publication, todo
+    tables and notification channel, named after the configured ones with the shard number appended. A single shard
+    keeps the configured names as they are.
+    """
+
+    number: int = 0
+    count: int = 1
+
+    def name(self, base: str) -> str:
+        return base if self.count <= 1 else f"{base}_{self.number}"
+
+    @property
+    def slot(self) -> str:
+        return self.name(SINKER_REPLICATION_SLOT)
+
+    @property
+    def publication(self) -> str:
+        return self.name(SINKER_PUBLICATION)
+
+    @property
+    def todo_table(self) -> str:
+        return self.name(SINKER_TODO_TABLE)
+
+    @property
+    def todo_keys_table(self) -> str:
+        return self.name(SINKER_TODO_KEYS_TABLE)
+
+    @property
+    def channel(self) -> str:
+        return self.name(SINKER_NOTIFY_CHANNEL)
+
+    def owns(self, view: str, assignments: Optional[dict[str, int]] = None) -> bool:
+        """
+        :param view: The view
+        :param assignments: The shards that views are explicitly assigned to, overriding the hashing
+        """
+        if assignments and view in assignments:
+            return assignments[view] == self.number
+        return owner(view, self.count) == self.number
+
+
+def owner(view: str, count: int = SINKER_SHARDS) -> int:
+    """
+    Picks the shard of a view by rendezvous hashing: the view goes to the shard with the highest hash of the pair.
+    Changing the number of shards only moves the views that the new shards win (or the removed shards held).
+    :return: The shard number
+    """
+    return max(
+        range(max(count, 1)), key=lambda shard: hashlib.blake2b(f"{shard}:{view}".encode(), digest_size=8).digest()
+    )
+
+
+def shard_of(view: str, assignments: Optional[dict[str, int]] = None, count: int = SINKER_SHARDS) -> Shard:
+    """
+    :return: The shard that owns the view
+    """
+    if assignments and view in assignments:
+        return Shard(assignments[view], count)
+    return Shard(owner(view, count), count)
+
+
+def load_assignments(path: str, count: int = SINKER_SHARDS) -> dict[str, int]:
+    """
+    Reads the optional shards.json definition file, which maps views to the shard they should go to e.g.
+        {"course_mv": 0, "person_mv": 1}
+    :param path: The path of the file
+    :param count: The number of shards
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        assignments: dict[str, int] = json.load(f)
+    for view, shard in assignments.items():
+        if not isinstance(shard, int) or not 0 <= shard < count:
+            raise ValueError(f"The shard of {view} must be between 0 and {count - 1}, not {shard}")
+    return assignments
@@ -1,38 +1,65 @@
+import concurrent
+import hashlib
 import json
 import logging
 import os
-from typing import Iterable, Dict, Any
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import monotonic
+from typing import Iterable, Iterator, Dict, Any, Optional
 
 import psycopg
-from elasticsearch.helpers import bulk
 
 import sinker.query_templates as q
+from . import metrics
+from .batcher import AdaptiveBatcher
+from .decoders import PgOutputDecoder
 from .es import get_client
+from .pg import RawTextLoader, get_pool
+from .pipeline import Pipeline
 from .settings import (
     SINKER_DEFINITIONS_PATH,
     DEFAULT_SCHEMA,
     SINKER_SCHEMA,
-    SINKER_TODO_TABLE,
-    ELASTICSEARCH_BULK_KWARGS,
+    SINKER_DEFINITIONS_TABLE,
+    SINKER_INCREMENTAL,
+    SINKER_OUTPUT_PLUGIN,
+    SINKER_BACKFILL_PARTITIONS,
+    SINKER_DIGEST_FIELD,
+    SINKER_FORCE_MERGE_SEGMENTS,
+    ELASTICSEARCH_BACKFILL_BATCHING,
+    ELASTICSEARCH_BULK_THREADS,
     PGCHUNK_SIZE,
     SCHEMA_TABLE_DELIMITER,
 )
-from .utils import parse_schema_tables
+from .shards import Shard
+from .utils import MAX_IDENTIFIER_BYTES, bounded_identifier, digested_doc, parse_schema_tables
 
 logger = logging.getLogger(__name__)
 
 BACKFILL_CURSOR_NAME = "backfill"
+# seconds between progress reports while backfilling a partition
+BACKFILL_PROGRESS_INTERVAL = 30
 
 
 class Sinker:
-    def __init__(self, view: str, index: str):
+    def __init__(self, view: str, index: str, shard: Shard = Shard()):
         """
         :param view: Postgres materialized view name
         :param index: Elasticsearch index name
+        :param shard: The shard the view belongs to, whose todo tables its triggers record changes in
         """
         self.view: str = view
         self.index: str = index
+        self.shard: Shard = shard
         self.parent_table: str = ""  # defined during setup process
+        self.view_select_query: str = ""  # defined during setup process
+        self.id_type: str = "text"  # defined during setup process in incremental mode
+        # the hash of the definitions the view and index were set up from, as far as this process knows
+        self.built_hash: Optional[str] = None
+        # whether a refresh found the view set up again from changed definitions by another process
+        self.redefined: bool = False
 
     def setup(self) -> str:
         """
@@ -40,50 +67,266 @@ class Sinker:
         """
         self.setup_pg()
         self.setup_es()
+        self.save_definition_hash()
         return self.view
 
+    def definition_files(self) -> list[str]:
+        return [
+            os.path.join(os.getcwd(), SINKER_DEFINITIONS_PATH, file_name)
+            for file_name in (f"{self.view}.sql", f"{self.view}.keys.json", f"{self.index}.json")
+        ]
+
+    def definition_hash(self) -> str:
+        """
+        :return: A hash of everything the view and index are built from: their definition files and the view mode
+        """
+        definition_hash = hashlib.sha256(f"{self.view}:{self.index}:incremental={SINKER_INCREMENTAL}".encode())
+        if self.shard.count > 1:
+            # the triggers record changes in the todo tables of the shard, so a view that moves needs setting up again
+            definition_hash.update(f":shard={self.shard.number}/{self.shard.count}".encode())
+        for path in self.definition_files():
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    definition_hash.update(os.path.basename(path).encode())
+                    definition_hash.update(f.read())
+        return definition_hash.hexdigest()
+
+    def save_definition_hash(self) -> None:
+        definition_hash: str = self.definition_hash()
+        with get_pool().connection() as conn:
+            conn.execute(
+                q.SAVE_DEFINITION_HASH.format(SINKER_SCHEMA, SINKER_DEFINITIONS_TABLE),
+                {"view": self.view, "hash": definition_hash},
+            )
+        self.built_hash = definition_hash
+
+    def is_current(self) -> bool:
+        """
+        :return: Whether the view and index were set up from the current definitions and still exist, so that they
+        can be resumed instead of rebuilt
+        """
+        schema_view_name: str = f"{SINKER_SCHEMA}.{self.view}"
+        with get_pool().connection() as conn:
+            # nothing has been set up in a fresh schema, not even the definitions table
+            definitions_tuple = conn.execute(
+                q.GET_RELKIND.format(f"{SINKER_SCHEMA}.{SINKER_DEFINITIONS_TABLE}")
+            ).fetchone()
+            if not definitions_tuple or definitions_tuple[0] is None:
+                logger.info(f"The {self.view} view hasn't been set up")
+                return False
+            hash_tuple = conn.execute(
+                q.GET_DEFINITION_HASH.format(SINKER_SCHEMA, SINKER_DEFINITIONS_TABLE), {"view": self.view}
+            ).fetchone()
+            relkind_tuple = conn.execute(q.GET_RELKIND.format(schema_view_name)).fetchone()
+        if not hash_tuple or hash_tuple[0] != self.definition_hash():
+            logger.info(f"The {self.view} definitions have changed")
+            return False
+        if not relkind_tuple or relkind_tuple[0] is None or not get_client().indices.exists_alias(name=self.index):
+            logger.info(f"The {self.view} view or {self.index} index is missing")
+            return False
+        self.built_hash = hash_tuple[0]
+        return True
+
+    def load_definition(self) -> str:
+        """
+        Reads the view's SQL definition and derives the parent table from it, and in incremental mode looks up the
+        type of the view table's IDs if it exists
+        :return: The view's select query as written in the definition file
+        """
+        view_sql_path: str = os.path.join(os.getcwd(), SINKER_DEFINITIONS_PATH, f"{self.view}.sql")
+        with open(view_sql_path, "r") as f:
+            view_select_query: str = f.read()
+        # the query gets embedded in other statements, so drop any trailing semicolon
+        self.view_select_query = view_select_query.strip().rstrip(";")
+        self.parent_table, _ = parse_schema_tables(view_select_query)
+        if SINKER_INCREMENTAL:
+            with get_pool().connection() as conn:
+                id_type_tuple = conn.execute(q.GET_ID_TYPE.format(f"{SINKER_SCHEMA}.{self.view}")).fetchone()
+            if id_type_tuple:
+                self.id_type = id_type_tuple[0]
+        return view_select_query
+
     def setup_es(self) -> None:
+        """
+        Builds the index into a new versioned index (e.g. courses_v17) and then atomically points the index name, which
+        is an alias, at it. Searches keep hitting the previous version until the new one is fully populated.
+        """
         logger.info(f"Setting up the {self.index} Elasticsearch index")
-        self.recreate_index()
-        self.backfill_index()
+        versioned_index: str = self.create_versioned_index()
+        self.backfill_index(versioned_index)
+        self.finish_versioned_index(versioned_index)
+        self.swap_alias(versioned_index)
 
-        # optionally enable ES replicas here
+    def backfill_index(self, index: Optional[str] = None) -> None:
+        """
+        Populates the ES index with initial data from the materialized view, one partition of its pages per thread
+        :param index: The concrete index to populate, defaults to the index alias
+        """
+        index = index or self.index
+        logger.info(
+            f"Populating {index} with initial data from {self.view} in {SINKER_BACKFILL_PARTITIONS} partition(s)"
+        )
+        # the partitions share a batcher, since they all load the same index
+        batcher = AdaptiveBatcher(**ELASTICSEARCH_BACKFILL_BATCHING)
+        ranges: list[Optional[tuple[int, Optional[int]]]] = [None]
+        if SINKER_BACKFILL_PARTITIONS > 1:
+            with get_pool().connection() as conn:
+                blocks_tuple = conn.execute(q.GET_BLOCK_COUNT.format(f"{SINKER_SCHEMA}.{self.view}")).fetchone()
+            ranges = list(block_ranges(blocks_tuple[0] if blocks_tuple else 0, SINKER_BACKFILL_PARTITIONS))
+        with ThreadPoolExecutor(max_workers=SINKER_BACKFILL_PARTITIONS) as executor:
+            futures = [
+                executor.submit(self.backfill_partition, partition, index, batcher, blocks)
+                for partition, blocks in enumerate(ranges)
+            ]
+            added_docs: int = sum(future.result() for future in concurrent.futures.as_completed(futures))
+        logger.info(f"Added {added_docs} documents to {index}")
+
+    def backfill_partition(
+        self,
+        partition: int,
+        index: str,
+        batcher: Optional[AdaptiveBatcher] = None,
+        blocks: Optional[tuple[int, Optional[int]]] = None,
+    ) -> int:
+        """
+        Ships one partition of the view to Elasticsearch with ELASTICSEARCH_BULK_THREADS concurrent bulk senders,
+        logging progress and throughput
+        :param partition: The partition number, from 0 to SINKER_BACKFILL_PARTITIONS - 1
+        :param index: The concrete index to populate
+        :param batcher: Sizes the bulk requests, defaults to one with the backfill profile
+        :param blocks: The partition's range of the view's pages (see block_ranges), or None for the whole view
+        :return: The number of documents added
+        """
+        name: str = f"{index} partition {partition + 1}/{SINKER_BACKFILL_PARTITIONS}"
+        start: float = monotonic()
+
+        def progress(actions: Iterable[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+            # the senders' queues are bounded, so the docs read so far are a close estimate of the docs added
+            read_docs: int = 0
+            last_progress: float = start
+            for action in actions:
+                yield action
+                read_docs += 1
+                if read_docs % PGCHUNK_SIZE == 0 and monotonic() - last_progress >= BACKFILL_PROGRESS_INTERVAL:
+                    last_progress = monotonic()
+                    logger.info(
+                        f"Added ~{read_docs} documents to {name} ({read_docs / (last_progress - start):.0f} docs/s)"
+                    )
 
-    def backfill_index(self) -> None:
-        # populate ES index with initial data from materialized view
-        logger.info(f"Populating {self.index} with initial data from {self.view}")
-        added_docs, _ = bulk(
-            client=get_client(), actions=self.backfill_stream(), stats_only=False, **ELASTICSEARCH_BULK_KWARGS
+        pipeline = Pipeline(
+            get_client(),
+            senders=ELASTICSEARCH_BULK_THREADS,
+            batcher=batcher or AdaptiveBatcher(**ELASTICSEARCH_BACKFILL_BATCHING),
         )
-        logger.info(f"Added {added_docs} documents to {self.index}")
+        added_docs: int = pipeline.ship(progress(self.backfill_stream(blocks, index)))
+        elapsed: float = monotonic() - start
+        logger.info(
+            f"Added {added_docs} documents to {name} in {elapsed:.1f}s ({added_docs / max(elapsed, 1e-3):.0f} docs/s)"
+        )
+        return added_docs
 
-    def backfill_stream(self) -> Iterable[Dict[str, Any]]:
+    def backfill_stream(
+        self, blocks: Optional[tuple[int, Optional[int]]] = None, index: Optional[str] = None
+    ) -> Iterable[Dict[str, Any]]:
         """
         Uses a server-side cursor to stream the data from Postgres in PGCHUNK_SIZE chunks, yielding an Elasticsearch
         bulk "index" action for each row.
+        :param blocks: The first page of the view to stream and the page to stop at (None for the end of the view), or
+            None for the whole view
+        :param index: The concrete index to populate, defaults to the index alias
         """
+        index = index or self.index
         schema_view_name: str = f"{SINKER_SCHEMA}.{self.view}"
         query: str = q.BACKFILL_QUERY.format(schema_view_name)
+        if blocks is not None:
+            start, end = blocks
+            query = q.BACKFILL_PARTITION_QUERY.format(schema_view_name, start) + (
+                q.BACKFILL_PARTITION_END.format(end) if end is not None else ""
+            )
+        # a backfill holds its connection for as long as it streams the view, so it gets a dedicated one rather than
+        # tying up a pooled connection that the refreshes need
         with psycopg.connect() as conn:
             with conn.cursor(name=BACKFILL_CURSOR_NAME) as cursor:
+                cursor.adapters.register_loader("text", RawTextLoader)
                 cursor.itersize = PGCHUNK_SIZE
                 cursor.execute(query)
                 for doc_id, doc in cursor:
-                    yield {"_id": doc_id, "_index": self.index, "_source": doc}
+                    if doc is None:
+                        # there is nothing to index for a NULL doc
+                        continue
+                    if isinstance(doc_id, bytes):
+                        # text IDs get loaded raw too
+                        doc_id = doc_id.decode()
+                    yield {"_id": doc_id, "_index": index, "_source": digested_doc(doc_id, doc)}
 
-    def recreate_index(self) -> None:
-        es = get_client()
+    def index_body(self) -> dict[str, Any]:
         # read Elasticsearch index definition file
         index_mapping_path: str = os.path.join(os.getcwd(), SINKER_DEFINITIONS_PATH, f"{self.index}.json")
         with open(index_mapping_path, "r") as f:
-            index_body = json.load(f)
-            # (re)create index in Elasticsearch
-            es.indices.delete(index=self.index, ignore_unavailable=True)
-            es.indices.create(
-                index=self.index,
-                mappings=index_body["mappings"],
-                settings=index_body["settings"],
-            )
+            return json.load(f)
+
+    def versions(self) -> dict[str, int]:
+        """
+        :return: The existing versioned indices behind the index alias, keyed by name
+        """
+        version_re = re.compile(rf"^{re.escape(self.index)}_v(\d+)$")
+        indices: Iterable[str] = get_client().indices.get(index=f"{self.index}_v*", expand_wildcards="all").keys()
+        return {index: int(match.group(1)) for index in indices if (match := version_re.match(index))}
+
+    def create_versioned_index(self) -> str:
+        """
+        Creates the next version of the index with refreshes and replicas disabled for a fast bulk load
+        :return: The versioned index name
+        """
+        versioned_index: str = f"{self.index}_v{max(self.versions().values(), default=0) + 1}"
+        index_body: dict[str, Any] = self.index_body()
+        settings: dict[str, Any] = flatten_settings(index_body["settings"])
+        settings.update({"index.refresh_interval": "-1", "index.number_of_replicas": 0})
+        mappings: dict[str, Any] = index_body["mappings"]
+        # the digests that reconciling sums up, of which only the ID hashes get queried
+        if SINKER_DIGEST_FIELD:
+            mappings.setdefault("properties", {})[SINKER_DIGEST_FIELD] = {
+                "properties": {"id": {"type": "long"}, "doc": {"type": "long", "index": False}}
+            }
+        get_client().indices.create(index=versioned_index, mappings=mappings, settings=settings)
+        return versioned_index
+
+    def finish_versioned_index(self, versioned_index: str) -> None:
+        """
+        Optionally force-merges the freshly loaded index and restores the refresh interval and replicas from the
+        index definition (or the Elasticsearch defaults)
+        """
+        es = get_client()
+        es.indices.refresh(index=versioned_index)
+        if SINKER_FORCE_MERGE_SEGMENTS > 0:
+            logger.info(f"Force-merging {versioned_index} to {SINKER_FORCE_MERGE_SEGMENTS} segment(s)")
+            es.indices.forcemerge(index=versioned_index, max_num_segments=SINKER_FORCE_MERGE_SEGMENTS)
+        settings: dict[str, Any] = flatten_settings(self.index_body()["settings"])
+        es.indices.put_settings(
+            index=versioned_index,
+            settings={
+                "index.refresh_interval": settings.get("index.refresh_interval"),
+                "index.number_of_replicas": settings.get("index.number_of_replicas"),
+            },
+        )
+
+    def swap_alias(self, versioned_index: str) -> None:
+        """
+        Atomically points the index alias at the given versioned index and deletes the previous versions
+        """
+        es = get_client()
+        actions: list[dict[str, Any]] = [{"add": {"index": versioned_index, "alias": self.index}}]
+        if es.indices.exists_alias(name=self.index):
+            for index in es.indices.get_alias(name=self.index).keys():
+                actions.insert(0, {"remove": {"index": index, "alias": self.index}})
+        elif es.indices.exists(index=self.index):
+            # a concrete index from before aliases were used is in the way
+            actions.insert(0, {"remove_index": {"index": self.index}})
+        es.indices.update_aliases(actions=actions)
+        logger.info(f"Pointed the {self.index} alias at {versioned_index}")
+        for index in self.versions().keys() - {versioned_index}:
+            logger.info(f"Deleting the previous {index} index")
+            es.indices.delete(index=index, ignore_unavailable=True)
 
     def setup_pg(self) -> None:
         """
@@ -93,43 +336,229 @@ class Sinker:
         logger.info(f"Setting up the {self.view} materialized view")
         ddl_list: list[str] = list()
         # read SQL view file
-        view_sql_path: str = os.path.join(os.getcwd(), SINKER_DEFINITIONS_PATH, f"{self.view}.sql")
-        with open(view_sql_path, "r") as f:
-            view_select_query: str = f.read()
+        view_select_query: str = self.load_definition()
         schema_view_name: str = f"{SINKER_SCHEMA}.{self.view}"
-        drop_view: str = q.DROP_VIEW.format(schema_view_name)
-        ddl_list.append(drop_view)
-        create_view: str = q.CREATE_VIEW.format(schema_view_name, view_select_query)
-        ddl_list.append(create_view)
-        create_index: str = q.CREATE_VIEW_INDEX.format(self.view, schema_view_name)
-        ddl_list.append(create_index)
+        ddl_list.extend(self.drop_view_ddl(schema_view_name))
+        if SINKER_INCREMENTAL:
+            ddl_list.append(q.CREATE_VIEW_TABLE.format(schema_view_name, view_select_query))
+            ddl_list.append(q.CREATE_VIEW_TABLE_KEY.format(schema_view_name))
+            if SINKER_OUTPUT_PLUGIN == PgOutputDecoder.plugin and self.publication_lists_tables():
+                ddl_list.append(q.ADD_PUBLICATION_TABLE.format(self.shard.publication, schema_view_name))
+        else:
+            create_view: str = q.CREATE_VIEW.format(schema_view_name, view_select_query)
+            ddl_list.append(create_view)
+            create_index: str = q.CREATE_VIEW_INDEX.format(self.view, schema_view_name)
+            ddl_list.append(create_index)
+            ddl_list.append(q.SET_VIEW_REPLICA_IDENTITY.format(schema_view_name))
         # Get constituent tables from SQL query and create function and triggers for them
-        plpgsql: str = f"{schema_view_name}_fn"
-        create_function: str = q.CREATE_FUNCTION.format(plpgsql, SINKER_SCHEMA, SINKER_TODO_TABLE, schema_view_name)
+        plpgsql: str = f"{SINKER_SCHEMA}.{bounded_identifier(self.view, '_fn')}"
+        create_function: str = q.CREATE_FUNCTION.format(
+            plpgsql, SINKER_SCHEMA, self.shard.todo_table, schema_view_name, channel=self.shard.channel
+        )
         ddl_list.append(create_function)
-        # The last table is the top-level table that gets DELETE events with an ID in the replication slot.
-        # The materialized views do not contain the ID of the doc being deleted,
-        # so we'll use this table's delete events as a proxy.
+        # The view's replica identity makes a refresh log the ID of each row it deletes, whether the parent row was
+        # deleted or the row no longer matches the view's filters, so deletes come from the view itself:
         # lsn,xid,data
-        # 0/24EDA4D8,17393,BEGIN 17393
-        # 0/24EDA4D8,17393,"table public.""Foo"": DELETE: id[text]:'91754ea9-2983-4cf7-bdf9-fc23d2386d90'"
-        # 0/24EDC1B0,17393,COMMIT 17393
         # 0/24EDC228,17394,BEGIN 17394
-        # 0/24EF0D60,17394,table sinker.foo_mv: DELETE: (no-tuple-data)
+        # 0/24EF0D60,17394,table sinker.foo_mv: DELETE: id[text]:'a-1' doc[jsonb]:'{"name": "Foo"}'
         # 0/24EF4718,17394,COMMIT 17394
+        # The last table is the top-level parent table, whose DELETE events served as a proxy for views set up without
+        # a replica identity.
         self.parent_table, schema_tables = parse_schema_tables(view_select_query)
+        key_queries: dict[str, str] = self.key_queries() if SINKER_INCREMENTAL else {}
         for schema_table in schema_tables:
             schema, _, table = schema_table.rpartition(SCHEMA_TABLE_DELIMITER)
             schema = schema or DEFAULT_SCHEMA
             trigger_name: str = f"{SINKER_SCHEMA}_{self.view}_{schema}_{table}"
-            create_trigger: str = q.CREATE_TRIGGER.format(trigger_name, schema, table, plpgsql)
-            ddl_list.append(create_trigger)
-        create_todo_entry: str = q.CREATE_TODO_ENTRY.format(SINKER_SCHEMA, SINKER_TODO_TABLE, schema_view_name)
+            trigger_function: str = plpgsql
+            if table in key_queries:
+                # only the rows of the view with the parent IDs selected by the key query need recomputing
+                trigger_function = f"{SINKER_SCHEMA}.{bounded_identifier(f'{self.view}_{schema}_{table}', '_fn')}"
+                insert_keys: dict[str, str] = {
+                    name: q.INSERT_KEYS.format(
+                        keys_table=f"{SINKER_SCHEMA}.{self.shard.todo_keys_table}",
+                        view=schema_view_name,
+                        changed=changed,
+                        key_query=key_queries[table],
+                    )
+                    for name, changed in (
+                        ("insert_keys_new", q.CHANGED_NEW),
+                        ("insert_keys_both", q.CHANGED_BOTH),
+                        ("insert_keys_old", q.CHANGED_OLD),
+                    )
+                }
+                ddl_list.append(
+                    q.CREATE_KEYS_FUNCTION.format(function=trigger_function, channel=self.shard.channel, **insert_keys)
+                )
+            # the name the row-level trigger got, which Postgres truncated if it was too long
+            row_trigger_name: str = trigger_name.encode()[:MAX_IDENTIFIER_BYTES].decode(errors="ignore")
+            ddl_list.append(q.DROP_ROW_TRIGGER.format(row_trigger_name, schema, table))
+            for event, referencing in q.TRIGGER_EVENTS.items():
+                ddl_list.append(
+                    q.CREATE_TRIGGER.format(
+                        name=bounded_identifier(trigger_name, f"_{event}"),
+                        event=event,
+                        schema=schema,
+                        table=table,
+                        # the todo function only needs to know that the table changed
+                        referencing=referencing if trigger_function != plpgsql else "",
+                        # a truncate has no rows to select keys from, so the whole view needs recomputing
+                        function=plpgsql if event == "truncate" else trigger_function,
+                    )
+                )
+        create_todo_entry: str = q.CREATE_TODO_ENTRY.format(SINKER_SCHEMA, self.shard.todo_table, schema_view_name)
         ddl_list.append(create_todo_entry)
-        psycopg.connect(autocommit=True).execute("; ".join(ddl_list))
+        # building the view takes as long as its query does, and all the views are set up at once, so the DDL gets a
+        # dedicated connection rather than holding pooled ones long enough for the others to time out waiting
+        with psycopg.connect(autocommit=True) as conn:
+            conn.execute("; ".join(ddl_list))
+        if SINKER_INCREMENTAL:
+            # now that the view table exists, look up the type of its IDs
+            self.load_definition()
+
+    def set_replica_identity(self) -> None:
+        """
+        Materialized views set up by earlier versions of Sinker have no replica identity, so their DELETE entries carry
+        no ID. Setting it only changes what gets logged from now on, without rewriting the view.
+        """
+        with get_pool().connection() as conn:
+            conn.execute(q.SET_VIEW_REPLICA_IDENTITY.format(f"{SINKER_SCHEMA}.{self.view}"))
+
+    def publication_lists_tables(self) -> bool:
+        """
+        :return: Whether the publication lists its tables, as opposed to publishing all tables, like the ones that
+        earlier versions of Sinker created and that are kept when resuming
+        """
+        with get_pool().connection() as conn:
+            all_tables_tuple = conn.execute(q.GET_PUBLICATION.format(self.shard.publication)).fetchone()
+        return all_tables_tuple is not None and not all_tables_tuple[0]
+
+    @staticmethod
+    def drop_view_ddl(schema_view_name: str) -> list[str]:
+        """
+        The view may be a materialized view or, in incremental mode, a regular table. Drop whichever one exists so
+        switching between the modes doesn't trip over the other kind of relation.
+        """
+        with get_pool().connection() as conn:
+            relkind_tuple = conn.execute(q.GET_RELKIND.format(schema_view_name)).fetchone()
+        if relkind_tuple and relkind_tuple[0] == "r":
+            return [q.DROP_TABLE.format(schema_view_name)]
+        return [q.DROP_VIEW.format(schema_view_name)]
+
+    def key_queries(self) -> dict[str, str]:
+        """
+        Incremental mode needs to know which parent IDs are affected by a change to a source table. For the parent
+        table it's simply the ID of the changed row. For any other table, the optional {view}.keys.json definition
+        file maps the table name to a query that selects the parent IDs from the "changed" relation, e.g.
+            {"enrollment": "select course_id from changed"}
+        Changes to tables without a key query fall back to recomputing the whole view.
+        """
+        key_queries: dict[str, str] = {self.parent_table: q.DEFAULT_KEY_QUERY}
+        keys_path: str = os.path.join(os.getcwd(), SINKER_DEFINITIONS_PATH, f"{self.view}.keys.json")
+        if os.path.exists(keys_path):
+            with open(keys_path, "r") as f:
+                key_queries.update(json.load(f))
+        return key_queries
 
     def refresh_view(self) -> str:
         logger.info(f"Refreshing the {self.view} materialized view")
+        if SINKER_INCREMENTAL:
+            with metrics.REFRESH_SECONDS.labels(view=self.view).time(), get_pool().connection() as conn:
+                with conn.transaction():
+                    conn.execute(q.WAIT_FOR_VIEW_REFRESHES.format(f"{SINKER_SCHEMA}.{self.view}"))
+                    self.check_definition(conn)
+                    conn.execute(self.refresh_rows_query(filtered=False))
+            return self.view
         refresh_view_query: str = q.REFRESH_VIEW.format(SINKER_SCHEMA, self.view)
-        psycopg.connect(autocommit=True).execute(refresh_view_query)
+        with metrics.REFRESH_SECONDS.labels(view=self.view).time(), get_pool().connection() as conn:
+            with conn.transaction():
+                conn.execute(q.WAIT_FOR_VIEW_REFRESHES.format(f"{SINKER_SCHEMA}.{self.view}"))
+                self.check_definition(conn)
+                conn.execute(refresh_view_query)
+        return self.view
+
+    def refresh_rows(self, ids: list[str]) -> str:
+        """
+        Recomputes only the rows of the view table with the given parent IDs (incremental mode)
+        :param ids: The IDs of the docs that may have changed, as text
+        """
+        logger.info(f"Refreshing {len(ids)} rows of the {self.view} view")
+        with metrics.REFRESH_SECONDS.labels(view=self.view).time(), get_pool().connection() as conn:
+            with conn.transaction():
+                conn.execute(q.WAIT_FOR_VIEW_REFRESHES.format(f"{SINKER_SCHEMA}.{self.view}"))
+                self.check_definition(conn)
+                conn.execute(self.refresh_rows_query(filtered=True), {"ids": ids})
         return self.view
+
+    def check_definition(self, conn: psycopg.Connection) -> None:
+        """
+        Another process, e.g. `sinker rebuild`, may have set the view up again from changed definitions since this
+        one loaded them. Called with the view's refreshes lock held, so the view isn't being set up at the same time.
+        The view's definition is then reloaded, so that incremental refreshes select the new rows, and the view is
+        flagged as redefined, so that what was cached of its docs is forgotten.
+        :param conn: The connection holding the lock
+        """
+        hash_tuple = conn.execute(
+            q.GET_DEFINITION_HASH.format(SINKER_SCHEMA, SINKER_DEFINITIONS_TABLE), {"view": self.view}
+        ).fetchone()
+        if not hash_tuple or hash_tuple[0] == self.built_hash:
+            return
+        if hash_tuple[0] != self.definition_hash():
+            raise RuntimeError(
+                f"The {self.view} view was set up from other definitions than the ones in {SINKER_DEFINITIONS_PATH}, "
+                "restart this worker with the definitions it was set up from"
+            )
+        logger.info(f"The {self.view} view was set up again from changed definitions, reloading them")
+        self.load_definition()
+        self.built_hash = hash_tuple[0]
+        self.redefined = True
+
+    @contextmanager
+    def holding_refreshes(self) -> Iterator[None]:
+        """
+        Holds off refreshing the view, e.g. by a running Sinker worker, until the block is done. The refreshes then pick
+        up the changes made in the meantime.
+        """
+        with psycopg.connect(autocommit=True) as conn:
+            conn.execute(q.LOCK_VIEW_REFRESHES.format(f"{SINKER_SCHEMA}.{self.view}"))
+            # closing the connection releases the lock
+            yield
+
+    def refresh_rows_query(self, filtered: bool) -> str:
+        # the view query is user-defined SQL, so escape any % before using it alongside query parameters
+        query: str = self.view_select_query.replace("%", "%%") if filtered else self.view_select_query
+        return q.REFRESH_ROWS.format(
+            query=query,
+            view=f"{SINKER_SCHEMA}.{self.view}",
+            filter=q.ROWS_FILTER.format(self.id_type) if filtered else "",
+            filter_dst=q.ROWS_FILTER_DST.format(self.id_type) if filtered else "",
+        )
+
+
+def block_ranges(blocks: int, partitions: int) -> Iterable[tuple[int, Optional[int]]]:
+    """
+    Splits a relation's pages into consecutive ranges of about the same size, e.g. 10 pages in 3 partitions ->
+        (0, 3), (3, 6), (6, None)
+    :param blocks: The number of pages of the relation
+    :param partitions: The number of ranges
+    :return: The first page of each range and the page it stops at, None for the last range, which has no end
+    """
+    for partition in range(partitions):
+        end: Optional[int] = blocks * (partition + 1) // partitions if partition < partitions - 1 else None
+        yield blocks * partition // partitions, end
+
+
+def flatten_settings(settings: dict[str, Any], prefix: str = "") -> dict[str, Any]:
+    """
+    Flattens nested index settings into dotted keys with the "index." prefix, e.g.
+        {"index": {"number_of_replicas": "0"}} -> {"index.number_of_replicas": "0"}
+    so that they can be overridden regardless of how the index definition nests them
+    """
+    flattened: dict[str, Any] = {}
+    for key, value in settings.items():
+        if isinstance(value, dict):
+            flattened.update(flatten_settings(value, f"{prefix}{key}."))
+        else:
+            flat_key: str = f"{prefix}{key}"
+            flattened[flat_key if flat_key.startswith("index.") else f"index.{flat_key}"] = value
+    return flattened
@@ -0,0 +1,289 @@
+"""
+Durable on-disk spool of bulk actions, which decouples draining the replication slot from shipping to Elasticsearch.
+"""
+
+import json
+import logging
+import mmap
+import os
+import threading
+import zlib
+from struct import Struct
+from time import sleep
+from typing import Any, Dict, Iterable, Optional
+
+from elasticsearch import ConnectionError, ConnectionTimeout
+
+from . import metrics
+from .pipeline import Pipeline
+
+logger = logging.getLogger(__name__)
+
+# each record is the length and CRC32 of its payload, followed by the payload
+RECORD_HEADER = Struct("!II")
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT_FILE = "checkpoint"
+
+# a position in the spool: the segment number and the offset in the segment
+Position = tuple[int, int]
+
+
+def encode(action: Dict[str, Any]) -> bytes:
+    """
+    :return: The action's metadata as JSON, followed by a newline and the doc's JSON text if it has one
+    """
+    metadata: bytes = json.dumps({key: value for key, value in action.items() if key != "_source"}).encode()
+    source = action.get("_source")
+    if source is None:
+        return metadata
+    if isinstance(source, str):
+        source = source.encode()
+    elif not isinstance(source, bytes):
+        source = json.dumps(source).encode()
+    return metadata + b"\n" + source
+
+
+def decode(payload: bytes) -> Dict[str, Any]:
+    metadata, newline, source = payload.partition(b"\n")
+    action: Dict[str, Any] = json.loads(metadata)
+    if newline:
+        # the doc is passed on to Elasticsearch as JSON text
+        action["_source"] = source
+    return action
+
+
+class Spool:
+    """
+    An append-only log of bulk actions in numbered segment files. Actions are appended as they are drained from the
+    replication slot, with an fsync per append rather than per action, and read back by a SpoolShipper, which commits a
+    checkpoint once Elasticsearch has acknowledged them. Segments are read memory-mapped, and deleted once the
+    checkpoint is past them. A record torn by a crash in the middle of an append fails its CRC and is truncated away
+    when the spool is opened again, and its actions are read from the replication slot again, which was only advanced
+    past them after the append.
+    """
+
+    def __init__(self, path: str, segment_bytes: int, max_bytes: int = 0):
+        """
+        :param path: The directory of the spool
+        :param segment_bytes: The size beyond which appends go to a new segment
+        :param max_bytes: The size of unshipped actions beyond which the spool counts as full, 0 for no limit
+        """
+        self.path: str = path
+        self.segment_bytes: int = segment_bytes
+        self.max_bytes: int = max_bytes
+        # guards the positions, and is notified when actions are appended
+        self._changed = threading.Condition()
+        os.makedirs(path, exist_ok=True)
+        segments: list[int] = self._segments()
+        self.checkpoint: Position = self._read_checkpoint() or ((segments[0] if segments else 0), 0)
+        segment: int = segments[-1] if segments else self.checkpoint[0]
+        self.end: Position = (segment, self._recover(segment))
+        self._file = open(self._segment_path(segment), "ab")
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def _segments(self) -> list[int]:
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)]) for name in os.listdir(self.path) if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _read_checkpoint(self) -> Optional[Position]:
+        checkpoint_path: str = os.path.join(self.path, CHECKPOINT_FILE)
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, "r") as f:
+            segment, offset = f.read().split()
+        return int(segment), int(offset)
+
+    def _recover(self, segment: int) -> int:
+        """
+        Truncates the segment after its last intact record
+        :return: The size of the segment
+        """
+        segment_path: str = self._segment_path(segment)
+        if not os.path.exists(segment_path):
+            return 0
+        size: int = os.path.getsize(segment_path)
+        offset: int = 0
+        if size:
+            with open(segment_path, "rb") as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                while offset + RECORD_HEADER.size <= size:
+                    length, crc = RECORD_HEADER.unpack_from(data, offset)
+                    payload_end: int = offset + RECORD_HEADER.size + length
+                    if payload_end > size or zlib.crc32(data[offset + RECORD_HEADER.size : payload_end]) != crc:
+                        break
+                    offset = payload_end
+        if offset < size:
+            logger.warning(f"Truncating {size - offset} bytes of a torn record from spool segment {segment}")
+            os.truncate(segment_path, offset)
+        return offset
+
+    def _sync(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _sync_directory(self) -> None:
+        directory: int = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def append(self, actions: Iterable[Dict[str, Any]]) -> int:
+        """
+        Appends the actions and makes them durable
+        :return: The number of actions appended
+        """
+        appended: int = 0
+        segment, size = self.end
+        for action in actions:
+            payload: bytes = encode(action)
+            if size and size + RECORD_HEADER.size + len(payload) > self.segment_bytes:
+                self._sync()
+                self._file.close()
+                segment, size = segment + 1, 0
+                self._file = open(self._segment_path(segment), "ab")
+                self._sync_directory()
+                # the previous segment is complete and durable, so it can be shipped while this one fills up
+                with self._changed:
+                    self.end = (segment, 0)
+                    self._changed.notify_all()
+            self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            size += RECORD_HEADER.size + len(payload)
+            appended += 1
+        self._sync()
+        with self._changed:
+            self.end = (segment, size)
+            self._changed.notify_all()
+        return appended
+
+    def read(self, start: Position, max_actions: int) -> tuple[list[Dict[str, Any]], Position]:
+        """
+        :param start: The position to read from
+        :param max_actions: The max number of actions to read
+        :return: The actions, and the position after them
+        """
+        with self._changed:
+            end: Position = self.end
+        actions: list[Dict[str, Any]] = []
+        segment, offset = start
+        while len(actions) < max_actions and (segment, offset) < end:
+            segment_path: str = self._segment_path(segment)
+            limit: int = end[1] if segment == end[0] else os.path.getsize(segment_path)
+            if offset < limit:
+                with open(segment_path, "rb") as f, mmap.mmap(f.fileno(), limit, access=mmap.ACCESS_READ) as data:
+                    while offset < limit and len(actions) < max_actions:
+                        length, _ = RECORD_HEADER.unpack_from(data, offset)
+                        offset += RECORD_HEADER.size
+                        actions.append(decode(data[offset : offset + length]))
+                        offset += length
+            if offset >= limit and segment < end[0]:
+                segment, offset = segment + 1, 0
+        return actions, (segment, offset)
+
+    def commit(self, position: Position) -> None:
+        """
+        Records that the actions before the position have been shipped, and deletes the segments before it
+        """
+        checkpoint_path: str = os.path.join(self.path, CHECKPOINT_FILE)
+        with open(f"{checkpoint_path}.tmp", "w") as f:
+            f.write(f"{position[0]} {position[1]}")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+        self._sync_directory()
+        with self._changed:
+            self.checkpoint = position
+        for segment in self._segments():
+            if segment < position[0]:
+                os.remove(self._segment_path(segment))
+
+    def pending_bytes(self) -> int:
+        """
+        :return: The size of the actions that haven't been shipped yet
+        """
+        with self._changed:
+            (start_segment, start_offset), (end_segment, end_offset) = self.checkpoint, self.end
+        full_segments: int = sum(
+            os.path.getsize(self._segment_path(segment)) for segment in range(start_segment, end_segment)
+        )
+        return full_segments - start_offset + end_offset
+
+    def full(self) -> bool:
+        return bool(self.max_bytes) and self.pending_bytes() >= self.max_bytes
+
+    def clear(self) -> None:
+        """
+        Drops any unshipped actions, e.g. those for indices that are being rebuilt
+        """
+        self._file.close()
+        segment: int = self.end[0] + 1
+        self._file = open(self._segment_path(segment), "ab")
+        with self._changed:
+            self.end = (segment, 0)
+        self.commit(self.end)
+
+    def wait(self, timeout: float) -> None:
+        """
+        Blocks until there are unshipped actions, or for the timeout at most
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.checkpoint < self.end, timeout=timeout)
+
+
+class SpoolShipper(threading.Thread):
+    """
+    Ships the actions in the spool to Elasticsearch in order, committing a checkpoint after each acknowledged batch.
+    While Elasticsearch can't be reached, the actions stay in the spool and the shipper retries with backoff. Any
+    other error stops the shipper, and is left for the runner to raise.
+    """
+
+    def __init__(self, spool: Spool, pipeline: Pipeline, batch_size: int, poll_interval: float):
+        super().__init__(name="spool-shipper", daemon=True)
+        self.spool: Spool = spool
+        self.pipeline: Pipeline = pipeline
+        self.batch_size: int = batch_size
+        self.poll_interval: float = poll_interval
+        self.error: Optional[BaseException] = None
+
+    def ship_batch(self) -> int:
+        """
+        :return: The number of actions shipped, 0 if the spool is empty
+        """
+        actions, end = self.spool.read(self.spool.checkpoint, self.batch_size)
+        if not actions:
+            return 0
+        self.pipeline.ship(actions)
+        # a crash before the checkpoint means shipping these again, which leaves the docs the same
+        self.spool.commit(end)
+        return len(actions)
+
+    def drain(self) -> None:
+        """
+        Ships everything in the spool before returning
+        """
+        shipped: int = 0
+        while batch := self.ship_batch():
+            shipped += batch
+        if shipped:
+            logger.info(f"Shipped {shipped} spooled actions")
+
+    def run(self) -> None:
+        attempt: int = 0
+        while True:
+            try:
+                if not self.ship_batch():
+                    self.spool.wait(self.poll_interval)
+                attempt = 0
+            except (ConnectionError, ConnectionTimeout) as e:
+                metrics.RETRIES.labels(stage="spool").inc()
+                delay: float = self.pipeline.batcher.backoff(attempt)
+                logger.warning(f"Can't reach Elasticsearch ({e}), retrying spooled actions in {delay:.1f}s")
+                sleep(delay)
+                attempt += 1
+            except BaseException as e:
+                metrics.ERRORS.labels(stage="spool").inc()
+                self.error = e
+                return
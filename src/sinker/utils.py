@@ -1,8 +1,21 @@
-from typing import Set, Tuple
+import hashlib
+from typing import Any, Optional, Set, Tuple, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+import json
 
 import sqlglot
 from sqlglot.expressions import Table, CTE
 
+from .settings import SINKER_DIGEST_FIELD
+
+# Postgres truncates longer identifiers to this many bytes
+MAX_IDENTIFIER_BYTES = 63
+
 
 def parse_schema_tables(view_select_query: str) -> Tuple[str, Set[str]]:
     """
@@ -18,3 +31,108 @@ def parse_schema_tables(view_select_query: str) -> Tuple[str, Set[str]]:
     ctes = {cte.alias for cte in parsed.find_all(CTE)}
     schema_tables = tables - ctes
     return parent_table.name, schema_tables
+
+
+def bounded_identifier(name: str, suffix: str = "") -> str:
+    """
+    Postgres truncates identifiers to MAX_IDENTIFIER_BYTES, so long names that only differ in their suffix, like the
+    triggers of a table for each event, would all end up the same. A name that's too long keeps as much of its start as
+    fits before a hash of the whole name and the suffix, e.g.
+        sinker_course_mv_public_..._enrollment + _insert -> sinker_course_mv_public_..._enr_1a2b3c4d_insert
+    :param name: The name, which may be too long
+    :param suffix: The end of the name that must be kept
+    :return: The name as is if it fits
+    """
+    if len(f"{name}{suffix}".encode()) <= MAX_IDENTIFIER_BYTES:
+        return f"{name}{suffix}"
+    digest: str = hashlib.md5(name.encode()).hexdigest()[:8]
+    prefix: bytes = name.encode()[: MAX_IDENTIFIER_BYTES - len(suffix.encode()) - len(digest) - 1]
+    return f"{prefix.decode(errors='ignore')}_{digest}{suffix}"
+
+
+def ndjson_doc(doc: Union[str, bytes]) -> Union[str, bytes]:
+    """
+    Bulk requests are newline-delimited JSON, so a doc can be passed to Elasticsearch verbatim as long as it's on a
+    single line. That is always the case for jsonb, but json keeps any newlines from the view's query, in which case
+    the doc is re-serialized (with orjson, if it's installed).
+    :param doc: The doc as JSON text
+    :return: The doc as single-line JSON text
+    """
+    if isinstance(doc, bytes) and b"\n" not in doc or isinstance(doc, str) and "\n" not in doc:
+        return doc
+    if orjson is not None:
+        return orjson.dumps(orjson.loads(doc))
+    return json.dumps(json.loads(doc), separators=(",", ":"))
+
+
+def md5_prefix(text: Union[str, bytes]) -> int:
+    """
+    :return: The first 32 bits of the MD5 of the text, which Postgres computes as
+        ('x' || substr(md5(text), 1, 8))::bit(32)::bigint
+    """
+    return int.from_bytes(hashlib.md5(text.encode() if isinstance(text, str) else text).digest()[:4], "big")
+
+
+def digested_doc(doc_id: Any, doc: Union[str, bytes]) -> Union[str, bytes]:
+    """
+    Adds the hash of the doc's ID and the digest of its text to the doc, in the SINKER_DIGEST_FIELD object, so that
+    reconciling can sum them up in Elasticsearch rather than reading every doc. The field is spliced into the JSON text
+    rather than re-serializing the doc, e.g.
+        '{"name": "Foo"}' -> '{"sinker_digest":{"id":1234,"doc":5678},"name": "Foo"}'
+    :param doc_id: The doc's ID, as Postgres prints it
+    :param doc: The doc as JSON text, as Postgres prints it
+    :return: The doc with the digest field as single-line JSON text, or just the doc if SINKER_DIGEST_FIELD is unset
+    """
+    if not SINKER_DIGEST_FIELD:
+        return ndjson_doc(doc)
+    field: str = f'"{SINKER_DIGEST_FIELD}":{{"id":{md5_prefix(str(doc_id))},"doc":{md5_prefix(doc)}}}'
+    text: Union[str, bytes] = ndjson_doc(doc).lstrip()
+    if isinstance(text, bytes):
+        rest: bytes = text[1:].lstrip()
+        return b"{" + field.encode() + (b"" if rest.startswith(b"}") else b",") + rest
+    rest_text: str = text[1:].lstrip()
+    return "{" + field + ("" if rest_text.startswith("}") else ",") + rest_text
+
+
+def json_text(value: Any) -> Union[str, bytes]:
+    """
+    :return: The value as compact JSON text (serialized with orjson, if it's installed)
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"))
+
+
+def load_json(text: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def doc_diff(old: Any, new: Any) -> Optional[dict[str, Any]]:
+    """
+    Works out a partial doc for an Elasticsearch update, which merges objects field by field and replaces any other
+    value, including arrays, as a whole
+    :param old: The doc as it is
+    :param new: The doc as it should be
+    :return: The fields to merge into the old doc to get the new one, empty if they're the same, or None if merging
+    can't get there because a field was removed or the docs aren't objects
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return None
+    if any(key not in new for key in old):
+        return None
+    partial: dict[str, Any] = {}
+    for key, value in new.items():
+        if key not in old:
+            partial[key] = value
+        elif old[key] == value:
+            continue
+        elif isinstance(old[key], dict) and isinstance(value, dict):
+            nested: Optional[dict[str, Any]] = doc_diff(old[key], value)
+            if nested is None:
+                return None
+            partial[key] = nested
+        else:
+            partial[key] = value
+    return partial
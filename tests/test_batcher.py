@@ -0,0 +1,86 @@
+import pytest
+from elasticsearch.helpers import BulkIndexError
+
+from sinker.batcher import AdaptiveBatcher
+from sinker.settings import ELASTICSEARCH_SYNC_BATCHING
+
+
+def batcher(**kwargs) -> AdaptiveBatcher:
+    return AdaptiveBatcher(**{**ELASTICSEARCH_SYNC_BATCHING, "min_chunk_size": 1, **kwargs})
+
+
+def test_record_adapts_chunk_size() -> None:
+    adaptive = batcher(chunk_size=100, min_chunk_size=10, max_chunk_size=200, target_latency=1)
+    adaptive.record(actions=100, latency=0.1, rejected=False)
+    assert adaptive.chunk_size == 126
+    # a partial chunk says nothing about whether bigger chunks would be quick
+    adaptive.record(actions=5, latency=0.1, rejected=False)
+    assert adaptive.chunk_size == 126
+    for _ in range(5):
+        adaptive.record(actions=adaptive.chunk_size, latency=0.1, rejected=False)
+    assert adaptive.chunk_size == 200
+    adaptive.record(actions=200, latency=1.6, rejected=False)
+    assert adaptive.chunk_size == 125
+    adaptive.record(actions=125, latency=0.1, rejected=True)
+    assert adaptive.chunk_size == 62
+    for _ in range(5):
+        adaptive.record(actions=62, latency=0.1, rejected=True)
+    assert adaptive.chunk_size == 10
+
+
+def test_full_by_bytes() -> None:
+    adaptive = batcher(chunk_size=100, max_chunk_bytes=1000)
+    assert not adaptive.full(10, 999)
+    assert adaptive.full(10, 1000)
+    assert adaptive.full(100, 0)
+    assert adaptive.action_bytes({"_index": "foo_index", "_id": "a-1", "_source": '{"a": 1}'}) == 8
+    assert adaptive.action_bytes({"_op_type": "delete", "_index": "foo_index", "_id": "a-1"}) == 0
+
+
+def test_send_retries_rejected_actions(mocker) -> None:
+    sleep = mocker.patch("sinker.batcher.sleep")
+    sent = []
+
+    def streaming_bulk(client, actions, **kwargs):
+        sent.append([action["_id"] for action in actions])
+        # reject every other action the first time around
+        oks = [len(sent) > 1 or i % 2 == 0 for i in range(len(actions))]
+        return [(ok, {"index": {"status": 201 if ok else 429}}) for ok in oks]
+
+    mocker.patch("sinker.batcher.streaming_bulk", side_effect=streaming_bulk)
+    adaptive = batcher(chunk_size=4, initial_backoff=1, max_backoff=10)
+    actions = [{"_index": "foo_index", "_id": str(i), "_source": "{}"} for i in range(4)]
+    assert adaptive.send(None, actions) == 4
+    assert sent == [["0", "1", "2", "3"], ["1", "3"]]
+    assert 0 <= sleep.call_args[0][0] <= 1
+    # halved by the rejections
+    assert adaptive.chunk_size < 4
+
+
+def test_send_raises_after_max_retries(mocker) -> None:
+    mocker.patch("sinker.batcher.sleep")
+    mocker.patch(
+        "sinker.batcher.streaming_bulk",
+        side_effect=lambda client, actions, **kwargs: [(False, {"index": {"status": 429}}) for _ in actions],
+    )
+    actions = [{"_index": "foo_index", "_id": str(i), "_source": "{}"} for i in range(4)]
+    with pytest.raises(BulkIndexError):
+        batcher(max_retries=2).send(None, actions)
+
+
+def test_send_counts_deletes_of_missing_docs_as_done(mocker) -> None:
+    mocker.patch(
+        "sinker.batcher.streaming_bulk",
+        side_effect=lambda client, actions, **kwargs: [(False, {"delete": {"status": 404}}) for _ in actions],
+    )
+    actions = [{"_op_type": "delete", "_index": "foo_index", "_id": str(i)} for i in range(2)]
+    assert batcher().send(None, actions) == 2
+
+
+def test_send_leaves_conflicting_actions_to_newer_changes(mocker) -> None:
+    mocker.patch(
+        "sinker.batcher.streaming_bulk",
+        side_effect=lambda client, actions, **kwargs: [(False, {"index": {"status": 409}}) for _ in actions],
+    )
+    actions = [{"_index": "foo_index", "_id": "a-1", "_source": "{}", "if_seq_no": 7, "if_primary_term": 1}]
+    assert batcher().send(None, actions) == 0
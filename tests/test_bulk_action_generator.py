@@ -1,25 +1,182 @@
 import pytest
+from elasticsearch.helpers import expand_action
 
-from sinker.bulk_action_generator import BulkActionGenerator
+from sinker.cache import DigestCache, DocCache
+
+from sinker.bulk_action_generator import BulkActionGenerator, coalesce
+from sinker.decoders import Change
+from sinker.settings import SINKER_SCHEMA
+from sinker.spool import decode, encode
+from sinker.utils import digested_doc
 
 
 @pytest.fixture
 def bulk_action_generator() -> BulkActionGenerator:
     v2i = dict(foo_mv="foo_index")
-    pt2i = dict(foo_table="foo_index")
-    return BulkActionGenerator(
-        views_to_indices=v2i,
-        parent_tables_to_indices=pt2i)
+    pt2i = dict(foo_table=["foo_index", "bar_index"])
+    return BulkActionGenerator(views_to_indices=v2i, parent_tables_to_indices=pt2i)
 
 
 def test_index_action(bulk_action_generator: BulkActionGenerator) -> None:
     doc = '{"name" : "Foo Bar"}'
-    slot_dict = dict(table="foo_mv", id="a-1")
-    expected = {"_index": "foo_index", "_id": "a-1", "_source": doc}
-    assert bulk_action_generator.index_action(doc, slot_dict) == expected
+    change = Change(schema="sinker", table="foo_mv", op="INSERT", id="a-1", doc=doc)
+    expected = {"_index": "foo_index", "_id": "a-1", "_source": digested_doc("a-1", doc)}
+    assert bulk_action_generator.index_action(change) == expected
+
+
+def test_delete_actions_fan_out_to_indices_of_parent_table(bulk_action_generator: BulkActionGenerator) -> None:
+    change = Change(schema="public", table="foo_table", op="DELETE", id="a-1")
+    expected = [
+        {"_op_type": "delete", "_index": "foo_index", "_id": "a-1"},
+        {"_op_type": "delete", "_index": "bar_index", "_id": "a-1"},
+    ]
+    assert bulk_action_generator.delete_actions(change) == expected
+
+
+def test_delete_actions_for_view(bulk_action_generator: BulkActionGenerator) -> None:
+    change = Change(schema="sinker", table="foo_mv", op="DELETE", id="a-1")
+    expected = [{"_op_type": "delete", "_index": "foo_index", "_id": "a-1"}]
+    assert bulk_action_generator.delete_actions(change) == expected
+
+
+def test_actions(bulk_action_generator: BulkActionGenerator) -> None:
+    entries = [
+        (1, "0/1", "BEGIN 1"),
+        (1, "0/2", "table sinker.foo_mv: DELETE: (no-tuple-data)"),
+        (1, "0/3", """table sinker.foo_mv: INSERT: id[text]:'a-1' doc[json]:'{"name" : "Foo''s Bar"}'"""),
+        (1, "0/4", "table public.other: INSERT: id[text]:'o-1'"),
+        (1, "0/5", "COMMIT 1"),
+        (2, "0/6", "BEGIN 2"),
+        (2, "0/7", "table public.foo_table: DELETE: id[text]:'a-2'"),
+        (2, "0/8", "COMMIT 2"),
+        (3, "0/9", "BEGIN 3"),
+        # a row that dropped out of the view, logged in full by the view's replica identity
+        (3, "0/A", """table sinker.foo_mv: DELETE: id[text]:'a-3' doc[json]:'{"name" : "Baz"}'"""),
+        (3, "0/B", "COMMIT 3"),
+    ]
+    assert list(bulk_action_generator.actions(entries)) == [
+        {"_index": "foo_index", "_id": "a-1", "_source": digested_doc("a-1", '{"name" : "Foo\'s Bar"}')},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "a-2"},
+        {"_op_type": "delete", "_index": "bar_index", "_id": "a-2"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "a-3"},
+    ]
+    assert bulk_action_generator.pending_lsn == "0/B"
+
+
+def test_confirm_advances_slot_to_pending_lsn(bulk_action_generator: BulkActionGenerator, mocker) -> None:
+    get_pool = mocker.patch("sinker.bulk_action_generator.get_pool")
+    bulk_action_generator.pending_lsn = "0/24EDC1B0"
+    bulk_action_generator.confirm()
+    execute = get_pool.return_value.connection.return_value.__enter__.return_value.execute
+    execute.assert_called_once_with("select pg_replication_slot_advance('sinker', '0/24EDC1B0'::pg_lsn)")
+    assert bulk_action_generator.pending_lsn is None
+    # nothing new to confirm
+    bulk_action_generator.confirm()
+    execute.assert_called_once()
+
+
+def test_coalesce_keeps_last_action_per_doc() -> None:
+    actions = [
+        {"_index": "foo_index", "_id": "a-1", "_source": "1"},
+        {"_index": "foo_index", "_id": "b-1", "_source": "1"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "a-1"},
+        {"_index": "bar_index", "_id": "a-1", "_source": "1"},
+        {"_index": "foo_index", "_id": "a-1", "_source": "2"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "b-1"},
+    ]
+    assert list(coalesce(actions, window=10)) == [
+        {"_index": "bar_index", "_id": "a-1", "_source": "1"},
+        {"_index": "foo_index", "_id": "a-1", "_source": "2"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "b-1"},
+    ]
+
+
+def test_coalesce_flushes_full_window() -> None:
+    actions = [{"_index": "foo_index", "_id": doc_id, "_source": str(i)} for i, doc_id in enumerate("aabca")]
+    # the window fills up at b, so the a after c can't be coalesced with the earlier ones
+    assert [(action["_id"], action["_source"]) for action in coalesce(actions, window=2)] == [
+        ("a", "1"),
+        ("b", "2"),
+        ("c", "3"),
+        ("a", "4"),
+    ]
+    assert list(coalesce(actions, window=0)) == actions
+
+
+def test_coalesce_holds_deletes_until_the_end_of_the_slice() -> None:
+    # a concurrent refresh deletes every changed row before inserting it again
+    actions = [
+        {"_op_type": "delete", "_index": "foo_index", "_id": "a"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "b"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "c"},
+        {"_index": "foo_index", "_id": "a", "_source": "1"},
+        {"_index": "foo_index", "_id": "b", "_source": "1"},
+    ]
+    expected = [
+        {"_index": "foo_index", "_id": "a", "_source": "1"},
+        {"_index": "foo_index", "_id": "b", "_source": "1"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "c"},
+    ]
+    # even with windows too small to hold a delete and its insert together
+    for window in (0, 1, 2):
+        assert list(coalesce(actions, window=window)) == expected
+
+
+def test_skip_unchanged(bulk_action_generator: BulkActionGenerator) -> None:
+    bulk_action_generator.digest_cache = DigestCache(max_size=10)
+    first = [
+        {"_index": "foo_index", "_id": "a-1", "_source": "1"},
+        {"_index": "foo_index", "_id": "b-1", "_source": "1"},
+    ]
+    assert list(bulk_action_generator.skip_unchanged(first)) == first
+    bulk_action_generator.pending_lsn = None  # nothing to advance the slot to
+    bulk_action_generator.confirm()
+    second = [
+        {"_index": "foo_index", "_id": "a-1", "_source": "1"},
+        {"_index": "foo_index", "_id": "b-1", "_source": "2"},
+        {"_op_type": "delete", "_index": "foo_index", "_id": "a-1"},
+        {"_index": "foo_index", "_id": "a-1", "_source": "1"},
+    ]
+    # a-1 is unchanged until it's deleted, after which it has to be shipped again
+    assert list(bulk_action_generator.skip_unchanged(second)) == second[1:]
+    assert bulk_action_generator.digest_cache.skipped == 1
+
+
+def test_tables(bulk_action_generator: BulkActionGenerator) -> None:
+    assert bulk_action_generator.tables() == [f"{SINKER_SCHEMA}.foo_mv", "*.foo_table"]
+
+
+def test_slices(bulk_action_generator: BulkActionGenerator, mocker) -> None:
+    mocker.patch("sinker.bulk_action_generator.SINKER_SLOT_SLICE_BYTES", 100 * 1000)
+    bulk_action_generator.upto_nchanges = 3
+    entries = [
+        (1, "0/1", "BEGIN 1"),
+        (1, "0/2", """table sinker.foo_mv: INSERT: id[text]:'a-1' doc[json]:'{}'"""),
+        (1, "0/3", "COMMIT 1"),
+    ]
+    mocker.patch.object(bulk_action_generator, "entries", return_value=iter(entries))
+    assert len(list(bulk_action_generator.generate_actions())) == 1
+    # the slice stopped at its limit, and the next one is sized by the bytes of its entries
+    assert bulk_action_generator.more_pending
+    assert bulk_action_generator.pending_lsn == "0/3"
+    assert bulk_action_generator.upto_nchanges == 100 * 1000 * 3 // sum(len(entry[2]) for entry in entries)
+    bulk_action_generator.size_next_slice(entries=10, nbytes=10)
+    assert not bulk_action_generator.more_pending
 
 
-def test_delete_action(bulk_action_generator: BulkActionGenerator) -> None:
-    slot_dict = dict(table="foo_table", id="a-1")
-    expected = {"_op_type": "delete", "_index": "foo_index", "_id": "a-1"}
-    assert bulk_action_generator.delete_action(slot_dict) == expected
+def test_partial_updates(bulk_action_generator: BulkActionGenerator) -> None:
+    bulk_action_generator.doc_cache = DocCache(max_bytes=1 << 20)
+    big = '{"name": "Foo", "payload": "' + "x" * 100 + '", "views": 1}'
+    bulk_action_generator.doc_cache.put(("foo_index", "a-1"), big)
+    actions = [
+        {"_index": "foo_index", "_id": "a-1", "_source": big.replace('"views": 1', '"views": 2')},
+        # not in the cache
+        {"_index": "foo_index", "_id": "a-2", "_source": big},
+        # the update would be about as big as the doc
+        {"_index": "foo_index", "_id": "a-2", "_source": '{"name": "Bar"}'},
+    ]
+    shipped = list(bulk_action_generator.partial_updates(actions))
+    # the bulk request gets the partial doc as the body of the update, also after a round trip through the spool
+    for update in (shipped[0], decode(encode(shipped[0]))):
+        assert expand_action(update) == ({"update": {"_index": "foo_index", "_id": "a-1"}}, {"doc": {"views": 2}})
+    assert shipped[1:] == actions[1:]
@@ -0,0 +1,46 @@
+from sinker.cache import DigestCache, DocCache
+
+
+def test_digest_cache_evicts_least_recently_used() -> None:
+    cache = DigestCache(max_size=2)
+    cache.put(("foo_index", "a"), DigestCache.digest("a"))
+    cache.put(("foo_index", "b"), DigestCache.digest("b"))
+    # using a makes b the least recently used
+    assert cache.get(("foo_index", "a")) == DigestCache.digest("a")
+    cache.put(("foo_index", "c"), DigestCache.digest("c"))
+    assert cache.get(("foo_index", "b")) is None
+    assert len(cache) == 2
+    cache.put(("foo_index", "a"), None)
+    assert cache.get(("foo_index", "a")) is None
+
+
+def test_disabled_digest_cache() -> None:
+    cache = DigestCache(max_size=0)
+    cache.put(("foo_index", "a"), DigestCache.digest("a"))
+    assert not cache.enabled
+    assert len(cache) == 0
+
+
+def test_doc_cache_evicts_by_bytes() -> None:
+    cache = DocCache(max_bytes=10)
+    cache.put(("foo_index", "a"), "aaaa")
+    cache.put(("foo_index", "b"), "bbbb")
+    cache.put(("foo_index", "a"), "aaaaa")
+    assert cache.nbytes == 9
+    cache.put(("foo_index", "c"), "cc")
+    # b is the least recently used
+    assert cache.get(("foo_index", "b")) is None
+    assert cache.get(("foo_index", "a")) == "aaaaa"
+    cache.put(("foo_index", "a"), None)
+    assert cache.nbytes == 2
+
+
+def test_caches_forget_an_index() -> None:
+    digests, docs = DigestCache(max_size=10), DocCache(max_bytes=100)
+    for key in (("foo_index", "a"), ("foo_index", "b"), ("bar_index", "a")):
+        digests.put(key, DigestCache.digest(key[1]))
+        docs.put(key, key[1] * 3)
+    digests.forget("foo_index")
+    docs.forget("foo_index")
+    assert len(digests) == 1 and digests.get(("bar_index", "a")) == DigestCache.digest("a")
+    assert (len(docs), docs.nbytes, docs.get(("bar_index", "a"))) == (1, 3, "aaa")
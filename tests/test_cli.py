@@ -0,0 +1,65 @@
+from argparse import Namespace
+
+import psycopg
+
+from sinker.__main__ import main, parse_args, settings_environment
+from sinker.shards import Shard
+from sinker.sinker import Sinker
+
+
+def test_flags_override_settings() -> None:
+    args = parse_args(["--log-level", "DEBUG", "rebuild", "course_mv", "--partitions", "8", "--parallel", "2"])
+    assert (args.command, args.views, args.parallel) == ("rebuild", ["course_mv"], 2)
+    assert settings_environment(args) == {"SINKER_LOG_LEVEL": "DEBUG", "SINKER_BACKFILL_PARTITIONS": "8"}
+
+
+def test_no_command_runs() -> None:
+    args = parse_args([])
+    assert args.command == "run"
+    assert settings_environment(args) == {}
+
+
+def test_sync_resumes() -> None:
+    assert settings_environment(parse_args(["sync", "--batch-size", "50"])) == {
+        "ELASTICSEARCH_CHUNK_SIZE": "50",
+        "SINKER_RESUME": "true",
+    }
+
+
+def test_main_dispatches_to_command(mocker) -> None:
+    mocker.patch.dict("os.environ")
+    reconcile = mocker.patch("sinker.commands.reconcile")
+    main(["reconcile", "foo_mv", "--dry-run", "--buckets", "64"])
+    args = reconcile.call_args[0][0]
+    assert (args.views, args.dry_run) == (["foo_mv"], True)
+
+
+def test_setup_sets_up_every_view_of_a_fresh_schema(mocker) -> None:
+    from sinker import commands
+
+    def execute(query, params=None):
+        # nothing exists yet, not even the definitions table
+        if "select hash" in query:
+            raise psycopg.errors.UndefinedTable(query)
+        return mocker.Mock(fetchone=mocker.Mock(return_value=None))
+
+    mocker.patch("sinker.sinker.get_pool").return_value.connection.return_value.__enter__.return_value.execute = execute
+    sinkers = [Sinker("foo_mv", "foo_index"), Sinker("bar_mv", "bar_index")]
+    mocker.patch("sinker.commands.load_sinkers", return_value=sinkers)
+    set_up = mocker.patch("sinker.commands.set_up")
+    commands.setup(Namespace(views=[], parallel=None))
+    set_up.assert_called_once_with(sinkers, None)
+
+
+def test_set_up_creates_the_missing_slot(mocker) -> None:
+    from sinker import commands
+
+    mocker.patch("sinker.commands.setup_tables")
+    mocker.patch("sinker.commands.slot_plugin", return_value=None)
+    setup_slot = mocker.patch("sinker.commands.setup_slot")
+    sinker = mocker.MagicMock(shard=Shard())
+    sinker.setup.return_value = "foo_mv"
+    commands.set_up([sinker], None)
+    sinker.setup.assert_called_once_with()
+    setup_slot.assert_called_once()
+    assert setup_slot.call_args[0][0] == Shard()
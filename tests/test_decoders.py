@@ -0,0 +1,92 @@
+import json
+import struct
+
+from sinker.decoders import Change, PgOutputDecoder, TestDecodingDecoder, Wal2JsonDecoder
+
+
+def test_test_decoding_insert() -> None:
+    data = """table sinker.foo_mv: INSERT: id[text]:'a-1' doc[json]:'{"name" : "Foo Bar"}'"""
+    assert TestDecodingDecoder().decode(data) == Change("sinker", "foo_mv", "INSERT", "a-1", '{"name" : "Foo Bar"}')
+
+
+def test_test_decoding_keeps_apostrophes() -> None:
+    data = """table sinker.foo_mv: UPDATE: id[text]:'a-1' doc[json]:'{"name" : "O''Brien''s"}'"""
+    change = TestDecodingDecoder().decode(data)
+    assert change is not None
+    assert json.loads(change.doc) == {"name": "O'Brien's"}
+
+
+def test_test_decoding_quoted_table_and_unquoted_id() -> None:
+    data = 'table public."Foo": DELETE: id[integer]:42'
+    assert TestDecodingDecoder().decode(data) == Change("public", "Foo", "DELETE", "42")
+
+
+def test_test_decoding_old_tuple() -> None:
+    data = (
+        "table sinker.foo_mv: UPDATE: old-tuple: id[text]:'a-1' doc[json]:'{\"a\": \"new-tuple: \"}' "
+        "new-tuple: id[text]:'a-1' doc[json]:'{\"a\": 2}'"
+    )
+    assert TestDecodingDecoder().decode(data) == Change("sinker", "foo_mv", "UPDATE", "a-1", '{"a": 2}')
+
+
+def test_test_decoding_ignores_entries_without_id() -> None:
+    decoder = TestDecodingDecoder()
+    assert decoder.decode("BEGIN 17393") is None
+    assert decoder.decode("table sinker.foo_mv: DELETE: (no-tuple-data)") is None
+    assert decoder.is_commit("COMMIT 17393")
+
+
+def test_wal2json() -> None:
+    decoder = Wal2JsonDecoder()
+    insert = json.dumps(
+        {
+            "action": "I",
+            "schema": "sinker",
+            "table": "foo_mv",
+            "columns": [{"name": "id", "value": "a-1"}, {"name": "doc", "value": '{"name": "Foo\'s"}'}],
+        }
+    )
+    assert decoder.decode(insert) == Change("sinker", "foo_mv", "INSERT", "a-1", '{"name": "Foo\'s"}')
+    delete = json.dumps({"action": "D", "schema": "public", "table": "foo", "identity": [{"name": "id", "value": 7}]})
+    assert decoder.decode(delete) == Change("public", "foo", "DELETE", "7")
+    assert decoder.decode('{"action":"B"}') is None
+    assert decoder.is_commit('{"action":"C"}')
+
+
+def _tuple(*values) -> bytes:
+    data = struct.pack("!H", len(values))
+    for value in values:
+        if value is None:
+            data += b"n"
+        else:
+            encoded = value.encode()
+            data += b"t" + struct.pack("!I", len(encoded)) + encoded
+    return data
+
+
+def test_pgoutput() -> None:
+    decoder = PgOutputDecoder()
+    relation = b"R" + struct.pack("!I", 16384) + b"sinker\0foo_mv\0d" + struct.pack("!H", 2)
+    for name in (b"id", b"doc"):
+        relation += b"\1" + name + b"\0" + struct.pack("!Ii", 25, -1)
+    assert decoder.decode(relation) is None
+    insert = b"I" + struct.pack("!I", 16384) + b"N" + _tuple("a-1", '{"name": "Foo\'s"}')
+    assert decoder.decode(insert) == Change("sinker", "foo_mv", "INSERT", "a-1", '{"name": "Foo\'s"}')
+    update = b"U" + struct.pack("!I", 16384) + b"O" + _tuple("a-1", "{}") + b"N" + _tuple("a-1", '{"a": 1}')
+    assert decoder.decode(update) == Change("sinker", "foo_mv", "UPDATE", "a-1", '{"a": 1}')
+    delete = b"D" + struct.pack("!I", 16384) + b"K" + _tuple("a-1", None)
+    assert decoder.decode(delete) == Change("sinker", "foo_mv", "DELETE", "a-1")
+    assert decoder.is_commit(b"C\0")
+
+
+def test_wal2json_peek_query_filters_tables() -> None:
+    query = Wal2JsonDecoder().peek_query("sinker", ["sinker.foo_mv", "*.foo_table", "public.Bar's, baz"])
+    assert query.endswith(r"""'add-tables', 'sinker.foo_mv,*.foo_table,public.Bar\''s\,\ baz')""")
+    assert "add-tables" not in Wal2JsonDecoder().peek_query("sinker")
+
+
+def test_peek_query_slices() -> None:
+    assert "('sinker', NULL, NULL)" in TestDecodingDecoder().peek_query("sinker")
+    assert "('sinker', NULL, 1000)" in TestDecodingDecoder().peek_query("sinker", upto_nchanges=1000)
+    assert "('sinker', NULL, 1000, " in Wal2JsonDecoder().peek_query("sinker", upto_nchanges=1000)
+    assert "('sinker', NULL, 1000, " in PgOutputDecoder().peek_query("sinker", upto_nchanges=1000)
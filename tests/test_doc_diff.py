@@ -0,0 +1,13 @@
+from sinker.utils import doc_diff
+
+
+def test_doc_diff_merges_nested_objects() -> None:
+    old = {"name": "Reth", "stats": {"views": 1, "likes": 2}, "tags": ["a"]}
+    new = {"name": "Reth", "stats": {"views": 2, "likes": 2}, "tags": ["a", "b"], "extra": None}
+    assert doc_diff(old, new) == {"stats": {"views": 2}, "tags": ["a", "b"], "extra": None}
+    assert doc_diff(old, old) == {}
+
+
+def test_doc_diff_cant_remove_fields() -> None:
+    assert doc_diff({"name": "Reth", "stats": {"views": 1}}, {"name": "Reth", "stats": {}}) is None
+    assert doc_diff({"name": "Reth"}, ["Reth"]) is None
@@ -0,0 +1,34 @@
+import pytest
+
+from sinker import metrics
+from sinker.pipeline import Pipeline
+
+prometheus_client = pytest.importorskip("prometheus_client")
+
+
+def test_noop_metric() -> None:
+    noop = metrics._NoopMetric()
+    noop.labels(view="foo_mv").inc()
+    with noop.labels(view="foo_mv").time():
+        pass
+
+
+def test_ship_counts_actions(mocker) -> None:
+    mocker.patch(
+        "sinker.batcher.streaming_bulk",
+        side_effect=lambda client, actions, **kwargs: [(True, {"index": {"status": 201}}) for _ in actions],
+    )
+
+    def sample(op: str) -> float:
+        labels = {"index": "metrics_index", "op": op}
+        return prometheus_client.REGISTRY.get_sample_value("sinker_actions_total", labels) or 0
+
+    deletes, indexes = sample("delete"), sample("index")
+    actions = [
+        {"_index": "metrics_index", "_id": "a-1", "_source": "{}"},
+        {"_index": "metrics_index", "_id": "b-1", "_source": "{}"},
+        {"_op_type": "delete", "_index": "metrics_index", "_id": "c-1"},
+    ]
+    Pipeline(client=None, senders=2).ship(actions)
+    assert sample("index") - indexes == 2
+    assert sample("delete") - deletes == 1
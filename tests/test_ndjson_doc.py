@@ -0,0 +1,37 @@
+import hashlib
+import json
+
+from sinker.pg import RawTextLoader
+from sinker.utils import digested_doc, md5_prefix, ndjson_doc
+
+
+def test_single_line_doc_is_passed_through() -> None:
+    doc = b'{"name" : "Foo Bar"}'
+    assert ndjson_doc(doc) is doc
+    assert ndjson_doc(doc.decode()) == doc.decode()
+
+
+def test_multiline_doc_is_reserialized() -> None:
+    doc = '{\n  "name": "Foo\\nBar"\n}'
+    single_line = ndjson_doc(doc)
+    assert b"\n" not in (single_line if isinstance(single_line, bytes) else single_line.encode())
+    assert json.loads(single_line) == {"name": "Foo\nBar"}
+
+
+def test_digested_doc(mocker) -> None:
+    doc = b'{"name" : "Foo Bar"}'
+    assert digested_doc("a-1", doc) is doc
+    mocker.patch("sinker.utils.SINKER_DIGEST_FIELD", "sinker_digest")
+    digested = digested_doc("a-1", doc)
+    assert digested.endswith(b',"name" : "Foo Bar"}')
+    assert json.loads(digested) == {
+        "sinker_digest": {"id": md5_prefix("a-1"), "doc": md5_prefix(doc)},
+        "name": "Foo Bar",
+    }
+    # the same as Postgres computes with ('x' || substr(md5('a-1'), 1, 8))::bit(32)::bigint
+    assert md5_prefix("a-1") == int(hashlib.md5(b"a-1").hexdigest()[:8], 16)
+    assert json.loads(digested_doc(7, " { }")) == {"sinker_digest": {"id": md5_prefix("7"), "doc": md5_prefix(" { }")}}
+
+
+def test_raw_text_loader() -> None:
+    assert RawTextLoader(25).load(memoryview(b'{"name": "Foo Bar"}')) == b'{"name": "Foo Bar"}'
@@ -0,0 +1,41 @@
+import pytest
+
+from sinker.batcher import AdaptiveBatcher
+from sinker.pipeline import Pipeline, prefetch
+from sinker.settings import ELASTICSEARCH_SYNC_BATCHING
+
+
+def test_prefetch() -> None:
+    assert list(prefetch(range(10), batch_size=3, queue_size=1)) == list(range(10))
+
+
+def test_prefetch_reraises() -> None:
+    def items():
+        yield 1
+        raise ValueError("Boom!")
+
+    with pytest.raises(ValueError):
+        list(prefetch(items(), batch_size=1))
+
+
+def test_ship_keeps_document_order(mocker) -> None:
+    sent = []
+
+    def streaming_bulk(client, actions, **kwargs):
+        sent.extend(actions)
+        return [(True, {"index": {"status": 201}}) for _ in actions]
+
+    mocker.patch("sinker.batcher.streaming_bulk", side_effect=streaming_bulk)
+    actions = [{"_index": "foo_index", "_id": f"a-{i % 5}", "_source": str(i)} for i in range(100)]
+    batcher = AdaptiveBatcher(**dict(ELASTICSEARCH_SYNC_BATCHING, chunk_size=7, min_chunk_size=1))
+    assert Pipeline(client=None, senders=3, batcher=batcher).ship(actions) == 100
+    for doc_id in {action["_id"] for action in actions}:
+        assert [a for a in sent if a["_id"] == doc_id] == [a for a in actions if a["_id"] == doc_id]
+
+
+def test_ship_reraises_sender_exception(mocker) -> None:
+    mocker.patch("sinker.batcher.streaming_bulk", side_effect=ConnectionError("Boom!"))
+    actions = ({"_index": "foo_index", "_id": str(i), "_source": "{}"} for i in range(1000))
+    with pytest.raises(ConnectionError):
+        batcher = AdaptiveBatcher(**dict(ELASTICSEARCH_SYNC_BATCHING, chunk_size=10))
+        Pipeline(client=None, senders=2, batcher=batcher, queue_size=1).ship(actions)
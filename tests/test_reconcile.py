@@ -0,0 +1,138 @@
+import pytest
+
+from sinker.reconcile import ID_HASH_BITS, Reconciler, Summary, bucket, differing_buckets
+from sinker.utils import md5_prefix
+
+SINKER_DIGEST_FIELD = "sinker_digest"
+
+
+@pytest.fixture(autouse=True)
+def digest_field(mocker) -> None:
+    mocker.patch("sinker.reconcile.SINKER_DIGEST_FIELD", SINKER_DIGEST_FIELD)
+    mocker.patch("sinker.utils.SINKER_DIGEST_FIELD", SINKER_DIGEST_FIELD)
+
+
+def summarize(digests: dict[str, int], shift: int, parents: list[int], parent_shift: int) -> Summary:
+    summary: Summary = {}
+    for doc_id, digest in digests.items():
+        if bucket(doc_id, parent_shift) in parents:
+            count, total = summary.get(bucket(doc_id, shift), (0, 0))
+            summary[bucket(doc_id, shift)] = (count + 1, total + digest)
+    return summary
+
+
+def in_leaves(doc_id: str, leaves: dict[int, list[int]]) -> bool:
+    return any(bucket(doc_id, shift) in buckets for shift, buckets in leaves.items())
+
+
+def test_differing_buckets() -> None:
+    view: Summary = {1: (2, 10), 2: (1, 5), 3: (1, 7)}
+    index: Summary = {1: (2, 10), 2: (1, 6), 4: (1, 1)}
+    assert differing_buckets(view, index) == [2, 3, 4]
+    assert bucket("a-1", ID_HASH_BITS) == 0
+
+
+def test_reconcile_narrows_down_to_differing_docs(mocker) -> None:
+    shipped = []
+
+    def ship(actions) -> int:
+        shipped.extend(actions)
+        return len(shipped)
+
+    pipeline = mocker.Mock()
+    pipeline.ship.side_effect = ship
+    reconciler = Reconciler("foo_mv", "foo_index", buckets=2, pipeline=pipeline, leaf_docs=1)
+    mocker.patch.object(reconciler, "id_type", return_value="text")
+    view_docs = {f"a-{n}": f'{{"n": {n}}}' for n in range(100)}
+    view_digests = {doc_id: md5_prefix(doc) for doc_id, doc in view_docs.items()}
+    index_digests = dict(view_digests)
+    del index_digests["a-3"]
+    index_digests["a-2"] += 1
+    index_digests["a-100"] = 1
+    mocker.patch.object(reconciler, "view_summary", side_effect=lambda *args: summarize(view_digests, *args))
+    mocker.patch.object(reconciler, "index_summary", side_effect=lambda *args: summarize(index_digests, *args))
+    mocker.patch.object(
+        reconciler,
+        "view_digests",
+        side_effect=lambda leaves: {
+            doc_id: digest for doc_id, digest in view_digests.items() if in_leaves(doc_id, leaves)
+        },
+    )
+    mocker.patch.object(
+        reconciler,
+        "index_versions",
+        side_effect=lambda leaves: {
+            doc_id: (digest, 7, 1) for doc_id, digest in index_digests.items() if in_leaves(doc_id, leaves)
+        },
+    )
+    mocker.patch.object(
+        reconciler,
+        "view_docs",
+        side_effect=lambda query, params: [(doc_id, view_docs[doc_id]) for doc_id in params["ids"]],
+    )
+
+    report = reconciler.reconcile()
+
+    assert (report.docs, report.missing, report.stale, report.extra, report.repaired) == (100, 1, 1, 1, 3)
+    # only the docs in the buckets that differ are compared, the buckets being split down to one doc each
+    assert report.compared == 3
+    assert sorted((action.get("_op_type", "index"), action["_id"]) for action in shipped) == [
+        ("create", "a-3"),
+        ("delete", "a-100"),
+        ("index", "a-2"),
+    ]
+
+
+def test_index_summary_aggregates_stored_digests(mocker) -> None:
+    es = mocker.patch("sinker.reconcile.get_client").return_value
+    es.search.return_value = {
+        "aggregations": {
+            "buckets": {
+                "buckets": [
+                    {"key": 3.0 * (1 << 28), "doc_count": 2, "digests": {"value": 12345678901.0}},
+                    {"key": 5.0 * (1 << 28), "doc_count": 1, "digests": {"value": 42.0}},
+                ]
+            }
+        }
+    }
+    reconciler = Reconciler("foo_mv", "foo_index", buckets=16, pipeline=mocker.Mock())
+    assert reconciler.index_summary(28, [0], ID_HASH_BITS) == {3: (2, 12345678901), 5: (1, 42)}
+    _, kwargs = es.search.call_args
+    assert kwargs["size"] == 0
+    assert kwargs["aggs"]["buckets"]["histogram"]["interval"] == 1 << 28
+    assert kwargs["query"] == {
+        "bool": {
+            "filter": [{"bool": {"should": [{"range": {f"{SINKER_DIGEST_FIELD}.id": {"gte": 0, "lt": 1 << 32}}}]}}]
+        }
+    }
+
+
+def test_repair_actions_are_conditional(mocker) -> None:
+    reconciler = Reconciler("foo_mv", "foo_index", buckets=4, pipeline=mocker.Mock())
+    mocker.patch.object(reconciler, "id_type", return_value="bigint")
+    view_docs = mocker.patch.object(
+        reconciler, "view_docs", side_effect=lambda query, params: [(doc_id, b"{}") for doc_id in params["ids"]]
+    )
+    versions = {"a-2": (0, 7, 1), "a-4": (0, 8, 1)}
+    actions = list(reconciler.repair_actions(["a-3", "a-2"], ["a-4"], versions))
+    assert [(action.get("_op_type"), action["_id"], action.get("if_seq_no")) for action in actions] == [
+        ("create", "a-3", None),
+        (None, "a-2", 7),
+        ("delete", "a-4", 8),
+    ]
+    assert actions[1] == {
+        "_index": "foo_index",
+        "_id": "a-2",
+        "_source": f'{{"{SINKER_DIGEST_FIELD}":{{"id":{md5_prefix("a-2")},"doc":{md5_prefix(b"{}")}}}}}'.encode(),
+        "if_seq_no": 7,
+        "if_primary_term": 1,
+    }
+    # the IDs are cast to the type of the view's id column so its index can be used
+    query, _ = view_docs.call_args.args
+    assert "where id = any(%(ids)s::bigint[])" in query
+
+
+def test_reconciling_needs_the_digest_field(mocker) -> None:
+    mocker.patch("sinker.reconcile.SINKER_DIGEST_FIELD", "")
+    with pytest.raises(ValueError, match="SINKER_DIGEST_FIELD"):
+        Reconciler("foo_mv", "foo_index", pipeline=mocker.Mock())
@@ -0,0 +1,55 @@
+from sinker.runner import Runner
+
+
+def test_wait_for_changes_drains_burst(mocker) -> None:
+    runner = Runner.__new__(Runner)
+    runner.listener = mocker.Mock()
+    runner.listener.notifies.side_effect = [iter(["change"]), iter(["change", "change"])]
+    runner.wait_for_changes(10)
+    assert runner.listener.notifies.call_args_list == [
+        mocker.call(timeout=10, stop_after=1),
+        mocker.call(timeout=0),
+    ]
+
+
+def test_parent_tables_to_indices_fans_out(mocker) -> None:
+    sinkers = [
+        mocker.Mock(parent_table="course", index="course"),
+        mocker.Mock(parent_table="course", index="course_summary"),
+        mocker.Mock(parent_table="person", index="person"),
+    ]
+    mocker.patch("sinker.runner.SINKER_INCREMENTAL", False)
+    assert Runner.parent_tables_to_indices(sinkers) == {"course": ["course", "course_summary"], "person": ["person"]}
+
+
+def test_resume_rebuilds_only_stale_views(mocker, tmp_path) -> None:
+    (tmp_path / "views_to_indices.json").write_text('{"current_mv": "current", "stale_mv": "stale"}')
+    mocker.patch("sinker.runner.SINKER_DEFINITIONS_PATH", str(tmp_path))
+    mocker.patch("sinker.runner.SINKER_RESUME", True)
+    mocker.patch("sinker.runner.SINKER_INCREMENTAL", True)
+    for name in ("metrics", "psycopg", "load_assignments", "get_client", "Pipeline", "load_scheduler"):
+        mocker.patch(f"sinker.runner.{name}")
+    for name in ("setup_tables", "setup_publication", "setup_slot", "BulkActionGenerator"):
+        mocker.patch(f"sinker.runner.{name}")
+    decoder = mocker.patch("sinker.runner.get_decoder").return_value
+    mocker.patch("sinker.runner.slot_plugin", return_value=decoder.plugin)
+    mocker.patch("sinker.runner.Sinker.load_definition")
+    mocker.patch(
+        "sinker.runner.Sinker.is_current", autospec=True, side_effect=lambda sinker: sinker.view == "current_mv"
+    )
+    setup = mocker.patch("sinker.runner.Sinker.setup", autospec=True, side_effect=lambda sinker: sinker.view)
+    # records the order in which the slot is processed and the todo entries are created
+    calls = mocker.Mock()
+    mocker.patch.object(Runner, "process_slot", calls.process_slot)
+    calls.attach_mock(
+        mocker.patch("sinker.runner.get_pool").return_value.connection.return_value.__enter__.return_value.execute,
+        "execute",
+    )
+
+    Runner()
+
+    assert [call.args[0].view for call in setup.call_args_list] == ["stale_mv"]
+    # the changes pending in the slot are shipped before the resumed views are queued for a refresh
+    assert [name for name, _, _ in calls.mock_calls] == ["process_slot", "execute"]
+    query = calls.execute.call_args.args[0]
+    assert "current_mv" in query and "stale_mv" not in query
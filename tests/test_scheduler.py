@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from sinker.scheduler import Schedule, Scheduler, load_scheduler
+
+
+def test_debounce_and_max_staleness() -> None:
+    scheduler = Scheduler({"foo_mv": Schedule(debounce=5, max_staleness=20)})
+    scheduler.add("foo_mv", age=0, now=100)
+    scheduler.add("foo_mv", age=0, now=104)
+    # still within the debounce window of the last change
+    assert scheduler.due(now=108) == []
+    assert scheduler.wait_time(now=108) == 1
+    assert scheduler.due(now=109) == ["foo_mv"]
+    # changes keep coming, but the first one can't wait any longer
+    for now in range(109, 120):
+        scheduler.add("foo_mv", age=0, now=now)
+    assert scheduler.due(now=119) == []
+    assert scheduler.due(now=120) == ["foo_mv"]
+
+
+def test_min_interval_priority_and_busy() -> None:
+    scheduler = Scheduler({"foo_mv": Schedule(min_interval=10), "bar_mv": Schedule(priority=1)})
+    scheduler.add("foo_mv", age=3, now=100)
+    scheduler.add("bar_mv", age=1, now=100)
+    scheduler.add("baz_mv", age=2, now=100)
+    assert scheduler.due(now=100) == ["bar_mv", "foo_mv", "baz_mv"]
+    assert scheduler.due(busy={"bar_mv"}, now=100) == ["foo_mv", "baz_mv"]
+    assert scheduler.take("foo_mv", now=100).full
+    scheduler.add("foo_mv", age=0, doc_id="a-1", now=101)
+    scheduler.add("foo_mv", age=0, doc_id="a-2", now=101)
+    assert "foo_mv" not in scheduler.due(now=109)
+    pending = scheduler.take("foo_mv", now=110)
+    assert not pending.full and pending.ids == {"a-1", "a-2"}
+
+
+def test_load_scheduler(tmp_path) -> None:
+    path = tmp_path / "schedules.json"
+    assert load_scheduler(str(path)).schedule("foo_mv") == Schedule()
+    path.write_text(json.dumps({"default": {"debounce": 1}, "foo_mv": {"priority": 10}}))
+    scheduler = load_scheduler(str(path))
+    assert scheduler.schedule("foo_mv") == Schedule(debounce=1, priority=10)
+    assert scheduler.schedule("bar_mv") == Schedule(debounce=1)
+    path.write_text(json.dumps({"foo_mv": {"debounse": 1}}))
+    with pytest.raises(ValueError):
+        load_scheduler(str(path))
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from sinker.settings import SINKER_REPLICATION_SLOT, SINKER_TODO_TABLE
+from sinker.shards import Shard, load_assignments, owner
+
+
+def test_names() -> None:
+    assert Shard().slot == SINKER_REPLICATION_SLOT
+    assert Shard(2, 3).slot == f"{SINKER_REPLICATION_SLOT}_2"
+    assert Shard(2, 3).todo_table == f"{SINKER_TODO_TABLE}_2"
+
+
+def test_owner_spreads_views_and_moves_few() -> None:
+    views = [f"view_{i}_mv" for i in range(1000)]
+    owners = {view: owner(view, 4) for view in views}
+    counts = [list(owners.values()).count(shard) for shard in range(4)]
+    assert all(150 < count < 350 for count in counts)
+    # adding a shard only moves views to the new shard
+    moved = [view for view in views if owner(view, 5) != owners[view]]
+    assert all(owner(view, 5) == 4 for view in moved)
+    assert len(moved) < 350
+
+
+def test_owns_with_assignments() -> None:
+    view = "foo_mv"
+    other = (owner(view, 2) + 1) % 2
+    assert Shard(owner(view, 2), 2).owns(view)
+    assert Shard(other, 2).owns(view, {view: other})
+    assert not Shard(owner(view, 2), 2).owns(view, {view: other})
+
+
+def test_load_assignments(tmp_path) -> None:
+    path = tmp_path / "shards.json"
+    assert load_assignments(str(path), 2) == {}
+    path.write_text(json.dumps({"foo_mv": 1}))
+    assert load_assignments(str(path), 2) == {"foo_mv": 1}
+    with pytest.raises(ValueError):
+        load_assignments(str(path), 1)
@@ -0,0 +1,111 @@
+import re
+
+import pytest
+
+from sinker.sinker import Sinker, block_ranges, flatten_settings
+
+
+def test_flatten_settings():
+    settings = {
+        "index": {"number_of_shards": "1", "number_of_replicas": "0"},
+        "refresh_interval": "5s",
+        "analysis": {"analyzer": {"default": {"type": "standard"}}},
+    }
+    assert flatten_settings(settings) == {
+        "index.number_of_shards": "1",
+        "index.number_of_replicas": "0",
+        "index.refresh_interval": "5s",
+        "index.analysis.analyzer.default.type": "standard",
+    }
+
+
+def test_block_ranges():
+    assert list(block_ranges(10, 3)) == [(0, 3), (3, 6), (6, None)]
+    # a view with fewer pages than partitions leaves some partitions empty, and the last one still reads to the end
+    assert list(block_ranges(1, 3)) == [(0, 0), (0, 0), (0, None)]
+    assert list(block_ranges(0, 1)) == [(0, None)]
+
+
+def test_refresh_reloads_definition_set_up_by_another_process(mocker):
+    sinker = Sinker("foo_mv", "foo_index")
+    sinker.built_hash = "old"
+    conn = mocker.patch("sinker.sinker.get_pool").return_value.connection.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.return_value = ("new",)
+    mocker.patch.object(sinker, "definition_hash", return_value="new")
+    load_definition = mocker.patch.object(sinker, "load_definition")
+    sinker.refresh_view()
+    load_definition.assert_called_once_with()
+    assert (sinker.built_hash, sinker.redefined) == ("new", True)
+    # the refresh only runs after the definition is checked
+    assert "refresh" in conn.execute.call_args_list[-1][0][0].lower()
+
+
+def test_refresh_fails_on_definition_set_up_from_other_files(mocker):
+    sinker = Sinker("foo_mv", "foo_index")
+    sinker.built_hash = "old"
+    conn = mocker.patch("sinker.sinker.get_pool").return_value.connection.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.return_value = ("other",)
+    mocker.patch.object(sinker, "definition_hash", return_value="old")
+    with pytest.raises(RuntimeError):
+        sinker.refresh_view()
+    assert not sinker.redefined
+
+
+@pytest.mark.parametrize("stored_hash, current", [("abc", True), ("old", False)])
+def test_is_current_compares_the_stored_definition_hash(mocker, stored_hash, current):
+    sinker = Sinker("foo_mv", "foo_index")
+    conn = mocker.patch("sinker.sinker.get_pool").return_value.connection.return_value.__enter__.return_value
+    # the definitions table, the hash stored in it, and the view table
+    conn.execute.return_value.fetchone.side_effect = [("r",), (stored_hash,), ("r",)]
+    mocker.patch("sinker.sinker.get_client").return_value.indices.exists_alias.return_value = True
+    mocker.patch.object(sinker, "definition_hash", return_value="abc")
+    assert sinker.is_current() is current
+    # only a view that is resumed has been built from a known definition
+    assert sinker.built_hash == ("abc" if current else None)
+
+
+def test_load_definition_of_view_table_not_set_up_yet(mocker, tmp_path):
+    (tmp_path / "foo_mv.sql").write_text("select id, jsonb_build_object('name', name) as doc from foo;\n")
+    mocker.patch("sinker.sinker.SINKER_DEFINITIONS_PATH", str(tmp_path))
+    mocker.patch("sinker.sinker.SINKER_INCREMENTAL", True)
+    conn = mocker.patch("sinker.sinker.get_pool").return_value.connection.return_value.__enter__.return_value
+    # the lookup finds no view table rather than failing
+    conn.execute.return_value.fetchone.return_value = None
+    sinker = Sinker("foo_mv", "foo_index")
+    assert sinker.load_definition().startswith("select id")
+    assert (sinker.parent_table, sinker.id_type) == ("foo", "text")
+    assert "to_regclass('public.foo_mv')" in conn.execute.call_args[0][0]
+
+
+@pytest.mark.parametrize("incremental", [True, False])
+def test_setup_pg_creates_a_trigger_per_event(mocker, tmp_path, incremental):
+    view = "a_view_with_a_name_long_enough_to_get_truncated_mv"
+    (tmp_path / f"{view}.sql").write_text(
+        "select c.id, jsonb_build_object('names', array_agg(e.name)) as doc\n"
+        "from a_course_table_with_a_long_name c join enrollment e on e.course_id = c.id group by c.id"
+    )
+    (tmp_path / f"{view}.keys.json").write_text('{"enrollment": "select course_id from changed"}')
+    (tmp_path / "foo_index.json").write_text("{}")
+    mocker.patch("sinker.sinker.SINKER_DEFINITIONS_PATH", str(tmp_path))
+    mocker.patch("sinker.sinker.SINKER_INCREMENTAL", incremental)
+    conn = mocker.patch("sinker.sinker.get_pool").return_value.connection.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.return_value = None
+    ddl_conn = mocker.patch("sinker.sinker.psycopg.connect").return_value.__enter__.return_value
+    Sinker(view, "foo_index").setup_pg()
+    ddl: str = ddl_conn.execute.call_args[0][0]
+    triggers = re.findall(
+        r"create or replace trigger (\S+)\nafter (\w+) on \S+\.\"(\w+)\"\n(.*)\n.*\nexecute procedure (\S+)\(\)", ddl
+    )
+    assert len(triggers) == 8
+    for table in ("a_course_table_with_a_long_name", "enrollment"):
+        names = {name for name, _, trigger_table, _, _ in triggers if trigger_table == table}
+        assert len(names) == 4
+        assert all(len(name.encode()) <= 63 for name in names)
+    for name, event, table, referencing, function in triggers:
+        assert name.endswith(f"_{event}")
+        # only the functions that select the keys of the changed rows read the transition tables
+        if event == "truncate" or not incremental:
+            assert (function, referencing) == (f"public.{view}_fn", "")
+        else:
+            assert function.startswith(f"public.{view}_") and function != f"public.{view}_fn"
+            assert referencing.startswith("referencing")
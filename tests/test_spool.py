@@ -0,0 +1,75 @@
+import os
+
+from elasticsearch import ConnectionError
+
+from sinker.spool import Spool, SpoolShipper, decode, encode
+
+
+def actions(count: int, start: int = 0) -> list[dict]:
+    return [{"_index": "foo_index", "_id": f"a-{i}", "_source": '{"name": "Foo"}'} for i in range(start, start + count)]
+
+
+def test_encode_decode() -> None:
+    delete = {"_op_type": "delete", "_index": "foo_index", "_id": "a-1"}
+    assert decode(encode(delete)) == delete
+    index = {"_index": "foo_index", "_id": "a-1", "_source": '{"name": "Foo\\nBar"}'}
+    assert decode(encode(index)) == {**index, "_source": b'{"name": "Foo\\nBar"}'}
+
+
+def test_segments_and_checkpoints(tmp_path) -> None:
+    spool = Spool(str(tmp_path), segment_bytes=200)
+    assert spool.append(actions(10)) == 10
+    assert len(spool._segments()) > 1
+    batch, position = spool.read(spool.checkpoint, 4)
+    assert [action["_id"] for action in batch] == ["a-0", "a-1", "a-2", "a-3"]
+    spool.commit(position)
+    # reopening continues from the checkpoint
+    spool = Spool(str(tmp_path), segment_bytes=200)
+    batch, position = spool.read(spool.checkpoint, 100)
+    assert [action["_id"] for action in batch] == [f"a-{i}" for i in range(4, 10)]
+    spool.commit(position)
+    assert spool.pending_bytes() == 0
+    # shipped segments are deleted
+    assert spool._segments() == [position[0]]
+
+
+def test_torn_record_is_truncated(tmp_path) -> None:
+    spool = Spool(str(tmp_path), segment_bytes=1 << 20)
+    spool.append(actions(3))
+    segment_path = spool._segment_path(spool.end[0])
+    with open(segment_path, "ab") as f:
+        f.write(b"\x00\x00\x01\x00garbage")
+    spool = Spool(str(tmp_path), segment_bytes=1 << 20)
+    assert spool.end[1] == os.path.getsize(segment_path)
+    batch, _ = spool.read(spool.checkpoint, 100)
+    assert len(batch) == 3
+    spool.append(actions(1, start=3))
+    batch, _ = spool.read(spool.checkpoint, 100)
+    assert [action["_id"] for action in batch] == ["a-0", "a-1", "a-2", "a-3"]
+
+
+def test_full_and_clear(tmp_path) -> None:
+    spool = Spool(str(tmp_path), segment_bytes=200, max_bytes=300)
+    spool.append(actions(2))
+    assert not spool.full()
+    spool.append(actions(8))
+    assert spool.full()
+    spool.clear()
+    assert not spool.full()
+    assert spool.read(spool.checkpoint, 100)[0] == []
+
+
+def test_shipper_retries_until_elasticsearch_is_back(tmp_path, mocker) -> None:
+    spool = Spool(str(tmp_path), segment_bytes=1 << 20)
+    spool.append(actions(3))
+    pipeline = mocker.Mock()
+    pipeline.ship.side_effect = [ConnectionError("down"), 3]
+    pipeline.batcher.backoff.return_value = 0
+    mocker.patch("sinker.spool.sleep")
+    shipper = SpoolShipper(spool, pipeline, batch_size=10, poll_interval=0.1)
+    # any error other than Elasticsearch being unreachable stops the shipper, here once the spool is empty
+    spool.wait = mocker.Mock(side_effect=ValueError("stop"))
+    shipper.run()
+    assert pipeline.ship.call_count == 2
+    assert spool.pending_bytes() == 0
+    assert isinstance(shipper.error, ValueError)